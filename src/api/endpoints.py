@@ -11,10 +11,33 @@ async def register_routes(app):
     app.router.add_post('/locks/release', h.release_lock)
     app.router.add_get('/locks/wait_for', h.wait_for)
     app.router.add_post('/queue/produce', h.produce)
+    app.router.add_post('/queue/produce_batch', h.produce_batch)
     app.router.add_post('/queue/consume', h.consume)
+    app.router.add_post('/queue/ack', h.ack)
+    app.router.add_post('/queue/nack', h.nack)
+    app.router.add_post('/queue/stream/publish', h.stream_publish)
+    app.router.add_post('/queue/stream/read', h.stream_read)
+    app.router.add_post('/queue/stream/ack', h.stream_ack)
+    app.router.add_post('/queue/stream/claim', h.stream_claim)
+    app.router.add_post('/queue/stream/seek', h.stream_seek)
+    app.router.add_get('/queue/stream/groups', h.stream_groups)
+    app.router.add_get('/queue/stats', h.queue_stats)
+    app.router.add_get('/queue/subscribe', h.queue_subscribe)
     app.router.add_get('/cache/get', h.cache_get)
     app.router.add_post('/cache/put', h.cache_put)
+    app.router.add_post('/cache/mget', h.cache_mget)
+    app.router.add_post('/cache/mput', h.cache_mput)
+    app.router.add_post('/cache/mdelete', h.cache_mdelete)
     app.router.add_post('/cache/invalidate', h.cache_invalidate)
+    app.router.add_post('/cache/minvalidate', h.cache_minvalidate)
+    app.router.add_post('/cache/purge', h.cache_purge)
+    app.router.add_post('/cache/invalidate_bulk', h.cache_invalidate_bulk)
+    app.router.add_post('/cache/update', h.cache_update)
     app.router.add_get('/cache/fetch', h.cache_fetch)
+    app.router.add_post('/cache/mfetch', h.cache_mfetch)
     app.router.add_get('/cache/state', h.cache_state)
+    app.router.add_get('/cache/keys', h.cache_keys)
+    app.router.add_get('/cache/digest', h.cache_digest)
+    app.router.add_get('/cache/snapshot', h.cache_snapshot)
+    app.router.add_get('/cache/subscribe', h.cache_subscribe)
     app.router.add_get('/metrics', h.metrics)
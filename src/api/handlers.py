@@ -1,6 +1,9 @@
-from aiohttp import web
+from aiohttp import web, WSMsgType, WSCloseCode
+import asyncio
 import json
+import time
 from src.utils.logging import get_logger, get_error_handler
+from src.nodes.queue_node import QueueFullError
 
 class Handlers:
     def __init__(self, app):
@@ -31,12 +34,15 @@ class Handlers:
 
     async def health(self, request):
         try:
+            # A node still warming its cache is up but not ready for traffic
+            ready = self.app['cache'].ready
             return web.json_response({
-                'status': 'ok',
+                'status': 'ok' if ready else 'warming',
                 'node_id': self.app['node_id'],
                 'leader': self.app['raft'].leader,
-                'term': self.app['raft'].term
-            })
+                'term': self.app['raft'].term,
+                'cache_ready': ready
+            }, status=200 if ready else 503)
         except Exception as e:
             self.logger.error("Health check failed", exception=e)
             return web.json_response({'status': 'error', 'error': str(e)}, status=500)
@@ -99,38 +105,403 @@ class Handlers:
         if not topic or not message:
             return web.json_response({'error': 'topic and message required'}, status=400)
         
-        await self.app['queue'].produce(topic, message)
+        options, error = self._produce_options(data)
+        if error:
+            return web.json_response({'error': error}, status=400)
+        
+        try:
+            await self.app['queue'].produce(topic, message, **options)
+        except ValueError as e:
+            return web.json_response({'error': str(e)}, status=400)
+        except QueueFullError as e:
+            return self._queue_full(e)
         return web.json_response({'status': 'ok'})
 
+    async def produce_batch(self, request):
+        data = await request.json()
+        topic = data.get('topic')
+        messages = data.get('messages')
+        
+        if not topic or not self._valid_keys(messages):
+            return web.json_response({'error': 'topic and non-empty messages list required'}, status=400)
+        
+        options, error = self._produce_options(data)
+        if error:
+            return web.json_response({'error': error}, status=400)
+        
+        try:
+            await self.app['queue'].produce_batch(topic, messages, **options)
+        except ValueError as e:
+            return web.json_response({'error': str(e)}, status=400)
+        except QueueFullError as e:
+            return self._queue_full(e)
+        return web.json_response({'status': 'ok', 'count': len(messages)})
+
+    @staticmethod
+    def _queue_full(error):
+        # Backpressure: the producer should slow down and retry
+        return web.json_response({'error': str(error)}, status=429, headers={'Retry-After': '1'})
+
+    def _produce_options(self, data):
+        """
+        Validate the produce options: key, priority, and delay (seconds) or
+        deliver_at (unix time). Returns (options, error message).
+        """
+        # Messages sharing a key go to the same partition, so their order is kept
+        options = {'key': data.get('key')}
+        priority = data.get('priority')
+        if priority is not None:
+            if not isinstance(priority, int) or isinstance(priority, bool) or priority < 0:
+                return None, 'priority must be a non-negative integer'
+            options['priority'] = priority
+        delay = data.get('delay')
+        deliver_at = data.get('deliver_at')
+        if delay is not None and deliver_at is not None:
+            return None, 'use either delay or deliver_at, not both'
+        if delay is not None and not self._valid_seconds(delay):
+            return None, 'delay must be a non-negative number'
+        if deliver_at is not None:
+            if not self._valid_seconds(deliver_at):
+                return None, 'deliver_at must be a unix timestamp'
+            delay = max(0.0, deliver_at - time.time())
+        if delay:
+            options['delay'] = delay
+        return options, None
+
     async def consume(self, request):
         data = await request.json()
         topic = data.get('topic')
+        count = data.get('count')
+        timeout = data.get('timeout')
         
         if not topic:
             return web.json_response({'error': 'topic required'}, status=400)
+        if count is not None and not self._valid_count(count):
+            return web.json_response({'error': 'count must be a positive integer'}, status=400)
+        if timeout is not None and not self._valid_seconds(timeout):
+            return web.json_response({'error': 'timeout must be a non-negative number'}, status=400)
         
-        message = await self.app['queue'].consume(topic)
+        # timeout (seconds, capped by the queue) turns an empty-topic poll into a blocking wait;
+        # consumer limits reads to the partitions assigned to it
+        options = {'timeout': timeout} if timeout else {}
+        if data.get('consumer'):
+            options['consumer'] = data['consumer']
+        if data.get('reliable'):
+            return await self._consume_reliable(topic, count, options, data)
+        if count is not None:
+            messages = await self.app['queue'].consume(topic, count=count, **options)
+            return web.json_response({'messages': messages})
+        message = await self.app['queue'].consume(topic, **options)
         return web.json_response({'message': message})
 
+    async def _consume_reliable(self, topic, count, options, data):
+        visibility_timeout = data.get('visibility_timeout')
+        if visibility_timeout is not None and (not self._valid_seconds(visibility_timeout) or visibility_timeout == 0):
+            return web.json_response({'error': 'visibility_timeout must be a positive number'}, status=400)
+        
+        deliveries = await self.app['queue'].consume_reliable(
+            topic, count=count, visibility_timeout=visibility_timeout, **options)
+        if count is not None:
+            return web.json_response({'messages': deliveries})
+        if deliveries is None:
+            return web.json_response({'message': None, 'receipt': None})
+        return web.json_response(deliveries)
+
+    async def ack(self, request):
+        return await self._settle(request, self.app['queue'].ack)
+
+    async def nack(self, request):
+        return await self._settle(request, self.app['queue'].nack)
+
+    async def _settle(self, request, settle):
+        data = await request.json()
+        topic = data.get('topic')
+        receipt = data.get('receipt')
+        
+        if not topic or not receipt:
+            return web.json_response({'error': 'topic and receipt required'}, status=400)
+        
+        success = await settle(topic, receipt)
+        return web.json_response({'success': success})
+
+    @staticmethod
+    def _streams_unavailable():
+        return web.json_response({'error': 'stream topics require Redis'}, status=503)
+
+    async def stream_publish(self, request):
+        data = await request.json()
+        topic = data.get('topic')
+        messages = data.get('messages', [data['message']] if data.get('message') else None)
+        
+        if not topic or not self._valid_keys(messages):
+            return web.json_response({'error': 'topic and message or messages required'}, status=400)
+        
+        ids = await self.app['queue'].publish(topic, messages)
+        if ids is None:
+            return self._streams_unavailable()
+        return web.json_response({'ids': ids})
+
+    async def stream_read(self, request):
+        data = await request.json()
+        topic, group, consumer = data.get('topic'), data.get('group'), data.get('consumer')
+        count = data.get('count', 1)
+        timeout = data.get('timeout')
+        
+        if not topic or not group or not consumer:
+            return web.json_response({'error': 'topic, group and consumer required'}, status=400)
+        if not self._valid_count(count):
+            return web.json_response({'error': 'count must be a positive integer'}, status=400)
+        if timeout is not None and not self._valid_seconds(timeout):
+            return web.json_response({'error': 'timeout must be a non-negative number'}, status=400)
+        
+        messages = await self.app['queue'].read_group(topic, group, consumer, count=count, timeout=timeout)
+        if messages is None:
+            return self._streams_unavailable()
+        return web.json_response({'messages': messages})
+
+    async def stream_ack(self, request):
+        data = await request.json()
+        topic, group, ids = data.get('topic'), data.get('group'), data.get('ids')
+        
+        if not topic or not group or not self._valid_keys(ids):
+            return web.json_response({'error': 'topic, group and non-empty ids list required'}, status=400)
+        
+        acked = await self.app['queue'].ack_group(topic, group, ids)
+        if acked is None:
+            return self._streams_unavailable()
+        return web.json_response({'acked': acked})
+
+    async def stream_claim(self, request):
+        """Reclaim entries left pending by a consumer that went away"""
+        data = await request.json()
+        topic, group, consumer = data.get('topic'), data.get('group'), data.get('consumer')
+        min_idle = data.get('min_idle')
+        count = data.get('count', 100)
+        
+        if not topic or not group or not consumer:
+            return web.json_response({'error': 'topic, group and consumer required'}, status=400)
+        if not self._valid_seconds(min_idle):
+            return web.json_response({'error': 'min_idle must be a non-negative number'}, status=400)
+        if not self._valid_count(count):
+            return web.json_response({'error': 'count must be a positive integer'}, status=400)
+        
+        messages = await self.app['queue'].claim_pending(topic, group, consumer, min_idle, count=count)
+        if messages is None:
+            return self._streams_unavailable()
+        return web.json_response({'messages': messages})
+
+    async def stream_seek(self, request):
+        data = await request.json()
+        topic, group, offset = data.get('topic'), data.get('group'), data.get('offset')
+        
+        if not topic or not group or not isinstance(offset, str) or not offset:
+            return web.json_response({'error': 'topic, group and offset required'}, status=400)
+        
+        result = await self.app['queue'].seek_group(topic, group, offset)
+        if result is None:
+            return self._streams_unavailable()
+        return web.json_response({'status': 'ok'})
+
+    async def stream_groups(self, request):
+        topic = request.query.get('topic')
+        if not topic:
+            return web.json_response({'error': 'topic required'}, status=400)
+        
+        groups = await self.app['queue'].stream_groups(topic)
+        if groups is None:
+            return self._streams_unavailable()
+        return web.json_response({'groups': groups})
+
+    async def queue_subscribe(self, request):
+        """
+        WebSocket push subscription (?topic=a&topic=b). The client grants
+        credits with {"type": "credit", "n": N} (or ?credits=N) and is pushed
+        one {"type": "message", ...} frame per credit. With reliable=true each
+        message has a receipt, settled with {"type": "ack" | "nack", "receipt"}
+        on the same socket; deliveries unsettled at disconnect are nacked.
+        """
+        topics = request.query.getall('topic', [])
+        if not topics:
+            return web.json_response({'error': 'topic required'}, status=400)
+        reliable = request.query.get('reliable', 'false').lower() in ('1', 'true', 'yes')
+        try:
+            credits = int(request.query.get('credits', 0))
+            visibility_timeout = request.query.get('visibility_timeout')
+            visibility_timeout = float(visibility_timeout) if visibility_timeout is not None else None
+        except ValueError:
+            return web.json_response({'error': 'credits and visibility_timeout must be numbers'}, status=400)
+        if credits < 0 or (visibility_timeout is not None and visibility_timeout <= 0):
+            return web.json_response({'error': 'credits must be >= 0 and visibility_timeout > 0'}, status=400)
+        
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        subscription = self.app['queue'].subscribe(
+            topics, consumer=request.query.get('consumer'), reliable=reliable,
+            visibility_timeout=visibility_timeout, credits=credits)
+        pusher = asyncio.ensure_future(self._push_messages(ws, subscription))
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    data = json.loads(msg.data)
+                except ValueError:
+                    await ws.send_json({'type': 'error', 'error': 'invalid JSON'})
+                    continue
+                kind = data.get('type') if isinstance(data, dict) else None
+                if kind == 'credit':
+                    if not self._valid_count(data.get('n')):
+                        await ws.send_json({'type': 'error', 'error': 'n must be a positive integer'})
+                        continue
+                    subscription.grant(data['n'])
+                elif kind in ('ack', 'nack'):
+                    success = await subscription.settle(data.get('receipt'), requeue=kind == 'nack')
+                    await ws.send_json({'type': kind, 'receipt': data.get('receipt'), 'success': success})
+                else:
+                    await ws.send_json({'type': 'error', 'error': 'type must be credit, ack or nack'})
+        finally:
+            # The pusher notices the closed socket within one wait. It is not cancelled
+            # mid-pop, so a reliable delivery it took is tracked and nacked below
+            await asyncio.gather(pusher, return_exceptions=True)
+            await subscription.close()
+            await ws.close()
+        return ws
+
+    async def _push_messages(self, ws, subscription):
+        try:
+            while not ws.closed:
+                for delivery in await subscription.next_batch():
+                    await ws.send_json({'type': 'message', **delivery})
+        except Exception as e:
+            if not ws.closed:
+                self.logger.error("Queue subscription push failed", exception=e)
+                await ws.close(code=WSCloseCode.INTERNAL_ERROR)
+
+    async def queue_stats(self, request):
+        # Depth, rates, oldest-message age and group lag for one topic (?topic=) or all known ones
+        stats = await self.app['queue'].stats(request.query.get('topic'))
+        return web.json_response({'node_id': self.app['node_id'], 'topics': stats})
+
     async def cache_get(self, request):
         key = request.query.get('key')
         if not key:
             return web.json_response({'error': 'key required'}, status=400)
         
-        value = await self.app['cache'].get(key)
+        # forwarded=1 marks a request proxied by another node (node=) in partitioned mode
+        forwarded = request.query.get('forwarded') == '1'
+        value = await self.app['cache'].get(key, forwarded=forwarded,
+                                            reader=request.query.get('node') if forwarded else None)
         return web.json_response({'value': value})
 
     async def cache_put(self, request):
         data = await request.json()
         key = data.get('key')
         value = data.get('value')
+        ttl = data.get('ttl')
+        tags = data.get('tags')
         
         if not key or value is None:
             return web.json_response({'error': 'key and value required'}, status=400)
+        if ttl is not None and (not isinstance(ttl, (int, float)) or ttl <= 0):
+            return web.json_response({'error': 'ttl must be a positive number'}, status=400)
+        if tags is not None and not self._valid_keys(tags):
+            return web.json_response({'error': 'tags must be a non-empty list of strings'}, status=400)
+        
+        success = await self.app['cache'].put(key, value, ttl=ttl, tags=tags,
+                                              forwarded=bool(data.get('forwarded')))
+        return web.json_response({'success': success})
+
+    @staticmethod
+    def _valid_keys(keys):
+        return isinstance(keys, list) and bool(keys) and all(isinstance(k, str) and k for k in keys)
+
+    @staticmethod
+    def _valid_count(count):
+        return isinstance(count, int) and not isinstance(count, bool) and count > 0
+
+    @staticmethod
+    def _valid_seconds(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+
+    async def cache_mget(self, request):
+        data = await request.json()
+        keys = data.get('keys')
+        
+        if not self._valid_keys(keys):
+            return web.json_response({'error': 'keys must be a non-empty list of strings'}, status=400)
+        
+        forwarded = bool(data.get('forwarded'))
+        values = await self.app['cache'].mget(keys, forwarded=forwarded,
+                                              reader=data.get('node') if forwarded else None)
+        return web.json_response({'values': values})
+
+    async def cache_mput(self, request):
+        data = await request.json()
+        items = data.get('items')
+        ttl = data.get('ttl')
+        tags = data.get('tags')
+        
+        if not isinstance(items, dict) or not items or not self._valid_keys(list(items)):
+            return web.json_response({'error': 'items must be a non-empty object'}, status=400)
+        if any(v is None for v in items.values()):
+            return web.json_response({'error': 'values must not be null'}, status=400)
+        if ttl is not None and (not isinstance(ttl, (int, float)) or ttl <= 0):
+            return web.json_response({'error': 'ttl must be a positive number'}, status=400)
+        if tags is not None and not self._valid_keys(tags):
+            return web.json_response({'error': 'tags must be a non-empty list of strings'}, status=400)
         
-        success = await self.app['cache'].put(key, value)
+        success = await self.app['cache'].mput(items, ttl=ttl, tags=tags,
+                                               forwarded=bool(data.get('forwarded')))
         return web.json_response({'success': success})
 
+    async def cache_mdelete(self, request):
+        data = await request.json()
+        keys = data.get('keys')
+        
+        if not self._valid_keys(keys):
+            return web.json_response({'error': 'keys must be a non-empty list of strings'}, status=400)
+        
+        deleted = await self.app['cache'].mdelete(keys, forwarded=bool(data.get('forwarded')))
+        return web.json_response({'deleted': deleted})
+
+    async def cache_purge(self, request):
+        """Invalidate all keys under a prefix and/or carrying any of the tags, cluster-wide"""
+        data = await request.json()
+        prefix = data.get('prefix')
+        tags = data.get('tags')
+        
+        if prefix is not None and (not isinstance(prefix, str) or not prefix):
+            return web.json_response({'error': 'prefix must be a non-empty string'}, status=400)
+        if tags is not None and not self._valid_keys(tags):
+            return web.json_response({'error': 'tags must be a non-empty list of strings'}, status=400)
+        if prefix is None and tags is None:
+            return web.json_response({'error': 'prefix or tags required'}, status=400)
+        
+        removed = await self.app['cache'].purge(prefix=prefix, tags=tags)
+        return web.json_response({'removed': removed})
+
+    async def cache_invalidate_bulk(self, request):
+        data = await request.json()
+        prefix = data.get('prefix')
+        tags = data.get('tags')
+        
+        if not prefix and not tags:
+            return web.json_response({'error': 'prefix or tags required'}, status=400)
+        
+        await self.app['cache'].handle_invalidate_bulk(prefix=prefix, tags=tags, sender=data.get('node'))
+        return web.json_response({'status': 'ok'})
+
+    async def cache_update(self, request):
+        """Write-update push from the node that wrote the lines"""
+        data = await request.json()
+        lines = data.get('lines')
+        
+        if not isinstance(lines, dict) or not lines or not all(isinstance(l, dict) for l in lines.values()):
+            return web.json_response({'error': 'lines must be a non-empty object'}, status=400)
+        
+        result = await self.app['cache'].handle_update(lines, sender=data.get('node'))
+        return web.json_response(result)
+
     async def cache_invalidate(self, request):
         data = await request.json()
         key = data.get('key')
@@ -138,21 +509,113 @@ class Handlers:
         if not key:
             return web.json_response({'error': 'key required'}, status=400)
         
-        await self.app['cache'].handle_invalidate(key)
+        await self.app['cache'].handle_invalidate(key, sender=data.get('node'), version=data.get('version'))
+        return web.json_response({'status': 'ok'})
+
+    async def cache_minvalidate(self, request):
+        data = await request.json()
+        keys = data.get('keys')
+        
+        if not self._valid_keys(keys):
+            return web.json_response({'error': 'keys must be a non-empty list of strings'}, status=400)
+        
+        await self.app['cache'].handle_minvalidate(keys, sender=data.get('node'), version=data.get('version'))
         return web.json_response({'status': 'ok'})
 
     async def cache_fetch(self, request):
         key = request.query.get('key')
         if not key:
             return web.json_response({'error': 'key required'}, status=400)
+        if_version = request.query.get('if_version')
+        try:
+            if_version = int(if_version) if if_version is not None else None
+        except ValueError:
+            return web.json_response({'error': 'if_version must be an integer'}, status=400)
         
-        result = await self.app['cache'].handle_fetch(key)
+        # any=1: the requester found no MESIF FORWARD holder, so sharers answer too
+        any_holder = request.query.get('any') == '1'
+        result = await self.app['cache'].handle_fetch(key, if_version=if_version, any_holder=any_holder)
         return web.json_response(result)
 
+    async def cache_mfetch(self, request):
+        data = await request.json()
+        keys = data.get('keys')
+        
+        if not self._valid_keys(keys):
+            return web.json_response({'error': 'keys must be a non-empty list of strings'}, status=400)
+        
+        result = await self.app['cache'].handle_mfetch(keys, any_holder=bool(data.get('any')))
+        return web.json_response(result)
+
+    async def cache_snapshot(self, request):
+        """One page of hot clean lines for a peer warming its cache"""
+        try:
+            offset = int(request.query.get('offset', '0'))
+            limit = int(request.query.get('limit', '100'))
+        except ValueError:
+            return web.json_response({'error': 'offset and limit must be integers'}, status=400)
+        
+        result = await self.app['cache'].handle_snapshot(offset, limit)
+        return web.json_response(result)
+
+    async def cache_digest(self, request):
+        """Bloom digest of this node's keys, as a delta when ?epoch=&since= is current"""
+        epoch = request.query.get('epoch')
+        since = request.query.get('since')
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            return web.json_response({'error': 'since must be an integer'}, status=400)
+        
+        digest = await self.app['cache'].get_digest(epoch=epoch, since=since)
+        if digest is None:
+            return web.json_response({'error': 'digests disabled'}, status=404)
+        return web.json_response(digest)
+
     async def cache_state(self, request):
         state = await self.app['cache'].get_cache_state()
         return web.json_response(state)
 
+    async def cache_subscribe(self, request):
+        """WebSocket stream of invalidation events for client near-caches"""
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        cache = self.app['cache']
+        queue = cache.subscribe()
+        # Anything cached before this point may already be stale on the client
+        await ws.send_json({'type': 'reset'})
+        reader = asyncio.ensure_future(ws.receive())
+        try:
+            while not ws.closed:
+                getter = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({getter, reader}, return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    await ws.send_json(getter.result())
+                else:
+                    getter.cancel()
+                if reader in done:
+                    # Clients only listen; any inbound frame other than a close is ignored
+                    msg = reader.result()
+                    if msg.type in (WSMsgType.CLOSE, WSMsgType.CLOSING, WSMsgType.CLOSED, WSMsgType.ERROR):
+                        break
+                    reader = asyncio.ensure_future(ws.receive())
+        finally:
+            reader.cancel()
+            cache.unsubscribe(queue)
+            await ws.close()
+        return ws
+
+    async def cache_keys(self, request):
+        try:
+            cursor = int(request.query.get('cursor', 0))
+            limit = int(request.query.get('limit', 100))
+        except ValueError:
+            return web.json_response({'error': 'cursor and limit must be integers'}, status=400)
+        sample = request.query.get('sample', 'false').lower() in ('1', 'true', 'yes')
+        
+        listing = await self.app['cache'].list_keys(cursor=cursor, limit=limit, sample=sample)
+        return web.json_response(listing)
+
     async def metrics(self, request):
         """Get metrics in Prometheus format"""
         metrics_data = self.app['metrics'].get_metrics_endpoint_data()
@@ -0,0 +1,171 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+class NearCacheClient:
+    """
+    Cache client with an in-process near-cache.
+
+    Reads are served from local memory while the node's invalidation stream
+    (/cache/subscribe) is connected; every key the node invalidates is pushed
+    over the WebSocket and dropped locally. While the stream is down the
+    near-cache is cleared and bypassed, so coherence never depends on a
+    connection we cannot see.
+    """
+
+    def __init__(self, base_url: str, capacity: int = 10000, ttl: Optional[float] = None,
+                 reconnect_delay: float = 1.0):
+        self.base_url = base_url.rstrip('/')
+        self.capacity = capacity
+        # Optional local TTL on top of push invalidation, as a safety net
+        self.ttl = ttl
+        self.reconnect_delay = reconnect_delay
+        self._local = OrderedDict()
+        # key -> token of the fetch in flight; invalidations cancel the token
+        self._pending: Dict[str, object] = {}
+        self._connected = False
+        self._session = None
+        self._listener = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'resets': 0
+        }
+
+    async def start(self):
+        """Open the HTTP session and start following the invalidation stream"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5, connect=2))
+        if self._listener is None:
+            self._listener = asyncio.ensure_future(self._listen_loop())
+
+    async def close(self):
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._reset()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    async def _listen_loop(self):
+        while True:
+            try:
+                async with self._session.ws_connect(f'{self.base_url}/cache/subscribe', heartbeat=30) as ws:
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        self._apply_event(msg.json())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Near-cache stream to {self.base_url} failed: {e}")
+            self._connected = False
+            self._reset()
+            await asyncio.sleep(self.reconnect_delay)
+
+    def _apply_event(self, event: Dict[str, Any]):
+        typ = event.get('type')
+        if typ == 'reset':
+            # Sent on (re)connect and when the node dropped events for us
+            self._reset()
+            self._connected = True
+        elif typ == 'invalidate':
+            for key in event.get('keys', []):
+                self._local.pop(key, None)
+                self._pending.pop(key, None)
+                self.stats['invalidations'] += 1
+        elif typ == 'invalidate_prefix':
+            prefix = event.get('prefix', '')
+            for key in [k for k in self._local if k.startswith(prefix)]:
+                del self._local[key]
+                self.stats['invalidations'] += 1
+            for key in [k for k in self._pending if k.startswith(prefix)]:
+                del self._pending[key]
+
+    def _reset(self):
+        self._local.clear()
+        self._pending.clear()
+        self.stats['resets'] += 1
+
+    def _lookup(self, key):
+        item = self._local.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.time():
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return item
+
+    def _remember(self, key, value, token):
+        # Only install if no invalidation for the key arrived while we were fetching
+        current = self._pending.get(key)
+        if current is token:
+            del self._pending[key]
+        if value is None or current is not token or not self._connected:
+            return
+        expires_at = time.time() + self.ttl if self.ttl else None
+        self._local[key] = (value, expires_at)
+        self._local.move_to_end(key)
+        while len(self._local) > self.capacity:
+            self._local.popitem(last=False)
+
+    async def get(self, key: str) -> Any:
+        item = self._lookup(key) if self._connected else None
+        if item is not None:
+            self.stats['hits'] += 1
+            return item[0]
+        self.stats['misses'] += 1
+        token = self._pending[key] = object()
+        async with self._session.get(f'{self.base_url}/cache/get', params={'key': key}) as resp:
+            resp.raise_for_status()
+            value = (await resp.json()).get('value')
+        self._remember(key, value, token)
+        return value
+
+    async def mget(self, keys: List[str]) -> Dict[str, Any]:
+        values = {}
+        missing = []
+        for key in keys:
+            item = self._lookup(key) if self._connected else None
+            if item is not None:
+                self.stats['hits'] += 1
+                values[key] = item[0]
+            elif key not in values:
+                missing.append(key)
+                values[key] = None
+        if not missing:
+            return values
+        self.stats['misses'] += len(missing)
+        tokens = {key: object() for key in missing}
+        self._pending.update(tokens)
+        async with self._session.post(f'{self.base_url}/cache/mget', json={'keys': missing}) as resp:
+            resp.raise_for_status()
+            fetched = (await resp.json()).get('values', {})
+        for key in missing:
+            values[key] = fetched.get(key)
+            self._remember(key, values[key], tokens[key])
+        return values
+
+    async def put(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        self._local.pop(key, None)
+        self._pending.pop(key, None)
+        payload = {'key': key, 'value': value}
+        if ttl is not None:
+            payload['ttl'] = ttl
+        async with self._session.post(f'{self.base_url}/cache/put', json=payload) as resp:
+            resp.raise_for_status()
+            return (await resp.json()).get('success', False)
@@ -1,4 +1,4 @@
-import os, asyncio
+import os, json, asyncio
 from aiohttp import web
 from src.consensus.raft_redis import RaftRedis
 from src.nodes.lock_manager import LockManager
@@ -13,6 +13,77 @@ NODE_ID = os.getenv('NODE_ID', 'node1')
 PEERS = os.getenv('PEERS', 'node1,node2,node3').split(',')
 HTTP_PORT = int(os.getenv('HTTP_PORT', '8000'))
 REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+# CACHE_CAPACITY=0 disables the entry bound so only CACHE_CAPACITY_BYTES applies
+CACHE_CAPACITY = int(os.getenv('CACHE_CAPACITY', '100')) or None
+CACHE_CAPACITY_BYTES = int(os.getenv('CACHE_CAPACITY_BYTES', '0')) or None
+CACHE_EVICTION_POLICY = os.getenv('CACHE_EVICTION_POLICY', 'lru')
+CACHE_DEFAULT_TTL = float(os.getenv('CACHE_DEFAULT_TTL', '0')) or None
+CACHE_PROTOCOL = os.getenv('CACHE_PROTOCOL', 'MESI')
+CACHE_FETCH_MODE = os.getenv('CACHE_FETCH_MODE', 'hedged')
+# 0 disables peer key digests / the negative cache
+CACHE_DIGEST_INTERVAL = float(os.getenv('CACHE_DIGEST_INTERVAL', '2')) or None
+CACHE_NEGATIVE_TTL = float(os.getenv('CACHE_NEGATIVE_TTL', '1')) or None
+# Hot lines copied on start (0 disables warm-up) and where they are snapshotted locally
+CACHE_WARMUP_KEYS = int(os.getenv('CACHE_WARMUP_KEYS', '0'))
+CACHE_SNAPSHOT_PATH = os.getenv('CACHE_SNAPSHOT_PATH', f'/tmp/cache-{NODE_ID}.snapshot') or None
+CACHE_SNAPSHOT_INTERVAL = float(os.getenv('CACHE_SNAPSHOT_INTERVAL', '60'))
+# Values whose JSON encoding reaches this many bytes are stored zlib compressed (0 = off)
+CACHE_COMPRESS_THRESHOLD = int(os.getenv('CACHE_COMPRESS_THRESHOLD', '0')) or None
+# Comma-separated keys / 'prefix*' patterns updated in place on sharers instead of invalidated
+CACHE_WRITE_UPDATE = [p for p in os.getenv('CACHE_WRITE_UPDATE', '').split(',') if p]
+# replicated (MESI copies everywhere) or partitioned (one owner per key via a hash ring)
+CACHE_MODE = os.getenv('CACHE_MODE', 'replicated')
+CACHE_L1_CAPACITY = int(os.getenv('CACHE_L1_CAPACITY', '1000'))
+CACHE_L1_TTL = float(os.getenv('CACHE_L1_TTL', '1'))
+# Keep a key trie for prefix purges instead of scanning every key per purge
+CACHE_PREFIX_INDEX = bool(int(os.getenv('CACHE_PREFIX_INDEX', '0')))
+# Connections reserved for the blocking peeks (BLMOVE) of consumes and lane watchers, kept apart from the shared pool
+QUEUE_BLOCKING_CONNECTIONS = int(os.getenv('QUEUE_BLOCKING_CONNECTIONS', '50'))
+# Seconds a reliable delivery may stay unacked before it is redelivered
+QUEUE_VISIBILITY_TIMEOUT = float(os.getenv('QUEUE_VISIBILITY_TIMEOUT', '30'))
+# Partitions per topic, spread by a hash ring over QUEUE_REDIS_URLS (empty = REDIS_URL only)
+QUEUE_PARTITIONS = int(os.getenv('QUEUE_PARTITIONS', '1'))
+QUEUE_REDIS_URLS = [u for u in os.getenv('QUEUE_REDIS_URLS', '').split(',') if u]
+# Where the fallback queue keeps its segmented logs while Redis is unavailable
+QUEUE_DATA_DIR = os.getenv('QUEUE_DATA_DIR', '/tmp')
+QUEUE_SEGMENT_BYTES = int(os.getenv('QUEUE_SEGMENT_BYTES', str(1 << 20)))
+# Approximate number of entries kept per stream topic (0 = unbounded)
+QUEUE_STREAM_MAXLEN = int(os.getenv('QUEUE_STREAM_MAXLEN', '100000')) or None
+# Priority levels per topic (0 = lowest, consumed last)
+QUEUE_PRIORITY_LEVELS = int(os.getenv('QUEUE_PRIORITY_LEVELS', '3'))
+# Topic limits (0 = unbounded; bytes are message payload), split evenly over partitions, and what happens when one is hit:
+# reject (HTTP 429), block, drop_oldest or spill (to a local log, refilled as the topic drains)
+QUEUE_MAX_DEPTH = int(os.getenv('QUEUE_MAX_DEPTH', '0'))
+QUEUE_MAX_BYTES = int(os.getenv('QUEUE_MAX_BYTES', '0'))
+QUEUE_OVERFLOW = os.getenv('QUEUE_OVERFLOW', 'reject')
+QUEUE_OVERFLOW_BLOCK_TIMEOUT = float(os.getenv('QUEUE_OVERFLOW_BLOCK_TIMEOUT', '5'))
+# Per-topic overrides as JSON, e.g. {"events": {"max_depth": 100000, "overflow": "spill"}}
+QUEUE_TOPIC_LIMITS = json.loads(os.getenv('QUEUE_TOPIC_LIMITS', '') or '{}')
+
+def _redis_client(url):
+    return redis.from_url(
+        url,
+        encoding='utf-8',
+        decode_responses=True,
+        max_connections=20,
+        retry_on_timeout=True,
+        socket_timeout=5,
+        socket_connect_timeout=5
+    )
+
+def _blocking_redis_client(url):
+    # No socket timeout: a blocking peek legitimately stays silent for its whole wait.
+    # The blocking pool makes extra consumers queue for a connection rather than fail.
+    return redis.Redis(
+        connection_pool=redis.BlockingConnectionPool.from_url(
+            url,
+            encoding='utf-8',
+            decode_responses=True,
+            max_connections=QUEUE_BLOCKING_CONNECTIONS,
+            socket_timeout=None,
+            socket_connect_timeout=5
+        )
+    )
 
 async def create_app():
     # Setup logging first
@@ -25,16 +96,16 @@ async def create_app():
     
     app = web.Application()
     redis_client = None
+    blocking_redis = None
+    queue_shards = queue_blocking_shards = None
     try:
-        redis_client = redis.from_url(
-            REDIS_URL, 
-            encoding='utf-8', 
-            decode_responses=True,
-            max_connections=20,
-            retry_on_timeout=True,
-            socket_timeout=5,
-            socket_connect_timeout=5
-        )
+        redis_client = _redis_client(REDIS_URL)
+        blocking_redis = _blocking_redis_client(REDIS_URL)
+        if QUEUE_REDIS_URLS:
+            queue_shards = {url: redis_client if url == REDIS_URL else _redis_client(url)
+                            for url in QUEUE_REDIS_URLS}
+            queue_blocking_shards = {url: blocking_redis if url == REDIS_URL else _blocking_redis_client(url)
+                                     for url in QUEUE_REDIS_URLS}
         logger.info("Redis connection established", redis_url=REDIS_URL)
     except Exception as e:
         logger.error("Redis connection failed", exception=e, redis_url=REDIS_URL)
@@ -43,9 +114,46 @@ async def create_app():
     msg_client = MessageClient(node_id=NODE_ID, peers=PEERS)
     raft = RaftRedis(node_id=NODE_ID, peers=PEERS, redis=redis_client, msg_client=msg_client)
     lockman = LockManager(node_id=NODE_ID, raft=raft, msg_client=msg_client)
-    queue = DistributedQueue(node_id=NODE_ID, redis_client=redis_client)
-    cache = CacheNode(node_id=NODE_ID, msg_client=msg_client)
-    metrics = SystemMetrics(node_id=NODE_ID)
+    queue = DistributedQueue(
+        node_id=NODE_ID,
+        redis_client=redis_client,
+        blocking_redis=blocking_redis,
+        visibility_timeout=QUEUE_VISIBILITY_TIMEOUT,
+        shards=queue_shards,
+        blocking_shards=queue_blocking_shards,
+        partitions=QUEUE_PARTITIONS,
+        data_dir=QUEUE_DATA_DIR,
+        segment_bytes=QUEUE_SEGMENT_BYTES,
+        stream_maxlen=QUEUE_STREAM_MAXLEN,
+        priority_levels=QUEUE_PRIORITY_LEVELS,
+        max_depth=QUEUE_MAX_DEPTH,
+        max_bytes=QUEUE_MAX_BYTES,
+        overflow=QUEUE_OVERFLOW,
+        overflow_block_timeout=QUEUE_OVERFLOW_BLOCK_TIMEOUT,
+        topic_limits=QUEUE_TOPIC_LIMITS
+    )
+    cache = CacheNode(
+        node_id=NODE_ID,
+        msg_client=msg_client,
+        capacity=CACHE_CAPACITY,
+        capacity_bytes=CACHE_CAPACITY_BYTES,
+        eviction_policy=CACHE_EVICTION_POLICY,
+        default_ttl=CACHE_DEFAULT_TTL,
+        protocol=CACHE_PROTOCOL,
+        fetch_mode=CACHE_FETCH_MODE,
+        digest_interval=CACHE_DIGEST_INTERVAL,
+        negative_ttl=CACHE_NEGATIVE_TTL,
+        warmup_keys=CACHE_WARMUP_KEYS,
+        snapshot_path=CACHE_SNAPSHOT_PATH,
+        snapshot_interval=CACHE_SNAPSHOT_INTERVAL,
+        compress_threshold=CACHE_COMPRESS_THRESHOLD,
+        write_update=CACHE_WRITE_UPDATE,
+        mode=CACHE_MODE,
+        l1_capacity=CACHE_L1_CAPACITY,
+        l1_ttl=CACHE_L1_TTL,
+        prefix_index=CACHE_PREFIX_INDEX
+    )
+    metrics = SystemMetrics(node_id=NODE_ID, queue=queue)
 
     app['node_id'] = NODE_ID
     app['raft'] = raft
@@ -65,6 +173,7 @@ async def create_app():
     app.on_startup.append(lambda a: raft.start_background(a))
     app.on_startup.append(lambda a: lockman.start_background(a))
     app.on_startup.append(lambda a: cache.start_background(a))
+    app.on_startup.append(lambda a: queue.start_background(a))
     app.on_startup.append(lambda a: metrics.start_background(a))
     
     logger.info("Background tasks started")
@@ -1,31 +1,214 @@
 import asyncio
+import base64
+import json
+import os
+import random
 import time
-from collections import OrderedDict
+import uuid
+import zlib
+from collections import OrderedDict, deque
 from enum import Enum
+from urllib.parse import quote
+from src.utils.eviction import Link, make_policy
+from src.utils.bloom import BloomFilter, CountingBloomFilter, optimal_params
+from src.utils.hash_ring import ConsistentHashRing
+from src.utils.key_index import PrefixIndex, TagIndex
+from src.utils.timing_wheel import TimingWheel
 
 class CacheState(Enum):
     MODIFIED = "M"      # Cache line is modified and dirty
     EXCLUSIVE = "E"     # Cache line is exclusive and clean
     SHARED = "S"        # Cache line is shared and clean
     INVALID = "I"       # Cache line is invalid
+    OWNED = "O"         # MOESI: dirty but shared, this node answers fetches
+    FORWARD = "F"       # MESIF: clean and shared, the one sharer that answers fetches
+
+class CacheProtocol(Enum):
+    MESI = "MESI"
+    MOESI = "MOESI"     # Dirty lines are shared as OWNED instead of downgraded to SHARED
+    MESIF = "MESIF"     # Only the FORWARD sharer answers fetches, the newest copy becomes FORWARD
+
+class CacheEntry(Link):
+    """
+    A single cache line. __slots__ keeps the per-line overhead to a handful of
+    pointers and lets hits update state in place instead of rebuilding tuples.
+    The line is also the eviction policy's list node, so recency order costs
+    two pointers per line rather than a second hash keyed by the same keys.
+    """
+    __slots__ = ('state', 'value', 'timestamp', 'size', 'expires_at', 'slot', 'codec', 'raw_size', 'version')
+
+    def __init__(self, state, value, timestamp, size, expires_at=None, codec=None, raw_size=None, version=0,
+                 key=None):
+        super().__init__(key)
+        self.state = state
+        self.value = value
+        self.timestamp = timestamp
+        self.size = size
+        self.expires_at = expires_at
+        # codec 'zlib' means value holds the compressed JSON encoding (size is
+        # the compressed length, raw_size the original one); None means plain
+        self.codec = codec
+        self.raw_size = raw_size if raw_size is not None else size
+        # Cluster-wide monotonic per key: every write stamps a newer version
+        self.version = version
+        # Position in CacheNode._slots, used for paginated listing and sampling
+        self.slot = -1
 
 class CacheNode:
-    def __init__(self, node_id, msg_client=None, capacity=100):
+    FETCH_MODES = ('sequential', 'hedged', 'parallel')
+    # replicated: any node may hold any key (MESI keeps copies coherent);
+    # partitioned: each key lives on one owner picked by a consistent-hash ring
+    MODES = ('replicated', 'partitioned')
+    # Hedge delay used until enough fetch latencies have been observed
+    DEFAULT_HEDGE_DELAY = 0.05
+    MIN_HEDGE_DELAY = 0.005
+    # Keys remembered as missing everywhere, and digest generations kept for deltas
+    NEGATIVE_CACHE_SIZE = 10000
+    DIGEST_HISTORY = 16
+    # Partitioned mode: keys whose proxied readers an owner remembers; past
+    # this the oldest records are dropped and their readers invalidated
+    READERS_MAX = 100000
+    # Warm-up pulls snapshot pages of this size and gives up after the timeout;
+    # snapshot files older than the max age are not trusted, and lines loaded
+    # from one expire after SNAPSHOT_TTL since invalidations sent while the node
+    # was down were missed (large ones are then revalidated by version)
+    WARMUP_PAGE = 200
+    WARMUP_TIMEOUT = 30.0
+    SNAPSHOT_MAX_AGE = 600
+    SNAPSHOT_TTL = 5.0
+    COMPRESS_LEVEL = 6
+    # Evicted/expired lines at least this large are kept (up to STALE_LINES of
+    # them) so a later miss can revalidate them by version instead of refetching.
+    # Their bytes count against capacity_bytes, capped at STALE_SHARE of it
+    # (STALE_MAX_BYTES when the cache has no byte bound)
+    REVALIDATE_MIN_BYTES = 1024
+    STALE_LINES = 256
+    STALE_SHARE = 0.1
+    STALE_MAX_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, node_id, msg_client=None, capacity=100, capacity_bytes=None,
+                 eviction_policy='lru', default_ttl=None, ttl_tick=1.0, protocol='MESI',
+                 fetch_mode='hedged', digest_interval=None, negative_ttl=None,
+                 warmup_keys=0, snapshot_path=None, snapshot_interval=60,
+                 compress_threshold=None, write_update=None, mode='replicated',
+                 vnodes=100, l1_capacity=1000, l1_ttl=1.0, prefix_index=False):
         self.node_id = node_id
         self.msg = msg_client
+        self.protocol = CacheProtocol(protocol.upper()) if isinstance(protocol, str) else protocol
+        # capacity bounds the number of lines, capacity_bytes the summed value size;
+        # either may be None to disable that bound
         self.capacity = capacity
-        self.cache = OrderedDict()
+        self.capacity_bytes = capacity_bytes
+        self.cache = {}
+        self.policy = make_policy(eviction_policy, capacity, entries=self.cache)
+        self.bytes_used = 0
+        # Running per-state line and byte counts, maintained on every transition
+        self.state_counts = {state: 0 for state in CacheState}
+        self.state_bytes = {state: 0 for state in CacheState}
+        # Dense key array so listings and samples never walk the whole dict
+        self._slots = []
+        # Key trie and tag index behind prefix/tag bulk invalidation. The trie
+        # more than doubles per-line memory, so it is only kept when prefix
+        # purges are frequent enough to need one (None = scan keys on purge)
+        self.prefixes = PrefixIndex() if prefix_index else None
+        self.tags = TagIndex()
+        # How misses query peers: 'sequential', 'hedged' (next peer after the p95
+        # fetch latency) or 'parallel' (all peers at once); first answer wins
+        if fetch_mode not in self.FETCH_MODES:
+            raise ValueError(f"Unknown fetch mode: {fetch_mode}")
+        self.fetch_mode = fetch_mode
+        self._fetch_latencies = deque(maxlen=256)
+        # Queues of client near-cache subscribers receiving invalidation events
+        self._subscribers = set()
+        # TTL in seconds applied to lines without an explicit one (None = never expire)
+        self.default_ttl = default_ttl
+        self.wheel = TimingWheel(tick=ttl_tick)
+        # Bloom digest of resident keys, pulled by peers every digest_interval
+        # seconds so misses only ask peers that may hold the key (None = off)
+        self.digest_interval = digest_interval
+        self.digest = CountingBloomFilter(*optimal_params(capacity or 100000)) if digest_interval else None
+        # A restarted node gets a new epoch, so peers never apply deltas to an old base
+        self.digest_epoch = uuid.uuid4().hex[:8]
+        self.digest_generation = 0
+        self._digest_history = deque(maxlen=self.DIGEST_HISTORY)
+        # peer -> (epoch, generation, BloomFilter) as last pulled from that peer
+        self.peer_digests = {}
+        # key -> expiry of a miss no peer could answer (negative_ttl None = off)
+        self.negative_ttl = negative_ttl
+        self._negative = OrderedDict()
+        # On start copy up to warmup_keys hot lines from a peer, or from the
+        # snapshot file saved every snapshot_interval seconds, before reporting ready
+        self.warmup_keys = warmup_keys
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.ready = not warmup_keys
+        # Keys written or invalidated while a warm-up runs; its copies of them are stale
+        self._warm_invalidated = None
+        # Values whose JSON encoding reaches this many bytes are stored zlib
+        # compressed and shipped to peers as is (None = never compress)
+        self.compress_threshold = compress_threshold
+        self.compressed_lines = 0
+        self.compressed_raw_bytes = 0
+        self.compressed_bytes = 0
+        # Lamport-style version clock (never behind wall-clock microseconds),
+        # advanced past every version seen in invalidations and fetches
+        self._clock = 0
+        self._stale = OrderedDict()
+        self.stale_bytes = 0
+        # Keys ('config') and prefixes ('flags:*') whose writes push the new
+        # value to current sharers instead of invalidating them
+        self.set_write_update(write_update or ())
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown cache mode: {mode}")
+        self.mode = mode
+        self.partitioned = mode == 'partitioned'
+        nodes = set(msg_client.peers) if msg_client else set()
+        self.ring = ConsistentHashRing(nodes | {node_id}, vnodes=vnodes)
+        # Small TTL-bounded copy of values read through other owners. The owner
+        # invalidates it on writes, so l1_ttl only bounds staleness when such an
+        # invalidation is lost
+        self.l1_capacity = l1_capacity
+        self.l1_ttl = l1_ttl
+        self._l1 = OrderedDict()
+        # Owner side: key -> nodes that proxied a read of it since its last write,
+        # and so may hold it in L1 or in a subscriber's near-cache
+        self._readers = OrderedDict()
         self._lock = asyncio.Lock()
         self.metrics = {
             'hits': 0,
             'misses': 0,
             'invalidations_sent': 0,
             'invalidations_received': 0,
-            'state_transitions': 0
+            'state_transitions': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'lazy_expirations': 0,
+            'subscriber_resets': 0,
+            'fetches_declined': 0,
+            'forward_fallbacks': 0,
+            'hedged_fetches': 0,
+            'negative_hits': 0,
+            'fetches_skipped': 0,
+            'warmed_keys': 0,
+            'bulk_invalidations_sent': 0,
+            'bulk_invalidations_received': 0,
+            'revalidations': 0,
+            'stale_invalidations': 0,
+            'updates_sent': 0,
+            'updates_applied': 0,
+            'proxied': 0,
+            'l1_hits': 0
         }
 
     async def start_background(self, app):
         app.loop.create_task(self._metrics_loop())
+        app.loop.create_task(self._expiry_loop())
+        if self.digest is not None:
+            app.loop.create_task(self._digest_loop())
+        if self.warmup_keys:
+            app.loop.create_task(self.warm_up())
+            if self.snapshot_path:
+                app.loop.create_task(self._snapshot_loop())
 
     async def _metrics_loop(self):
         """Periodically log cache metrics"""
@@ -33,140 +216,1319 @@ class CacheNode:
             await asyncio.sleep(30)
             print(f"[{self.node_id}] Cache metrics: {self.metrics}")
 
-    async def get(self, key):
-        """Read operation - implements MESI protocol"""
-        async with self._lock:
-            if key in self.cache:
-                state, value, timestamp = self.cache.pop(key)
-                # Move to end for LRU
-                self.cache[key] = (state, value, timestamp)
-                
-                # MESI state transitions for read
-                if state == CacheState.MODIFIED:
-                    # M -> M (no change needed)
-                    self.metrics['hits'] += 1
-                elif state == CacheState.EXCLUSIVE:
-                    # E -> S (become shared)
-                    self.cache[key] = (CacheState.SHARED, value, timestamp)
-                    self.metrics['state_transitions'] += 1
-                    self.metrics['hits'] += 1
-                elif state == CacheState.SHARED:
-                    # S -> S (no change needed)
-                    self.metrics['hits'] += 1
-                else:  # INVALID
-                    # I -> S (need to fetch from other nodes)
-                    await self._fetch_from_peers(key)
-                    self.metrics['misses'] += 1
-                    return None
-                
-                return value
-            else:
-                # Cache miss - need to fetch from peers
-                await self._fetch_from_peers(key)
-                self.metrics['misses'] += 1
+    async def _expiry_loop(self):
+        """Advance the timing wheel once per tick and drop expired lines"""
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            now = time.time()
+            expired = self.wheel.advance(now)
+            if not expired:
+                continue
+            async with self._lock:
+                for key in expired:
+                    entry = self.cache.get(key)
+                    if entry is not None and entry.expires_at is not None and entry.expires_at <= now:
+                        self._retire(key, entry)
+                        self._drop(key)
+                        self.metrics['expirations'] += 1
+
+    async def _digest_loop(self):
+        """Periodically pull the key digests of all peers"""
+        while True:
+            await asyncio.sleep(self.digest_interval)
+            await self.refresh_peer_digests()
+
+    async def _snapshot_loop(self):
+        """Periodically save the hot lines so a restart can warm up without peers"""
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.save_snapshot()
+            except OSError as e:
+                print(f"[{self.node_id}] Cache snapshot failed: {e}")
+
+    def _live_entry(self, key):
+        """Return the line for key, lazily dropping it if its TTL has passed"""
+        entry = self.cache.get(key)
+        if entry is None or entry.expires_at is None or entry.expires_at > time.time():
+            return entry
+        self._retire(key, entry)
+        self._drop(key)
+        self.metrics['expirations'] += 1
+        self.metrics['lazy_expirations'] += 1
+        return None
+
+    def _set_ttl(self, key, entry, ttl):
+        if ttl is None:
+            if entry.expires_at is not None:
+                entry.expires_at = None
+                self.wheel.cancel(key)
+            return
+        entry.expires_at = time.time() + ttl
+        self.wheel.schedule(key, entry.expires_at)
+
+    def ttl_remaining(self, key):
+        """Seconds until key expires, or None if it has no TTL"""
+        entry = self.cache.get(key)
+        if entry is None or entry.expires_at is None:
+            return None
+        return max(0.0, entry.expires_at - time.time())
+
+    async def get(self, key, forwarded=False, reader=None):
+        """
+        Read operation - implements MESI protocol. reader is the node a
+        partitioned-mode read was proxied for.
+        """
+        owner = self._remote_owner(key, forwarded)
+        if owner is not None:
+            return await self._proxy_get(owner, key)
+        async with self._lock:
+            self._note_readers([key], reader)
+            entry = self._live_entry(key)
+            if entry is not None and entry.state != CacheState.INVALID:
+                return self._read_hit(key, entry)
+            # Cache miss (or I -> S) - need to fetch from peers
+            self.metrics['misses'] += 1
+            if self.partitioned or self._negative_hit(key):
                 return None
+            # Only a miss every candidate peer confirmed is remembered, not a timeout
+            if await self._fetch_from_peers(key) is False:
+                self._remember_missing([key])
+            return None
+
+    async def mget(self, keys, forwarded=False, reader=None):
+        """Batch read - one lock acquisition and one combined peer fetch for all misses"""
+        local, remote = self._split_by_owner(keys, forwarded)
+        values = await self._proxy_mget(remote) if remote else {}
+        if not local:
+            return {key: values.get(key) for key in keys}
+        async with self._lock:
+            self._note_readers(local, reader)
+            misses = []
+            for key in local:
+                entry = self._live_entry(key)
+                if entry is not None and entry.state != CacheState.INVALID:
+                    values[key] = self._read_hit(key, entry)
+                elif key not in values:
+                    values[key] = None
+                    misses.append(key)
+            if misses:
+                self.metrics['misses'] += len(misses)
+                misses = [key for key in misses if not self.partitioned and not self._negative_hit(key)]
+            if misses:
+                _, absent = await self._fetch_many_from_peers(misses)
+                self._remember_missing(absent)
+            return {key: values.get(key) for key in keys}
+
+    def _read_hit(self, key, entry):
+        """Apply MESI read transitions to a valid line and return its value"""
+        self.policy.record_access(key)
+        if entry.state == CacheState.EXCLUSIVE:
+            # E -> S (become shared)
+            self._set_state(entry, CacheState.SHARED)
+            self.metrics['state_transitions'] += 1
+        # M, S, O and F reads need no change
+        self.metrics['hits'] += 1
+        return self._decode(entry)
 
-    async def put(self, key, value):
+    async def put(self, key, value, ttl=None, tags=None, forwarded=False):
         """Write operation - implements MESI protocol"""
+        owner = self._remote_owner(key, forwarded)
+        if owner is not None:
+            return await self._proxy_put(owner, key, value, ttl, tags)
         async with self._lock:
-            current_state = CacheState.INVALID
-            if key in self.cache:
-                current_state, _, _ = self.cache.pop(key)
-            
-            # MESI state transitions for write
-            if current_state == CacheState.MODIFIED:
-                # M -> M (update value)
-                self.cache[key] = (CacheState.MODIFIED, value, time.time())
-            elif current_state == CacheState.EXCLUSIVE:
-                # E -> M (become modified)
-                self.cache[key] = (CacheState.MODIFIED, value, time.time())
-                self.metrics['state_transitions'] += 1
-            elif current_state == CacheState.SHARED:
-                # S -> M (invalidate other copies first)
-                await self._invalidate_peers(key)
-                self.cache[key] = (CacheState.MODIFIED, value, time.time())
-                self.metrics['state_transitions'] += 1
-            else:  # INVALID
-                # I -> M (invalidate other copies first)
-                await self._invalidate_peers(key)
-                self.cache[key] = (CacheState.MODIFIED, value, time.time())
+            version = self._next_version()
+            shared = self._needs_invalidation(key)
+            update = shared and self.is_write_update(key)
+            if shared and not update:
+                # S/O/F/I -> M invalidate other copies first
+                await self._invalidate_peers(key, version)
+            self._negative.pop(key, None)
+            self._write_line(key, value, ttl, tags, version)
+            if update:
+                await self._push_updates([key])
+            self._evict_if_needed()
+            self._publish_invalidation([key])
+            readers = self._take_readers([key])
+        await self._fan_out_invalidation(readers, version)
+        return True
+
+    async def mput(self, items, ttl=None, tags=None, forwarded=False):
+        """Batch write - one lock acquisition and one invalidation message per peer"""
+        local, remote = self._split_by_owner(items, forwarded)
+        success = True
+        if remote:
+            success = await self._proxy_mput({
+                owner: {key: items[key] for key in keys} for owner, keys in remote.items()
+            }, ttl, tags)
+        if not local:
+            return success
+        items = {key: items[key] for key in local}
+        async with self._lock:
+            version = self._next_version()
+            shared = [key for key in items if self._needs_invalidation(key)]
+            updates = [key for key in shared if self.is_write_update(key)]
+            stale = [key for key in shared if not self.is_write_update(key)]
+            if stale:
+                await self._invalidate_peers_many(stale, version)
+            for key, value in items.items():
+                self._negative.pop(key, None)
+                self._write_line(key, value, ttl, tags, version)
+            if updates:
+                await self._push_updates(updates)
+            self._evict_if_needed()
+            self._publish_invalidation(list(items))
+            readers = self._take_readers(items)
+        await self._fan_out_invalidation(readers, version)
+        return success
+
+    async def mdelete(self, keys, forwarded=False):
+        """Batch delete - drop lines locally and invalidate every peer copy"""
+        keys, remote = self._split_by_owner(keys, forwarded)
+        deleted = await self._proxy_mdelete(remote) if remote else 0
+        if not keys:
+            return deleted
+        async with self._lock:
+            self._note_changed(keys)
+            for key in keys:
+                if key in self.cache:
+                    self._drop(key)
+                    deleted += 1
+            version = self._next_version()
+            if not self.partitioned:
+                await self._invalidate_peers_many(list(keys), version)
+            self._publish_invalidation(list(keys))
+            readers = self._take_readers(keys)
+        await self._fan_out_invalidation(readers, version)
+        return deleted
+
+    def _remote_owner(self, key, forwarded=False):
+        """The node to proxy key to in partitioned mode, or None to serve it here"""
+        if not self.partitioned or forwarded or not self.msg:
+            return None
+        owner = self.ring.owner(key)
+        return owner if owner != self.node_id else None
+
+    def _split_by_owner(self, keys, forwarded=False):
+        """Split keys into those served here and {owner: keys} to proxy"""
+        local = []
+        remote = {}
+        for key in keys:
+            owner = self._remote_owner(key, forwarded)
+            if owner is None:
+                local.append(key)
+            else:
+                remote.setdefault(owner, []).append(key)
+        return local, remote
+
+    def _l1_get(self, key):
+        item = self._l1.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.time():
+            del self._l1[key]
+            return None
+        self._l1.move_to_end(key)
+        self.metrics['l1_hits'] += 1
+        return item[0]
+
+    def _l1_put(self, key, value):
+        if value is None or not self.l1_capacity:
+            return
+        self._l1[key] = (value, time.time() + self.l1_ttl)
+        self._l1.move_to_end(key)
+        while len(self._l1) > self.l1_capacity:
+            self._l1.popitem(last=False)
+
+    async def _proxy_get(self, owner, key):
+        value = self._l1_get(key)
+        if value is not None:
+            return value
+        self.metrics['proxied'] += 1
+        response = await self.msg.get(
+            owner, f'/cache/get?key={quote(key, safe="")}&forwarded=1&node={quote(self.node_id, safe="")}')
+        value = response.get('value') if response else None
+        self._l1_put(key, value)
+        return value
+
+    async def _proxy_mget(self, remote):
+        values = {}
+        wanted = {}
+        for owner, keys in remote.items():
+            for key in keys:
+                value = self._l1_get(key)
+                if value is not None:
+                    values[key] = value
+                else:
+                    wanted.setdefault(owner, []).append(key)
+        owners = list(wanted)
+        self.metrics['proxied'] += len(owners)
+        responses = await asyncio.gather(*(
+            self.msg.post(owner, '/cache/mget', {'keys': wanted[owner], 'forwarded': True, 'node': self.node_id})
+            for owner in owners
+        ))
+        for response in responses:
+            for key, value in ((response or {}).get('values') or {}).items():
+                values[key] = value
+                self._l1_put(key, value)
+        return values
+
+    async def _proxy_put(self, owner, key, value, ttl, tags):
+        self._l1.pop(key, None)
+        self.metrics['proxied'] += 1
+        body = {'key': key, 'value': value, 'ttl': ttl, 'tags': tags, 'forwarded': True}
+        response = await self.msg.post(owner, '/cache/put', body)
+        # Near-caches attached here see the write now, the owner's fan-out follows
+        self._publish_invalidation([key])
+        return bool(response and response.get('success'))
+
+    async def _proxy_mput(self, items_by_owner, ttl, tags):
+        owners = list(items_by_owner)
+        for items in items_by_owner.values():
+            for key in items:
+                self._l1.pop(key, None)
+        self.metrics['proxied'] += len(owners)
+        responses = await asyncio.gather(*(
+            self.msg.post(owner, '/cache/mput', {'items': items_by_owner[owner], 'ttl': ttl,
+                                                 'tags': tags, 'forwarded': True})
+            for owner in owners
+        ))
+        self._publish_invalidation([key for items in items_by_owner.values() for key in items])
+        return all(bool(r and r.get('success')) for r in responses)
+
+    async def _proxy_mdelete(self, remote):
+        owners = list(remote)
+        for keys in remote.values():
+            for key in keys:
+                self._l1.pop(key, None)
+        self.metrics['proxied'] += len(owners)
+        responses = await asyncio.gather(*(
+            self.msg.post(owner, '/cache/mdelete', {'keys': remote[owner], 'forwarded': True}) for owner in owners
+        ))
+        self._publish_invalidation([key for keys in remote.values() for key in keys])
+        return sum((r or {}).get('deleted', 0) for r in responses)
+
+    def _needs_invalidation(self, key) -> bool:
+        """Only M and E lines are known to be the sole copy"""
+        if self.partitioned:
+            # The owner holds the only copy; other nodes keep at most a TTL-bounded
+            # L1, and writes are fanned out to those that read through it afterwards
+            return False
+        entry = self.cache.get(key)
+        return entry is None or entry.state not in (CacheState.MODIFIED, CacheState.EXCLUSIVE)
+
+    def set_write_update(self, patterns):
+        """Replace the write-update keys and prefixes (a trailing '*' marks a prefix)"""
+        patterns = list(patterns)
+        self._update_keys = {p for p in patterns if not p.endswith('*')}
+        self._update_prefixes = tuple(p[:-1] for p in patterns if p.endswith('*'))
+
+    def is_write_update(self, key) -> bool:
+        return key in self._update_keys or (bool(self._update_prefixes) and key.startswith(self._update_prefixes))
+
+    async def _push_updates(self, keys):
+        """
+        Write-update (Dragon-style): send the freshly written lines to every
+        peer, which applies them only where it already holds a copy. If anyone
+        did, the writer keeps sharing the line (O under MOESI, F under MESIF,
+        else S) instead of holding it MODIFIED.
+        """
+        if not self.msg:
+            return
+        lines = {key: self._wire_line(key, self.cache[key]) for key in keys}
+        body = {'lines': lines, 'node': self.node_id}
+        
+        async def push(peer):
+            try:
+                response = await self.msg.post(peer, '/cache/update', body)
+            except Exception:
+                return []
+            self.metrics['updates_sent'] += 1
+            return response.get('applied', []) if response else []
+        
+        results = await asyncio.gather(*(push(peer) for peer in self._peers()))
+        shared = set().union(*results) if results else set()
+        state = {
+            CacheProtocol.MOESI: CacheState.OWNED,
+            CacheProtocol.MESIF: CacheState.FORWARD
+        }.get(self.protocol, CacheState.SHARED)
+        for key in shared:
+            entry = self.cache.get(key)
+            if entry is not None and entry.state == CacheState.MODIFIED:
+                self._set_state(entry, state)
                 self.metrics['state_transitions'] += 1
-            
-            # Apply LRU eviction if needed
-            if len(self.cache) > self.capacity:
-                self.cache.popitem(last=False)
-            
+
+    async def handle_update(self, lines, sender=None):
+        """Apply pushed writes to the lines we hold; returns the keys applied"""
+        async with self._lock:
+            # Like an invalidation: the sender holds the keys now, even where we don't
+            self._note_peer_write(sender, list(lines))
+            applied = []
+            for key, line in lines.items():
+                self._observe_version(line.get('version'))
+                self._note_changed([key])
+                self._negative.pop(key, None)
+                self._l1.pop(key, None)
+                entry = self._live_entry(key)
+                if entry is None or entry.version > line.get('version', 0):
+                    continue
+                # Whatever we held, the writer now has the authoritative copy
+                if entry.state != CacheState.SHARED:
+                    self.metrics['state_transitions'] += 1
+                self._install_fetched(key, line, CacheState.SHARED)
+                applied.append(key)
+            self.metrics['updates_applied'] += len(applied)
+            # Near-caches hold the old value
+            self._publish_invalidation(list(lines))
+            return {'applied': applied}
+
+    def _next_version(self):
+        self._clock = max(self._clock + 1, int(time.time() * 1_000_000))
+        return self._clock
+
+    def _observe_version(self, version):
+        if version:
+            self._clock = max(self._clock, version)
+
+    def _write_line(self, key, value, ttl, tags=None, version=None):
+        """Apply MESI write transitions once other copies are invalidated"""
+        entry = self.cache.get(key)
+        current_state = entry.state if entry is not None else CacheState.INVALID
+        # M -> M only updates the value; E, S and I all move to M
+        if current_state != CacheState.MODIFIED:
+            self.metrics['state_transitions'] += 1
+        self._note_changed([key])
+        version = version if version is not None else self._next_version()
+        entry = self._store(key, CacheState.MODIFIED, value, time.time(), version=version)
+        # A write always restarts the line's TTL and replaces its tags
+        self._set_ttl(key, entry, ttl if ttl is not None else self.default_ttl)
+        self.tags.set(key, tags)
+
+    def _encode(self, value):
+        """
+        Stored form of a value: (value, codec, size, raw_size). Size is the
+        JSON encoding's length; large values are compressed when that helps.
+        """
+        try:
+            raw = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        except (TypeError, ValueError):
+            size = len(str(value))
+            return value, None, size, size
+        if self.compress_threshold is not None and len(raw) >= self.compress_threshold:
+            packed = zlib.compress(raw, self.COMPRESS_LEVEL)
+            if len(packed) < len(raw):
+                return packed, 'zlib', len(packed), len(raw)
+        return value, None, len(raw), len(raw)
+
+    @staticmethod
+    def _decode(entry):
+        """The value of a line as the client stored it"""
+        if entry.codec == 'zlib':
+            return json.loads(zlib.decompress(entry.value))
+        return entry.value
+
+    def _wire_line(self, key, entry):
+        """A line as sent to peers; compressed values travel compressed (base64)"""
+        line = {'value': entry.value, 'ttl': self.ttl_remaining(key), 'version': entry.version}
+        if entry.codec is not None:
+            line['value'] = base64.b64encode(entry.value).decode('ascii')
+            line['codec'] = entry.codec
+            line['raw_size'] = entry.raw_size
+        tags = self.tags.tags_of(key)
+        if tags:
+            line['tags'] = tags
+        return line
+
+    def _store(self, key, state, value, timestamp, codec=None, raw_size=None, version=0):
+        """
+        Insert a line or update it in place, keeping policy and byte accounting
+        in sync. With a codec the value is already in stored (compressed) form.
+        """
+        if codec is None:
+            value, codec, size, raw_size = self._encode(value)
+        else:
+            size = len(value)
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.bytes_used += size - entry.size
+            self._uncount(entry)
+            entry.state = state
+            entry.value = value
+            entry.timestamp = timestamp
+            entry.size = size
+            entry.codec = codec
+            entry.raw_size = raw_size if raw_size is not None else size
+            entry.version = version
+            self.policy.record_access(key)
+        else:
+            entry = self.cache[key] = CacheEntry(state, value, timestamp, size, codec=codec,
+                                                 raw_size=raw_size, version=version, key=key)
+            self._unretire(key)
+            entry.slot = len(self._slots)
+            self._slots.append(key)
+            self.bytes_used += size
+            self.policy.record_insert(key)
+            if self.prefixes is not None:
+                self.prefixes.add(key)
+            if self.digest is not None:
+                self.digest.add(key)
+        self._count(entry)
+        return entry
+
+    def _count(self, entry):
+        self.state_counts[entry.state] += 1
+        self.state_bytes[entry.state] += entry.size
+        if entry.codec is not None:
+            self.compressed_lines += 1
+            self.compressed_raw_bytes += entry.raw_size
+            self.compressed_bytes += entry.size
+
+    def _uncount(self, entry):
+        self.state_counts[entry.state] -= 1
+        self.state_bytes[entry.state] -= entry.size
+        if entry.codec is not None:
+            self.compressed_lines -= 1
+            self.compressed_raw_bytes -= entry.raw_size
+            self.compressed_bytes -= entry.size
+
+    def _set_state(self, entry, state):
+        """Change a line's state, keeping the per-state counters exact"""
+        self._uncount(entry)
+        entry.state = state
+        self._count(entry)
+
+    def _forget(self, key):
+        """Release the bookkeeping (size, TTL) held for a removed line"""
+        entry = self.cache.pop(key, None)
+        if entry is None:
+            return
+        self.bytes_used -= entry.size
+        self._uncount(entry)
+        # Swap-remove from the slot array: move the last key into the hole
+        last_key = self._slots.pop()
+        if last_key != key:
+            self._slots[entry.slot] = last_key
+            self.cache[last_key].slot = entry.slot
+        if entry.expires_at is not None:
+            self.wheel.cancel(key)
+        if self.prefixes is not None:
+            self.prefixes.remove(key)
+        self.tags.remove(key)
+        if self.digest is not None:
+            self.digest.remove(key)
+
+    def _drop(self, key):
+        """Remove a line without going through the eviction policy"""
+        # Unlink first: the policy finds the line's links through self.cache
+        self.policy.remove(key)
+        self._forget(key)
+
+    def _over_capacity(self) -> bool:
+        if self.capacity is not None and len(self.cache) > self.capacity:
             return True
+        return self.capacity_bytes is not None and self.bytes_used + self.stale_bytes > self.capacity_bytes
+
+    def _evict_if_needed(self):
+        """Evict policy victims until both entry and byte bounds hold"""
+        while self.cache and self._over_capacity():
+            key = self.policy.victim()
+            if key is None:
+                break
+            self._retire(key, self.cache.get(key))
+            self._forget(key)
+            self.metrics['evictions'] += 1
+
+    def _retire(self, key, entry):
+        """Remember a large line leaving the cache so a later miss can revalidate it"""
+        if entry is None or entry.size < self.REVALIDATE_MIN_BYTES or not entry.version:
+            return
+        budget = self.STALE_MAX_BYTES if self.capacity_bytes is None else self.capacity_bytes * self.STALE_SHARE
+        if entry.size > budget:
+            return
+        self._unretire(key)
+        self._stale[key] = (entry, self.tags.tags_of(key))
+        self.stale_bytes += entry.size
+        while len(self._stale) > self.STALE_LINES or self.stale_bytes > budget:
+            _, (old, _) = self._stale.popitem(last=False)
+            self.stale_bytes -= old.size
+
+    def _unretire(self, key):
+        """Take back a retired line, returning (entry, tags) or None"""
+        stale = self._stale.pop(key, None)
+        if stale is not None:
+            self.stale_bytes -= stale[0].size
+        return stale
+
+    def _peers(self):
+        """Peers to talk to, never including this node itself"""
+        return [p for p in self.msg.peers if p != self.node_id]
+
+    def _negative_hit(self, key) -> bool:
+        """True if key recently missed on every peer and that is still believed"""
+        expires_at = self._negative.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= time.time():
+            del self._negative[key]
+            return False
+        self.metrics['negative_hits'] += 1
+        return True
+
+    def _remember_missing(self, keys):
+        if not self.negative_ttl or not self.msg:
+            return
+        expires_at = time.time() + self.negative_ttl
+        for key in keys:
+            self._negative[key] = expires_at
+            self._negative.move_to_end(key)
+        while len(self._negative) > self.NEGATIVE_CACHE_SIZE:
+            self._negative.popitem(last=False)
+
+    def _candidate_peers(self, key):
+        """Peers that may hold key: their digest says maybe, or we have no digest for them"""
+        candidates = []
+        for peer in self._peers():
+            known = self.peer_digests.get(peer)
+            if known is None or key in known[2]:
+                candidates.append(peer)
+        return candidates
+
+    def _install_fetched(self, key, line, state=None, stale=None):
+        """
+        Install a line received from a peer. A not_modified answer confirms
+        that our retired copy (stale) still has the peer's version.
+        """
+        # Mark as shared since we got it from another node; under MESIF the
+        # newest copy takes over forwarding from the responder
+        if state is None:
+            state = CacheState.FORWARD if self.protocol == CacheProtocol.MESIF else CacheState.SHARED
+        version = line.get('version', 0)
+        self._observe_version(version)
+        tags = line.get('tags')
+        if line.get('not_modified'):
+            old, tags = stale
+            entry = self._store(key, state, old.value, time.time(), old.codec, old.raw_size, version)
+        elif line.get('codec') is not None:
+            # Keep the peer's compressed bytes as they are instead of recompressing
+            entry = self._store(key, state, base64.b64decode(line['value']), time.time(),
+                                line['codec'], line.get('raw_size'), version)
+        else:
+            entry = self._store(key, state, line['value'], time.time(), version=version)
+        # Never outlive the owner's TTL; the default TTL bounds staleness
+        ttls = [t for t in (line.get('ttl'), self.default_ttl) if t is not None]
+        self._set_ttl(key, entry, min(ttls) if ttls else None)
+        # Copies keep their tags so tag purges reach them too
+        self.tags.set(key, tags)
 
     async def _fetch_from_peers(self, key):
-        """Fetch data from other cache nodes"""
+        """
+        Fetch data from other cache nodes. Returns True if a peer had it, False
+        if every candidate peer answered that it does not, and None if some
+        peer gave no answer (it was slow or down), so nothing is known.
+        """
+        if not self.msg:
+            return False
+        
+        peers = self._candidate_peers(key)
+        self.metrics['fetches_skipped'] += len(self._peers()) - len(peers)
+        path = f'/cache/fetch?key={quote(key, safe="")}'
+        stale = self._unretire(key)
+        if stale is not None:
+            # Only ask for the body if the peer's version differs from ours
+            path += f'&if_version={stale[0].version}'
+        
+        def accept(r):
+            return bool(r) and ('not_modified' in r or ('value' in r and r['value'] is not None))
+        
+        replies = []
+        response = await self._race_peers(lambda peer: self.msg.get(peer, path), accept, peers, replies)
+        if response is None and any(r and r.get('declined') for r in replies):
+            # A MESIF sharer holds the key but the FORWARD holder may have
+            # evicted or dropped its copy: ask again, letting any holder answer
+            replies = []
+            response = await self._race_peers(lambda peer: self.msg.get(peer, path + '&any=1'), accept, peers,
+                                              replies)
+            if response is not None:
+                self.metrics['forward_fallbacks'] += 1
+        if response is None:
+            answered = len(replies) == len(peers) and all(r and 'value' in r for r in replies)
+            return False if answered else None
+        if response.get('not_modified'):
+            self.metrics['revalidations'] += 1
+        self._install_fetched(key, response, stale=stale)
+        self._evict_if_needed()
+        return True
+
+    def _hedge_delay(self):
+        """p95 of recent successful fetch latencies"""
+        if len(self._fetch_latencies) < 20:
+            return self.DEFAULT_HEDGE_DELAY
+        ordered = sorted(self._fetch_latencies)
+        return max(self.MIN_HEDGE_DELAY, ordered[int(len(ordered) * 0.95) - 1])
+
+    async def _race_peers(self, call, accept, peers=None, replies=None):
+        """
+        Ask peers (all of them by default) for something and return the first
+        accepted response. Depending on fetch_mode peers are asked one after
+        another, all at once, or hedged: the next peer is asked once the current
+        ones are slower than the p95 latency. Requests still in flight are
+        cancelled once one wins. Responses that were not accepted are appended
+        to replies (None for a failed request).
+        """
+        peers = iter(self._peers() if peers is None else peers)
+        started = {}
+        
+        def launch():
+            peer = next(peers, None)
+            if peer is None:
+                return False
+            task = asyncio.ensure_future(call(peer))
+            started[task] = time.monotonic()
+            return True
+        
+        if self.fetch_mode == 'parallel':
+            while launch():
+                pass
+        else:
+            launch()
+        pending = set(started)
+        exhausted = False
+        try:
+            while pending:
+                delay = self._hedge_delay() if self.fetch_mode == 'hedged' and not exhausted else None
+                done, pending = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Everyone in flight is slower than p95: hedge with the next peer
+                    if launch():
+                        self.metrics['hedged_fetches'] += 1
+                        pending = set(t for t in started if not t.done())
+                    else:
+                        exhausted = True
+                    continue
+                for task in done:
+                    try:
+                        response = task.result()
+                    except Exception:
+                        response = None
+                    if accept(response):
+                        self._fetch_latencies.append(time.monotonic() - started[task])
+                        return response
+                    if replies is not None:
+                        replies.append(response)
+                # A peer answered without the data: move on to the next one now
+                if self.fetch_mode != 'parallel' and launch():
+                    pending = set(t for t in started if not t.done())
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _keys_for_peer(self, peer, keys):
+        """The subset of keys that peer's digest says it may hold"""
+        known = self.peer_digests.get(peer)
+        if known is None:
+            return list(keys)
+        wanted = [key for key in keys if key in known[2]]
+        self.metrics['fetches_skipped'] += len(keys) - len(wanted)
+        return wanted
+
+    async def _fetch_many_from_peers(self, keys):
+        """
+        Fetch several keys with one request per peer, asking only for what is
+        still missing. Returns (keys a peer had, keys every candidate peer
+        answered it does not have); keys in neither got no answer from some peer.
+        """
+        if not self.msg:
+            return set(), []
+        
+        installed, unanswered, declined = await self._fetch_many_round(keys)
+        # Keys a MESIF sharer declined may have lost their FORWARD copy
+        missing = [key for key in keys if key in declined and key not in installed]
+        if missing:
+            found, retried, _ = await self._fetch_many_round(missing, any_holder=True)
+            self.metrics['forward_fallbacks'] += len(found)
+            installed |= found
+            unanswered = (unanswered - set(missing)) | retried
+        self._evict_if_needed()
+        return installed, [key for key in keys if key not in installed and key not in unanswered]
+
+    async def _fetch_many_round(self, keys, any_holder=False):
+        """
+        One pass over the peers for keys; returns (keys installed, keys some
+        peer gave no answer for, keys a MESIF sharer declined to serve)
+        """
+        installed = set()
+        unanswered = set()
+        declined = set()
+        if self.fetch_mode == 'sequential':
+            remaining = list(keys)
+            for peer in self._peers():
+                if not remaining:
+                    break
+                wanted = self._keys_for_peer(peer, remaining)
+                if not wanted:
+                    continue
+                lines = await self._mfetch_from(peer, wanted, any_holder)
+                if lines is None:
+                    unanswered.update(wanted)
+                    continue
+                declined.update(key for key, line in lines.items() if line.get('declined'))
+                for key, line in lines.items():
+                    if line.get('value') is not None:
+                        self._install_fetched(key, line)
+                        installed.add(key)
+                remaining = [k for k in remaining if k not in installed]
+        else:
+            # One combined request to every peer concurrently, first copy of each key wins
+            requests = [(peer, self._keys_for_peer(peer, keys)) for peer in self._peers()]
+            requests = [(peer, wanted) for peer, wanted in requests if wanted]
+            results = await asyncio.gather(*(self._mfetch_from(peer, wanted, any_holder)
+                                             for peer, wanted in requests))
+            for (_, wanted), lines in zip(requests, results):
+                if lines is None:
+                    unanswered.update(wanted)
+                    continue
+                declined.update(key for key, line in lines.items() if line.get('declined'))
+                for key, line in lines.items():
+                    if key not in installed and line.get('value') is not None:
+                        self._install_fetched(key, line)
+                        installed.add(key)
+        return installed, unanswered - installed, declined
+
+    async def _mfetch_from(self, peer, keys, any_holder=False):
+        """Ask one peer for several keys; returns its lines, or None if it gave no answer"""
+        body = {'keys': keys, 'any': True} if any_holder else {'keys': keys}
+        try:
+            response = await self.msg.post(peer, '/cache/mfetch', body)
+        except Exception:
+            return None
+        lines = response.get('values') if response else None
+        if not isinstance(lines, dict):
+            return None
+        return lines
+
+    async def _invalidate_peers(self, key, version=None):
+        """Send invalidation messages to all peers"""
         if not self.msg:
             return
         
-        for peer in self.msg.peers:
+        body = {'key': key, 'node': self.node_id, 'version': version}
+        for peer in self._peers():
             try:
-                response = await self.msg.get(peer, f'/cache/fetch?key={key}')
-                if response and 'value' in response and response['value'] is not None:
-                    # Mark as shared since we got it from another node
-                    self.cache[key] = (CacheState.SHARED, response['value'], time.time())
-                    break
+                await self.msg.post(peer, '/cache/invalidate', body)
+                self.metrics['invalidations_sent'] += 1
             except Exception:
                 continue
 
-    async def _invalidate_peers(self, key):
-        """Send invalidation messages to all peers"""
-        if not self.msg:
+    async def _invalidate_peers_many(self, keys, version=None):
+        """Send one combined invalidation message per peer"""
+        if not self.msg or not keys:
             return
         
-        for peer in self.msg.peers:
+        body = {'keys': keys, 'node': self.node_id, 'version': version}
+        for peer in self._peers():
             try:
-                await self.msg.post(peer, '/cache/invalidate', {'key': key})
+                await self.msg.post(peer, '/cache/minvalidate', body)
                 self.metrics['invalidations_sent'] += 1
             except Exception:
                 continue
 
-    async def handle_invalidate(self, key):
+    def _note_readers(self, keys, reader):
+        """Owner side: remember that reader proxied a read of keys"""
+        if not reader or reader == self.node_id:
+            return
+        for key in keys:
+            nodes = self._readers.get(key)
+            if nodes is None:
+                nodes = self._readers[key] = set()
+            else:
+                self._readers.move_to_end(key)
+            nodes.add(reader)
+        if len(self._readers) > self.READERS_MAX:
+            # A forgotten reader must not keep a copy no later write would reach
+            dropped = {}
+            while len(self._readers) > self.READERS_MAX * 9 // 10:
+                key, nodes = self._readers.popitem(last=False)
+                for node in nodes:
+                    dropped.setdefault(node, []).append(key)
+            asyncio.ensure_future(self._fan_out_invalidation(dropped, None))
+
+    def _take_readers(self, keys):
+        """{node: keys} that proxied reads of keys, to invalidate after writing them"""
+        targets = {}
+        for key in keys:
+            for node in self._readers.pop(key, ()):
+                targets.setdefault(node, []).append(key)
+        return targets
+
+    async def _fan_out_invalidation(self, targets, version):
+        """
+        Partitioned mode: after the owner applied a write, tell the nodes that
+        read the keys through it ({node: keys}) so their L1 copies and
+        near-cache subscribers drop them. Nodes that never read a key get
+        nothing. Sent outside the lock, so two owners fanning out to each
+        other never wait on one another.
+        """
+        if not self.msg or not targets:
+            return
+        
+        async def send(peer, keys):
+            try:
+                await self.msg.post(peer, '/cache/minvalidate',
+                                    {'keys': keys, 'node': self.node_id, 'version': version})
+                self.metrics['invalidations_sent'] += 1
+            except Exception:
+                pass
+        
+        await asyncio.gather(*(send(peer, keys) for peer, keys in targets.items()))
+
+    def subscribe(self, maxsize=1024) -> asyncio.Queue:
+        """Register a client near-cache; it receives every key invalidated on this node"""
+        queue = asyncio.Queue(maxsize=maxsize)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def _publish_invalidation(self, keys):
+        """Push invalidated keys to subscribers"""
+        if keys:
+            self._publish({'type': 'invalidate', 'keys': keys})
+
+    def _publish(self, event):
+        """Push an event to subscribers; a subscriber that fell behind gets a reset"""
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._reset_subscriber(queue)
+
+    def _reset_subscriber(self, queue):
+        # The client can no longer trust any cached key, so tell it to drop everything
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait({'type': 'reset'})
+        self.metrics['subscriber_resets'] += 1
+
+    def _note_peer_write(self, sender, keys):
+        """
+        An invalidation means the sender is about to hold the keys; mark them in
+        its digest now instead of missing it until the next digest pull
+        """
+        known = self.peer_digests.get(sender)
+        if known is not None:
+            for key in keys:
+                known[2].add(key)
+
+    def _invalidate_line(self, key, version):
+        """Drop our copy unless it is already newer than the invalidating write"""
+        self._unretire(key)
+        entry = self.cache.get(key)
+        if entry is None:
+            return
+        if version is not None and entry.version > version:
+            # A delayed invalidation for a write we have already seen past
+            self.metrics['stale_invalidations'] += 1
+            return
+        self._drop(key)
+        self.metrics['invalidations_received'] += 1
+        # State transition: any state -> I
+        self.metrics['state_transitions'] += 1
+
+    async def handle_invalidate(self, key, sender=None, version=None):
         """Handle invalidation request from other nodes"""
         async with self._lock:
-            if key in self.cache:
-                state, value, timestamp = self.cache.pop(key)
-                self.metrics['invalidations_received'] += 1
-                # State transition: any state -> I
+            self._observe_version(version)
+            self._note_peer_write(sender, [key])
+            self._note_changed([key])
+            # Client near-caches may hold the key even after this node evicted it
+            self._publish_invalidation([key])
+            # Someone just wrote the key, so it no longer misses everywhere
+            self._negative.pop(key, None)
+            self._l1.pop(key, None)
+            self._invalidate_line(key, version)
+
+    async def handle_minvalidate(self, keys, sender=None, version=None):
+        """Handle a combined invalidation request from other nodes"""
+        async with self._lock:
+            self._observe_version(version)
+            self._note_peer_write(sender, keys)
+            self._note_changed(keys)
+            self._publish_invalidation(list(keys))
+            for key in keys:
+                self._negative.pop(key, None)
+                self._l1.pop(key, None)
+                self._invalidate_line(key, version)
+
+    def _matching_keys(self, prefix=None, tags=None):
+        if not prefix:
+            keys = set()
+        elif self.prefixes is not None:
+            keys = set(self.prefixes.keys_with_prefix(prefix))
+        else:
+            keys = {key for key in self.cache if key.startswith(prefix)}
+        if tags:
+            keys |= self.tags.keys_with_tags(tags)
+        return keys
+
+    def _purge_local(self, prefix, tags):
+        """Drop every line matching the prefix or any tag in one pass"""
+        keys = self._matching_keys(prefix, tags)
+        self._note_changed(keys)
+        for key in keys:
+            self._drop(key)
+        if tags:
+            self._l1.clear()
+        else:
+            for key in [k for k in self._l1 if k.startswith(prefix)]:
+                del self._l1[key]
+        if tags:
+            # Near-caches may hold tagged keys this node has already evicted,
+            # and they do not know tags, so they have to start over
+            for queue in self._subscribers:
+                self._reset_subscriber(queue)
+        else:
+            self._publish({'type': 'invalidate_prefix', 'prefix': prefix})
+        return len(keys)
+
+    async def purge(self, prefix=None, tags=None):
+        """
+        Invalidate every key starting with prefix or carrying one of tags,
+        here and on all peers with a single message per peer. Returns the
+        number of lines dropped locally.
+        """
+        tags = list(tags or ())
+        if not prefix and not tags:
+            return 0
+        async with self._lock:
+            removed = self._purge_local(prefix, tags)
+            if self.msg:
+                body = {'prefix': prefix, 'tags': tags, 'node': self.node_id}
+                for peer in self._peers():
+                    try:
+                        await self.msg.post(peer, '/cache/invalidate_bulk', body)
+                        self.metrics['bulk_invalidations_sent'] += 1
+                    except Exception:
+                        continue
+            return removed
+
+    async def handle_invalidate_bulk(self, prefix=None, tags=None, sender=None):
+        """Handle a prefix/tag invalidation from another node"""
+        async with self._lock:
+            removed = self._purge_local(prefix, list(tags or ()))
+            self.metrics['bulk_invalidations_received'] += 1
+            self.metrics['invalidations_received'] += removed
+            self.metrics['state_transitions'] += removed
+            return removed
+
+    async def handle_fetch(self, key, if_version=None, any_holder=False):
+        """
+        Handle fetch request from other nodes. With if_version the value is
+        only sent if our version differs; otherwise the answer is not_modified.
+        any_holder makes MESIF sharers answer too (no FORWARD holder did).
+        """
+        async with self._lock:
+            line = self._serve_fetch(key, if_version, any_holder)
+            return line if line is not None else {'value': None}
+
+    async def handle_mfetch(self, keys, any_holder=False):
+        """Handle a combined fetch request; only keys held here (or declined) are returned"""
+        async with self._lock:
+            values = {}
+            for key in keys:
+                line = self._serve_fetch(key, any_holder=any_holder)
+                if line is not None:
+                    values[key] = line
+            return {'values': values}
+
+    def _serve_fetch(self, key, if_version=None, any_holder=False):
+        """Downgrade a line that a peer is about to share and describe it"""
+        entry = self._live_entry(key)
+        if entry is None:
+            return None
+        state = entry.state
+        if self.protocol == CacheProtocol.MESIF and state == CacheState.SHARED and not any_holder:
+            # Plain sharers stay silent; the FORWARD holder answers. Saying so
+            # lets the requester retry with any_holder if no FORWARD copy is left
+            self.metrics['fetches_declined'] += 1
+            return {'value': None, 'declined': True}
+        self.policy.record_access(key)
+        
+        # State transition based on current state
+        if state == CacheState.MODIFIED and self.protocol == CacheProtocol.MOESI:
+            # M -> O (share the dirty line, keep answering fetches)
+            self._set_state(entry, CacheState.OWNED)
+            self.metrics['state_transitions'] += 1
+        elif state == CacheState.MODIFIED:
+            # M -> S (downgrade to shared)
+            self._set_state(entry, CacheState.SHARED)
+            self.metrics['state_transitions'] += 1
+        elif state == CacheState.FORWARD:
+            # F -> S (the requester becomes the forwarder)
+            self._set_state(entry, CacheState.SHARED)
+            self.metrics['state_transitions'] += 1
+        elif state == CacheState.EXCLUSIVE:
+            # E -> S (become shared)
+            self._set_state(entry, CacheState.SHARED)
+            self.metrics['state_transitions'] += 1
+        
+        if if_version is not None and entry.version == if_version:
+            return {'not_modified': True, 'version': entry.version, 'state': state.value,
+                    'ttl': self.ttl_remaining(key)}
+        line = self._wire_line(key, entry)
+        line['state'] = state.value
+        return line
+
+    def _serve_snapshot(self, offset, limit):
+        """
+        Clean lines from the hot end of the eviction order, for a warming peer.
+        Dirty (M/O) lines stay with their owner; E lines are downgraded to S
+        because the warming node is about to share them.
+        """
+        hot = self.policy.hot_keys(offset + limit)[offset:]
+        lines = []
+        for key in hot:
+            entry = self._live_entry(key)
+            if entry is None or entry.state not in (CacheState.SHARED, CacheState.EXCLUSIVE, CacheState.FORWARD):
+                continue
+            if entry.state == CacheState.EXCLUSIVE:
+                self._set_state(entry, CacheState.SHARED)
                 self.metrics['state_transitions'] += 1
+            lines.append(dict(self._wire_line(key, entry), key=key))
+        return {'lines': lines, 'more': offset + limit < len(self.cache)}
 
-    async def handle_fetch(self, key):
-        """Handle fetch request from other nodes"""
-        async with self._lock:
-            if key in self.cache:
-                state, value, timestamp = self.cache.pop(key)
-                # Move to end for LRU
-                self.cache[key] = (state, value, timestamp)
-                
-                # State transition based on current state
-                if state == CacheState.MODIFIED:
-                    # M -> S (downgrade to shared)
-                    self.cache[key] = (CacheState.SHARED, value, timestamp)
-                    self.metrics['state_transitions'] += 1
-                elif state == CacheState.EXCLUSIVE:
-                    # E -> S (become shared)
-                    self.cache[key] = (CacheState.SHARED, value, timestamp)
-                    self.metrics['state_transitions'] += 1
-                
-                return {'value': value, 'state': state.value}
-            return {'value': None}
+    async def handle_snapshot(self, offset=0, limit=100):
+        """Serve one page of hot clean lines to a peer that is warming up"""
+        limit = max(1, min(int(limit), self.MAX_LISTING))
+        async with self._lock:
+            return self._serve_snapshot(max(0, int(offset)), limit)
 
-    async def get_cache_state(self):
-        """Get current cache state for monitoring"""
+    def _note_changed(self, keys):
+        if self._warm_invalidated is not None:
+            self._warm_invalidated.update(keys)
+
+    async def warm_up(self):
+        """Fill a freshly started cache with hot lines, then mark the node ready"""
+        self._warm_invalidated = set()
+        try:
+            installed = await asyncio.wait_for(self._warm_up(), self.WARMUP_TIMEOUT)
+            print(f"[{self.node_id}] Cache warm-up installed {installed} lines")
+        except asyncio.TimeoutError:
+            print(f"[{self.node_id}] Cache warm-up timed out after {self.metrics['warmed_keys']} lines")
+        finally:
+            self._warm_invalidated = None
+            self.ready = True
+
+    async def _warm_up(self):
+        installed = await self._warm_from_peers()
+        if not installed and self.snapshot_path:
+            installed = await self._warm_from_file()
+        return installed
+
+    async def _warm_from_peers(self):
+        """Page through the hot lines of the first peer that has any"""
+        if not self.msg:
+            return 0
+        for peer in self._peers():
+            installed = 0
+            offset = 0
+            while offset < self.warmup_keys:
+                limit = min(self.WARMUP_PAGE, self.warmup_keys - offset)
+                try:
+                    response = await self.msg.get(peer, f'/cache/snapshot?offset={offset}&limit={limit}')
+                except Exception:
+                    response = None
+                if not response:
+                    break
+                installed += await self._install_warm(response.get('lines', []))
+                offset += limit
+                if not response.get('more'):
+                    break
+            if installed:
+                return installed
+        return 0
+
+    async def _warm_from_file(self):
+        """Load the local snapshot, aging its TTLs and capping them at SNAPSHOT_TTL"""
+        loop = asyncio.get_event_loop()
+        try:
+            data = await loop.run_in_executor(None, self._read_snapshot_file)
+        except (OSError, ValueError):
+            return 0
+        age = time.time() - data.get('saved_at', 0)
+        if age > self.SNAPSHOT_MAX_AGE:
+            return 0
+        lines = []
+        for line in data.get('lines', []):
+            ttl = line.get('ttl')
+            if ttl is not None:
+                ttl -= age
+                if ttl <= 0:
+                    continue
+            lines.append(dict(line, ttl=self.SNAPSHOT_TTL if ttl is None else min(ttl, self.SNAPSHOT_TTL)))
+        return await self._install_warm(lines)
+
+    async def _install_warm(self, lines):
+        """Install warm-up lines as SHARED, never over anything newer"""
+        async with self._lock:
+            changed = self._warm_invalidated or ()
+            installed = 0
+            for line in lines:
+                key = line['key']
+                if key in self.cache or key in changed:
+                    continue
+                if self.partitioned and self.ring.owner(key) != self.node_id:
+                    continue
+                self._install_fetched(key, line, CacheState.SHARED)
+                installed += 1
+            self._evict_if_needed()
+            self.metrics['warmed_keys'] += installed
+            return installed
+
+    async def save_snapshot(self):
+        """
+        Write the hot clean lines to snapshot_path (atomically, via a temp file).
+        Dirty M/O lines are left out: reloaded as SHARED they would be served
+        as clean copies while the cluster may already hold newer ones.
+        """
+        async with self._lock:
+            now = time.time()
+            lines = []
+            for key in self.policy.hot_keys(self.warmup_keys):
+                entry = self._live_entry(key)
+                if entry is not None and entry.state not in (CacheState.MODIFIED, CacheState.OWNED):
+                    lines.append(dict(self._wire_line(key, entry), key=key))
+        data = {'node_id': self.node_id, 'saved_at': now, 'lines': lines}
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write_snapshot_file, data)
+
+    def _write_snapshot_file(self, data):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _read_snapshot_file(self):
+        with open(self.snapshot_path) as f:
+            return json.load(f)
+
+    def _roll_digest(self):
+        """Close the current digest generation if any bits changed in it"""
+        dirty = self.digest.take_dirty()
+        if dirty:
+            self.digest_generation += 1
+            self._digest_history.append((self.digest_generation, dirty))
+
+    async def get_digest(self, epoch=None, since=None):
+        """
+        Bloom digest of the resident keys. A peer that already holds generation
+        `since` of this epoch gets only the bytes changed after it; anyone else
+        (or a peer too far behind) gets the full bit array.
+        """
+        if self.digest is None:
+            return None
         async with self._lock:
-            state_summary = {}
-            for key, (state, value, timestamp) in self.cache.items():
-                state_summary[key] = {
-                    'state': state.value,
-                    'age': time.time() - timestamp
+            self._roll_digest()
+            result = {'epoch': self.digest_epoch, 'generation': self.digest_generation}
+            history = self._digest_history
+            oldest = history[0][0] - 1 if history else self.digest_generation
+            if epoch == self.digest_epoch and since is not None and oldest <= since <= self.digest_generation:
+                changed = set()
+                for generation, dirty in history:
+                    if generation > since:
+                        changed |= dirty
+                result['delta'] = self.digest.delta(changed)
+            else:
+                result.update(self.digest.snapshot().to_dict())
+            return result
+
+    async def refresh_peer_digests(self):
+        """Pull every peer's digest, incrementally where we already hold a base"""
+        if not self.msg:
+            return
+        await asyncio.gather(*(self._refresh_peer_digest(peer) for peer in self._peers()))
+
+    async def _refresh_peer_digest(self, peer):
+        known = self.peer_digests.get(peer)
+        path = '/cache/digest'
+        if known is not None:
+            path += f'?epoch={known[0]}&since={known[1]}'
+        try:
+            response = await self.msg.get(peer, path)
+        except Exception:
+            response = None
+        if not response or 'generation' not in response:
+            # Unknown state: stop filtering so misses ask this peer again
+            self.peer_digests.pop(peer, None)
+            return
+        if 'bits' in response:
+            bloom = BloomFilter.from_dict(response)
+        elif known is not None and known[0] == response.get('epoch'):
+            bloom = known[2]
+            bloom.apply_delta(response.get('delta', {}))
+        else:
+            self.peer_digests.pop(peer, None)
+            return
+        self.peer_digests[peer] = (response['epoch'], response['generation'], bloom)
+
+    async def get_cache_state(self):
+        """Get current cache state for monitoring - O(1), served from running counters"""
+        return {
+            'protocol': self.protocol.value,
+            'mode': self.mode,
+            'cache_state': {
+                state.value: {
+                    'count': self.state_counts[state],
+                    'bytes': self.state_bytes[state]
                 }
-            return {
-                'cache_state': state_summary,
-                'metrics': self.metrics.copy(),
-                'capacity_used': len(self.cache),
-                'capacity_total': self.capacity
+                for state in CacheState
+            },
+            'metrics': self.metrics.copy(),
+            'capacity_used': len(self.cache),
+            'capacity_total': self.capacity,
+            'bytes_used': self.bytes_used,
+            'stale_bytes': self.stale_bytes,
+            'bytes_total': self.capacity_bytes,
+            'eviction_policy': self.policy.name,
+            'compression': {
+                'threshold': self.compress_threshold,
+                'lines': self.compressed_lines,
+                'raw_bytes': self.compressed_raw_bytes,
+                'stored_bytes': self.compressed_bytes,
+                'saved_bytes': self.compressed_raw_bytes - self.compressed_bytes,
+                'ratio': self.compressed_bytes / self.compressed_raw_bytes if self.compressed_raw_bytes else None
             }
+        }
+
+    MAX_LISTING = 1000
+
+    async def list_keys(self, cursor=0, limit=100, sample=False):
+        """
+        Paginated (or randomly sampled) key listing for monitoring.
+        Each call holds the lock for at most `limit` lines. Like SCAN, a key
+        moved by a concurrent removal may be skipped between pages.
+        """
+        limit = max(1, min(int(limit), self.MAX_LISTING))
+        async with self._lock:
+            now = time.time()
+            total = len(self._slots)
+            if sample:
+                keys = [self._slots[i] for i in random.sample(range(total), min(limit, total))]
+                next_cursor = 0
+            else:
+                cursor = max(0, int(cursor))
+                keys = self._slots[cursor:cursor + limit]
+                next_cursor = cursor + len(keys)
+                if next_cursor >= total:
+                    next_cursor = 0
+            lines = {}
+            for key in keys:
+                entry = self.cache[key]
+                lines[key] = {
+                    'state': entry.state.value,
+                    'age': now - entry.timestamp,
+                    'size': entry.size,
+                    'ttl': None if entry.expires_at is None else max(0.0, entry.expires_at - now)
+                }
+            return {'keys': lines, 'cursor': next_cursor, 'total': total}
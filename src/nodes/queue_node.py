@@ -1,79 +1,1562 @@
 import os
+import json
+import time
+import heapq
+import math
+import uuid
 import asyncio
-import aiofiles
-from typing import Optional
+import itertools
+from collections import deque
+from typing import Dict, List, Optional, Set
+from redis.exceptions import ResponseError
+from src.utils.hash_ring import ConsistentHashRing, stable_hash
+from src.utils.segmented_log import SegmentedLog
+from src.utils.metrics import RateCounter
+
+# Stats any node can read, per partition: a hash of totals (enqueued,
+# dequeued, dropped, rejected), per-minute rate buckets ('e{minute}',
+# 'd{minute}') and, per lane, how many messages were ever pushed at its tail
+# ('in:{lane}'), how many of those were taken off its head ('out:{lane}') and
+# how many nacked or redelivered messages were put back at its head and not
+# taken again yet ('back:{lane}'); those are not counted as dequeued twice.
+# Each lane also has a sorted set of enqueue-time marks, about one per second:
+# member the second, score the lane's 'in' count after its last push. The hash
+# also keeps the payload bytes the partition holds, ready or in flight
+# ('held_bytes') and delayed ('delayed_bytes'), which bounded topics check
+# against max_bytes, and how many drop_oldest pushes left the partition over
+# its limits ('over_limit'). All of it is updated by the same script that moves
+# the messages; times are the calling node's clock, passed in as now.
+
+_STATS = """
+local function count_enqueued(stats, lane, marks, topics, ptopic, n, now, keep)
+    if n <= 0 then return end
+    redis.call('HINCRBY', stats, 'enqueued', n)
+    redis.call('HINCRBY', stats, 'e' .. math.floor(now / 60), n)
+    local total = redis.call('HINCRBY', stats, 'in:' .. lane, n)
+    redis.call('ZADD', marks, total, math.floor(now))
+    redis.call('ZREMRANGEBYRANK', marks, 0, -keep - 1)
+    redis.call('SADD', topics, ptopic)
+end
+local function count_taken(stats, lane, n)
+    if n <= 0 then return 0 end
+    local again = math.min(tonumber(redis.call('HGET', stats, 'back:' .. lane) or 0), n)
+    if again > 0 then redis.call('HINCRBY', stats, 'back:' .. lane, -again) end
+    if n > again then redis.call('HINCRBY', stats, 'out:' .. lane, n - again) end
+    return n - again
+end
+local function count_dequeued(stats, lane, n, now)
+    local first = count_taken(stats, lane, n)
+    if first <= 0 then return end
+    redis.call('HINCRBY', stats, 'dequeued', first)
+    redis.call('HINCRBY', stats, 'd' .. math.floor(now / 60), first)
+end
+local function count_put_back(stats, lane, n)
+    redis.call('HINCRBY', stats, 'back:' .. lane, n)
+end
+local function count_bytes(stats, field, n)
+    if n ~= 0 then redis.call('HINCRBY', stats, field, n) end
+end
+local function payload(items, from, to)
+    local size = 0
+    for i = from, to do size = size + #items[i] end
+    return size
+end
+"""
+
+# KEYS: lane, stats, lane marks, stats topics; ARGV: partition topic, now, keep marks, message...
+_PUSH = _STATS + """
+for i = 4, #ARGV do redis.call('RPUSH', KEYS[1], ARGV[i]) end
+count_bytes(KEYS[2], 'held_bytes', payload(ARGV, 4, #ARGV))
+count_enqueued(KEYS[2], KEYS[1], KEYS[3], KEYS[4], ARGV[1], #ARGV - 3, tonumber(ARGV[2]), tonumber(ARGV[3]))
+return #ARGV - 3
+"""
+
+# KEYS: lane, stats; ARGV: count, now
+_POP = _STATS + """
+local items = redis.call('LPOP', KEYS[1], tonumber(ARGV[1]))
+if not items then return {} end
+count_bytes(KEYS[2], 'held_bytes', -payload(items, 1, #items))
+count_dequeued(KEYS[2], KEYS[1], #items, tonumber(ARGV[2]))
+return items
+"""
+
+# Reliable delivery keeps, per topic, a hash of in-flight deliveries
+# (receipt -> message) and a sorted set of their visibility deadlines. A receipt
+# names the delivery's partition, lane and consumer, so the caller can pass the
+# lane and processing list a settle or redelivery touches as KEYS. Deadlines use
+# Redis TIME so node clocks don't matter.
+
+# KEYS: queue, processing, deadlines, inflight, reliable topics, stats
+# ARGV: topic, visibility timeout, now, receipt...
+_RELIABLE_CONSUME = _STATS + """
+local t = redis.call('TIME')
+local deadline = tonumber(t[1]) + tonumber(t[2]) / 1000000 + tonumber(ARGV[2])
+local out = {}
+for i = 4, #ARGV do
+    local msg = redis.call('LMOVE', KEYS[1], KEYS[2], 'LEFT', 'RIGHT')
+    if not msg then break end
+    redis.call('HSET', KEYS[4], ARGV[i], msg)
+    redis.call('ZADD', KEYS[3], deadline, ARGV[i])
+    table.insert(out, ARGV[i])
+    table.insert(out, msg)
+end
+if #out > 0 then redis.call('SADD', KEYS[5], ARGV[1]) end
+count_dequeued(KEYS[6], KEYS[1], #out / 2, tonumber(ARGV[3]))
+return out
+"""
+
+# KEYS: lane, processing, deadlines, inflight, stats; ARGV: receipt, requeue (0/1)
+_RELIABLE_SETTLE = _STATS + """
+local message = redis.call('HGET', KEYS[4], ARGV[1])
+if not message then return 0 end
+redis.call('LREM', KEYS[2], 1, message)
+if ARGV[2] == '1' then
+    redis.call('LPUSH', KEYS[1], message)
+    count_put_back(KEYS[5], KEYS[1], 1)
+else
+    count_bytes(KEYS[5], 'held_bytes', -#message)
+end
+redis.call('HDEL', KEYS[4], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return 1
+"""
+
+# KEYS: deadlines, inflight, reliable topics, stats, then the lane and
+# processing list of each receipt; ARGV: topic, receipt...
+# Receipts are candidates (the earliest deadlines); only those past their
+# deadline are redelivered. Returns how many were.
+_RELIABLE_REDELIVER = _STATS + """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local redelivered = 0
+for i = 2, #ARGV do
+    local deadline = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if deadline and tonumber(deadline) <= now then
+        local lane, processing = KEYS[2 * i + 1], KEYS[2 * i + 2]
+        local message = redis.call('HGET', KEYS[2], ARGV[i])
+        if message then
+            redis.call('LREM', processing, 1, message)
+            redis.call('LPUSH', lane, message)
+            count_put_back(KEYS[4], lane, 1)
+            redis.call('HDEL', KEYS[2], ARGV[i])
+            redelivered = redelivered + 1
+        end
+        redis.call('ZREM', KEYS[1], ARGV[i])
+    end
+end
+if redis.call('ZCARD', KEYS[1]) == 0 then redis.call('SREM', KEYS[3], ARGV[1]) end
+return redelivered
+"""
+
+# Delayed messages wait in a per-topic sorted set scored by due time (Redis TIME
+# again); members are JSON [unique id, priority, message].
+
+# KEYS: delayed, delayed topics, stats; ARGV: topic, delay, member...
+_SCHEDULE = _STATS + """
+local t = redis.call('TIME')
+local due = tonumber(t[1]) + tonumber(t[2]) / 1000000 + tonumber(ARGV[2])
+local size = 0
+for i = 3, #ARGV do
+    redis.call('ZADD', KEYS[1], due, ARGV[i])
+    size = size + #cjson.decode(ARGV[i])[3]
+end
+count_bytes(KEYS[3], 'delayed_bytes', size)
+redis.call('SADD', KEYS[2], ARGV[1])
+return #ARGV - 2
+"""
+
+# Bounded topics count every message a partition holds against its limits:
+# ready in its lanes, waiting in its delayed set and in flight to reliable
+# consumers, by count and by payload bytes. Promotion, nack and redelivery only
+# move messages between those, so once admitted by _BOUNDED_PUSH they never
+# push a partition over.
+
+# KEYS[first - 2]: delayed set, KEYS[first - 1]: in-flight hash, KEYS[first..]:
+# lanes, lowest priority first, then as many lane marks in the same order.
+# last_lane(first) is the index of the last lane; usage returns ready +
+# in-flight count, delayed count and the payload bytes of each from stats.
+_PARTITION_USAGE = """
+local function last_lane(first)
+    return (#KEYS + first - 1) / 2
+end
+local function usage(first, stats)
+    local held = redis.call('HLEN', KEYS[first - 1])
+    local delayed = redis.call('ZCARD', KEYS[first - 2])
+    for i = first, last_lane(first) do held = held + redis.call('LLEN', KEYS[i]) end
+    local bytes = redis.call('HMGET', stats, 'held_bytes', 'delayed_bytes')
+    return held, delayed, tonumber(bytes[1] or 0), tonumber(bytes[2] or 0)
+end
+"""
+
+# KEYS: queue, stats, its marks, stats topics, delayed topics, delayed,
+# in-flight, every lane of the partition, their marks
+# ARGV: topic, limit, max depth, max bytes (0 = no limit), now, keep marks
+# Due messages stay delayed while the partition's ready and in-flight messages
+# alone fill a limit (it was lowered, or they were scheduled before it existed).
+# Returns {promoted, seconds until the next due message or -1 if none remain, full}
+_PROMOTE = _PARTITION_USAGE + _STATS + """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local max_depth = tonumber(ARGV[3])
+local max_bytes = tonumber(ARGV[4])
+local held, held_bytes = 0, 0
+if max_depth > 0 or max_bytes > 0 then
+    local _
+    held, _, held_bytes = usage(8, KEYS[2])
+end
+local due = redis.call('ZRANGEBYSCORE', KEYS[6], '-inf', now, 'LIMIT', 0, tonumber(ARGV[2]))
+local last = last_lane(8)
+local moved, moved_bytes, full, per_lane = 0, 0, 0, {}
+for _, member in ipairs(due) do
+    local e = cjson.decode(member)
+    if (max_depth > 0 and held >= max_depth) or (max_bytes > 0 and held_bytes + #e[3] > max_bytes) then
+        full = 1
+        break
+    end
+    redis.call('RPUSH', KEYS[8 + e[2]], e[3])
+    redis.call('ZREM', KEYS[6], member)
+    held = held + 1
+    held_bytes = held_bytes + #e[3]
+    moved = moved + 1
+    moved_bytes = moved_bytes + #e[3]
+    per_lane[e[2]] = (per_lane[e[2]] or 0) + 1
+end
+count_bytes(KEYS[2], 'held_bytes', moved_bytes)
+count_bytes(KEYS[2], 'delayed_bytes', -moved_bytes)
+for priority, n in pairs(per_lane) do
+    count_enqueued(KEYS[2], KEYS[8 + priority], KEYS[last + 1 + priority], KEYS[4], ARGV[1], n,
+        tonumber(ARGV[5]), tonumber(ARGV[6]))
+end
+local nxt = redis.call('ZRANGE', KEYS[6], 0, 0, 'WITHSCORES')
+if #nxt == 0 then
+    redis.call('SREM', KEYS[5], ARGV[1])
+    return {moved, '-1', full}
+end
+return {moved, tostring(tonumber(nxt[2]) - now), full}
+"""
+
+# The limits are checked in the same script that pushes (or schedules), so
+# concurrent producers cannot overshoot together.
+
+# KEYS: target lane, stats, its marks, stats topics, delayed topics, delayed,
+# in-flight, every lane of the partition, lowest priority first, their marks
+# ARGV: max depth, max bytes (0 = no limit), mode, delay (0 = ready now),
+# partition topic, now, keep marks, message... (delayed set members when delay > 0)
+# mode: 'reject' pushes all or nothing, 'partial' pushes what fits, 'drop' pushes
+# everything and then drops the oldest ready messages, lowest priority first.
+# Delayed and in-flight messages cannot be dropped, so a partition they fill
+# stays over its limits; that is counted as over_limit.
+# Returns {pushed, dropped}
+_BOUNDED_PUSH = _PARTITION_USAGE + _STATS + """
+local max_depth = tonumber(ARGV[1])
+local max_bytes = tonumber(ARGV[2])
+local mode = ARGV[3]
+local delay = tonumber(ARGV[4])
+local held, delayed, held_bytes, delayed_bytes = usage(8, KEYS[2])
+local depth, bytes = held + delayed, held_bytes + delayed_bytes
+local n, size = 0, 0
+for i = 8, #ARGV do
+    local s = #ARGV[i]
+    if delay > 0 then s = #cjson.decode(ARGV[i])[3] end
+    local fits = (max_depth == 0 or depth + n < max_depth)
+        and (max_bytes == 0 or bytes + size + s <= max_bytes)
+    if not fits and mode ~= 'drop' then break end
+    n = n + 1
+    size = size + s
+end
+if n == 0 or (mode == 'reject' and n < #ARGV - 7) then return {0, 0} end
+if delay > 0 then
+    local t = redis.call('TIME')
+    local due = tonumber(t[1]) + tonumber(t[2]) / 1000000 + delay
+    for i = 8, 7 + n do redis.call('ZADD', KEYS[6], due, ARGV[i]) end
+    redis.call('SADD', KEYS[5], ARGV[5])
+    count_bytes(KEYS[2], 'delayed_bytes', size)
+else
+    for i = 8, 7 + n do redis.call('RPUSH', KEYS[1], ARGV[i]) end
+    count_bytes(KEYS[2], 'held_bytes', size)
+    count_enqueued(KEYS[2], KEYS[1], KEYS[3], KEYS[4], ARGV[5], n, tonumber(ARGV[6]), tonumber(ARGV[7]))
+end
+local dropped = 0
+if mode == 'drop' then
+    depth, bytes = depth + n, bytes + size
+    local function over()
+        return (max_depth > 0 and depth > max_depth) or (max_bytes > 0 and bytes > max_bytes)
+    end
+    for i = 8, last_lane(8) do
+        while over() do
+            -- Enough for the depth limit and, at the average size, for the bytes limit
+            local excess = 1
+            if max_depth > 0 then excess = math.max(excess, depth - max_depth) end
+            if max_bytes > 0 and bytes > max_bytes then
+                excess = math.max(excess, math.ceil((bytes - max_bytes) * depth / bytes))
+            end
+            local popped = redis.call('LPOP', KEYS[i], excess)
+            if not popped then break end
+            local freed = payload(popped, 1, #popped)
+            count_taken(KEYS[2], KEYS[i], #popped)
+            count_bytes(KEYS[2], 'held_bytes', -freed)
+            depth, bytes = depth - #popped, bytes - freed
+            dropped = dropped + #popped
+        end
+    end
+    if dropped > 0 then redis.call('HINCRBY', KEYS[2], 'dropped', dropped) end
+    if over() then redis.call('HINCRBY', KEYS[2], 'over_limit', 1) end
+end
+return {n, dropped}
+"""
+
+class QueueFullError(Exception):
+    """A bounded topic has no room and its overflow policy did not make any"""
 
 class DistributedQueue:
-    def __init__(self, node_id, redis_client=None):
+    """
+    Topic queues on Redis lists (or local files when Redis is unavailable).
+    A topic may be split into `partitions` lists, `queue:{topic}:p{n}`, each
+    placed on one of the Redis shards by a consistent-hash ring. With a single
+    partition the topic keeps its plain `queue:{topic}` key. Each partition has
+    one list per priority level (`...:pri{n}` above 0), drained highest first,
+    and a sorted set of delayed messages promoted to those lists when due.
+    Topics may be bounded by depth and/or bytes (split evenly over partitions)
+    with an overflow policy: reject, block, drop_oldest, or spill to a local
+    segmented log that is refilled to Redis as the topic drains. Delayed and
+    in-flight messages count against the bounds too.
+    """
+
+    # Upper bound on how long a blocking consume may hold a request open
+    MAX_BLOCK_TIMEOUT = 30.0
+    # Shorter waits are not passed to Redis, where a 0 timeout means forever
+    MIN_BLOCK_TIMEOUT = 0.01
+    # A wait spanning several shards rotates between them in slices this long
+    BLOCK_SLICE = 0.5
+    # A lane watcher's blocking peek; it stops once no waiter is left after one
+    WATCH_SLICE = 1.0
+    RELIABLE_TOPICS_KEY = "queue:reliable_topics"
+    REDELIVERY_INTERVAL = 1.0
+    REDELIVERY_BATCH = 100
+    # Consumers silent for CONSUMER_TTL leave partition assignment; assignments are cached locally
+    CONSUMER_TTL = 10.0
+    ASSIGNMENT_REFRESH = 2.0
+    DELAYED_TOPICS_KEY = "queue:delayed_topics"
+    # The promoter sleeps until the next known due time, but never longer than
+    # this, so messages delayed through other nodes are picked up too
+    PROMOTE_INTERVAL = 1.0
+    PROMOTE_BATCH = 500
+    # Enqueue-time marks kept per lane for oldest-message age (about one per second)
+    STATS_MARKS = 86400
+    STATS_TOPICS_KEY = "queue:stats_topics"
+    OVERFLOW_POLICIES = ('reject', 'block', 'drop_oldest', 'spill')
+    REFILL_INTERVAL = 0.5
+    REFILL_BATCH = 500
+
+    def __init__(self, node_id, redis_client=None, blocking_redis=None, visibility_timeout: float = 30.0,
+                 shards: Optional[Dict[str, object]] = None, blocking_shards: Optional[Dict[str, object]] = None,
+                 partitions: int = 1, data_dir: str = '/tmp', segment_bytes: int = 1 << 20,
+                 stream_maxlen: Optional[int] = 100000, priority_levels: int = 1, max_depth: int = 0,
+                 max_bytes: int = 0, overflow: str = 'reject', overflow_block_timeout: float = 5.0,
+                 topic_limits: Optional[Dict[str, dict]] = None):
         self.node_id = node_id
-        self.redis = redis_client
+        if shards is None and redis_client is not None:
+            shards = {'default': redis_client}
+            if blocking_redis is not None:
+                blocking_shards = {'default': blocking_redis}
+        self.shards = shards or {}
+        # Separate pools for blocking peeks so parked consumers can't exhaust the shared ones
+        self.blocking_shards = blocking_shards or {}
+        self.redis = redis_client or next(iter(self.shards.values()), None)
+        self.ring = ConsistentHashRing(self.shards)
+        self.partitions = max(1, partitions)
+        self.priority_levels = max(1, priority_levels)
+        self.visibility_timeout = visibility_timeout
+        # Stream topics are trimmed to about this many entries (None keeps everything)
+        self.stream_maxlen = stream_maxlen
+        self._stream_groups: Set[tuple] = set()
         self._lock = asyncio.Lock()
+        # Fallback mode: one segmented log per (partition) topic under data_dir,
+        # plus messages nacked or redelivered back in front of it
+        self.data_dir = data_dir
+        self.segment_bytes = segment_bytes
+        self._logs: Dict[str, SegmentedLog] = {}
+        self._requeued: Dict[str, deque] = {}
+        self._next_partition = 0
+        self._next_sweep = 0
+        # (topic, consumer) -> (refresh at, assigned partitions); fallback mode membership
+        self._assignments: Dict[tuple, tuple] = {}
+        self._members: Dict[str, Dict[str, float]] = {}
+        # Consumers parked per lane, woken by produce (fallback mode) or by the
+        # lane's watcher task, which peeks it in Redis on behalf of all of them
+        self._waiters: Dict[str, Set[asyncio.Future]] = {}
+        self._watchers: Dict[str, asyncio.Task] = {}
+        # Fallback mode in-flight deliveries: receipt -> (topic, lane, message), plus a deadline heap
+        self._inflight: Dict[str, tuple] = {}
+        self._deadlines: List[tuple] = []
+        # Fallback mode delayed messages: heap of (due, sequence, topic, lane, message)
+        self._delayed: List[tuple] = []
+        self._delayed_seq = 0
+        self._promote_wakeup = asyncio.Event()
+        self._next_promote = 0.0
+        self.metrics = {'acked': 0, 'nacked': 0, 'redelivered': 0}
+        # Per-topic counters updated as messages pass through this node, see stats()
+        self._topic_stats: Dict[str, dict] = {}
+        self._stream_topics: Set[str] = set()
+        # Default limits (0 = unbounded) and per-topic overrides of any of them
+        self.limits = {'max_depth': max_depth, 'max_bytes': max_bytes, 'overflow': overflow}
+        self.topic_limits = topic_limits or {}
+        for limits in [self.limits, *self.topic_limits.values()]:
+            if limits.get('overflow', overflow) not in self.OVERFLOW_POLICIES:
+                raise ValueError(f"Unknown overflow policy: {limits['overflow']}")
+        self.overflow_block_timeout = overflow_block_timeout
+        # Spill policy: lane -> (topic, partition topic, log) of messages waiting to refill Redis,
+        # and lane -> (topic, partition topic, priority, log) of delayed ones as JSON [due, message]
+        self._spills: Dict[str, tuple] = {}
+        self._delayed_spills: Dict[str, tuple] = {}
+        # Fallback mode: per lane, messages delayed or in flight (they count against limits)
+        self._held: Dict[str, int] = {}
+
+    async def start_background(self, app):
+        app.loop.create_task(self._redelivery_loop())
+        app.loop.create_task(self._promote_loop())
+        app.loop.create_task(self._refill_loop())
+
+    def partition_topic(self, topic: str, partition: int) -> str:
+        """Name under which a partition of topic is stored"""
+        return topic if self.partitions == 1 else f"{topic}:p{partition}"
+
+    def _lane(self, ptopic: str, priority: int) -> str:
+        """Name of the list holding ptopic's messages at priority"""
+        return ptopic if priority == 0 else f"{ptopic}:pri{priority}"
+
+    def _lanes(self, topic: str, partitions: List[int]) -> List[tuple]:
+        """(partition topic, lane) pairs for partitions, highest priority first"""
+        ptopics = [self.partition_topic(topic, p) for p in partitions]
+        return [(ptopic, self._lane(ptopic, priority))
+                for priority in reversed(range(self.priority_levels)) for ptopic in ptopics]
+
+    def _topic_of(self, ptopic: str) -> str:
+        """Inverse of partition_topic"""
+        return ptopic.rsplit(':p', 1)[0] if self.partitions > 1 else ptopic
+
+    def _pick_partition(self, key: Optional[str]) -> int:
+        # Keyed messages always land on the same partition, which keeps their order
+        if self.partitions == 1:
+            return 0
+        if key is not None:
+            return stable_hash(key) % self.partitions
+        self._next_partition = (self._next_partition + 1) % self.partitions
+        return self._next_partition
 
-    async def produce(self, topic: str, message: str):
-        """Produce message to queue with error handling"""
-        key = f"queue:{topic}"
+    def _shard_name(self, ptopic: str) -> str:
+        return self.ring.owner(ptopic)
+
+    def _shard(self, ptopic: str):
+        return self.shards[self._shard_name(ptopic)]
+
+    def _blocking_shard(self, name: str):
+        return self.blocking_shards.get(name) or self.shards[name]
+
+    async def _candidates(self, topic: str, consumer: Optional[str]) -> List[int]:
+        """Partitions a consume may read: the consumer's assignment, or all of them"""
+        if self.partitions == 1:
+            return [0]
+        if consumer:
+            return await self.assigned_partitions(topic, consumer)
+        # Unassigned consumers sweep every partition, starting at a rotating one
+        self._next_sweep = (self._next_sweep + 1) % self.partitions
+        return [(self._next_sweep + i) % self.partitions for i in range(self.partitions)]
+
+    async def assigned_partitions(self, topic: str, consumer: str) -> List[int]:
+        """
+        Partitions of topic owned by consumer: live consumers are sorted by name
+        and partition p goes to the (p mod n)-th. Every node computes the same
+        assignment from the membership set; a changed membership takes up to
+        ASSIGNMENT_REFRESH seconds to be seen everywhere.
+        """
+        now = time.time()
+        cached = self._assignments.get((topic, consumer))
+        if cached and cached[0] > now:
+            return cached[1]
+        members = await self._heartbeat(topic, consumer, now)
+        index = members.index(consumer)
+        assigned = [p for p in range(self.partitions) if p % len(members) == index]
+        self._assignments[(topic, consumer)] = (now + self.ASSIGNMENT_REFRESH, assigned)
+        return assigned
+
+    async def _heartbeat(self, topic: str, consumer: str, now: float) -> List[str]:
+        """Record consumer as live for topic and return the live consumers, sorted"""
+        if self.redis:
+            key = f"queue:{topic}:consumers"
+            shard = self._shard(topic)
+            await shard.zadd(key, {consumer: now})
+            await shard.zremrangebyscore(key, '-inf', now - self.CONSUMER_TTL)
+            return sorted(await shard.zrange(key, 0, -1))
+        members = self._members.setdefault(topic, {})
+        members[consumer] = now
+        for name, seen in list(members.items()):
+            if seen < now - self.CONSUMER_TTL:
+                del members[name]
+        return sorted(members)
+
+    async def produce(self, topic: str, message: str, key: Optional[str] = None,
+                      priority: int = 0, delay: Optional[float] = None):
+        """
+        Produce message to queue with error handling.
+        priority (0 to priority_levels - 1, higher first) picks the lane, and
+        delay holds the message back for that many seconds.
+        """
+        await self.produce_batch(topic, [message], key=key, priority=priority, delay=delay)
+
+    async def produce_batch(self, topic: str, messages: List[str], key: Optional[str] = None,
+                            priority: int = 0, delay: Optional[float] = None):
+        """Produce several messages with one counted push script (or one log append) to one partition"""
+        if not 0 <= priority < self.priority_levels:
+            raise ValueError(f"priority must be between 0 and {self.priority_levels - 1}")
+        if not messages:
+            return
+        ptopic = self.partition_topic(topic, self._pick_partition(key))
+        lane = self._lane(ptopic, priority)
+        delay = delay if delay and delay > 0 else None
         try:
+            limits = self._partition_limits(topic)
+            if limits:
+                await self._produce_bounded(topic, ptopic, lane, messages, limits, priority, delay)
+            elif delay:
+                await self._schedule(topic, ptopic, lane, priority, messages, delay)
+            elif self.redis:
+                await self._shard(ptopic).eval(
+                    _PUSH, 4, f"queue:{lane}", *self._stats_keys(ptopic, lane),
+                    ptopic, time.time(), self.STATS_MARKS, *messages)
+            else:
+                await self._produce_to_file(lane, *messages)
+                self._wake(lane)
+            # With Redis the pushing script counts; delayed messages are counted when promoted
+            if not delay and not self.redis:
+                self._record(topic, enqueued=len(messages))
+        except QueueFullError:
             if self.redis:
-                await self.redis.rpush(key, message)
+                try:
+                    await self._shard(ptopic).hincrby(f"queue:{ptopic}:stats", 'rejected', len(messages))
+                except Exception as e:
+                    print(f"Error counting rejects for {topic}: {e}")
             else:
-                await self._produce_to_file(topic, message)
+                self._record(topic, rejected=len(messages))
+            raise
         except Exception as e:
-            print(f"Error producing message to {topic}: {e}")
+            print(f"Error producing to {topic}: {e}")
             raise
 
-    async def consume(self, topic: str) -> Optional[str]:
-        """Consume message from queue with error handling"""
-        key = f"queue:{topic}"
+    def _partition_limits(self, topic: str) -> Optional[dict]:
+        """topic's limits divided over its partitions, or None when it is unbounded"""
+        limits = {**self.limits, **self.topic_limits.get(topic, {})}
+        if not limits['max_depth'] and not limits['max_bytes']:
+            return None
+        return {'max_depth': math.ceil(limits['max_depth'] / self.partitions),
+                'max_bytes': math.ceil(limits['max_bytes'] / self.partitions),
+                'overflow': limits['overflow']}
+
+    async def _produce_bounded(self, topic: str, ptopic: str, lane: str, messages: List[str], limits: dict,
+                               priority: int = 0, delay: Optional[float] = None):
+        policy = limits['overflow']
+        spills = self._delayed_spills if delay else self._spills
+        spill = spills.get(lane)
+        if self.redis and spill is not None and len(spill[-1]):
+            # Once a lane has spilled, newer messages queue behind the spilled ones to keep FIFO order
+            self._spill(topic, ptopic, lane, priority, messages, delay)
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.overflow_block_timeout
+        backoff = 0.01
+        while True:
+            pushed, dropped = await self._push_bounded(ptopic, lane, messages, limits,
+                                                       'drop' if policy == 'drop_oldest' else 'reject',
+                                                       priority, delay)
+            if pushed:
+                if dropped and not self.redis:
+                    self._record(topic, dropped=dropped)
+                return
+            if policy == 'spill':
+                self._spill(topic, ptopic, lane, priority, messages, delay)
+                return
+            remaining = deadline - loop.time()
+            if policy != 'block' or remaining <= 0:
+                raise QueueFullError(f"Topic {topic} is full")
+            await asyncio.sleep(min(backoff, remaining))
+            backoff = min(backoff * 2, self.BLOCK_SLICE)
+
+    def _stats_keys(self, ptopic: str, lane: str) -> List[str]:
+        """stats, lane marks and stats topics KEYS of the scripts that count messages pushed to lane"""
+        return [f"queue:{ptopic}:stats", f"queue:{lane}:marks", self.STATS_TOPICS_KEY]
+
+    def _partition_keys(self, ptopic: str, lane: str) -> List[str]:
+        """
+        KEYS after the target lane in the bounded scripts: stats, lane marks,
+        stats topics, delayed topics, delayed, in-flight, every lane, their marks
+        """
+        keys = self._reliable_keys(ptopic)
+        lanes = [f"queue:{self._lane(ptopic, priority)}" for priority in range(self.priority_levels)]
+        return [*self._stats_keys(ptopic, lane), self.DELAYED_TOPICS_KEY, f"queue:{ptopic}:delayed",
+                keys['inflight'], *lanes, *[f"{name}:marks" for name in lanes]]
+
+    async def _push_bounded(self, ptopic: str, lane: str, messages: List[str], limits: dict, mode: str,
+                            priority: int = 0, delay: Optional[float] = None) -> tuple:
+        """
+        Atomic check-and-push (or schedule, with delay) into a bounded partition;
+        returns (pushed, dropped)
+        """
+        if self.redis:
+            keys = self._partition_keys(ptopic, lane)
+            if delay:
+                messages = [json.dumps([uuid.uuid4().hex, priority, m]) for m in messages]
+            pushed, dropped = await self._shard(ptopic).eval(
+                _BOUNDED_PUSH, 1 + len(keys), f"queue:{lane}", *keys,
+                limits['max_depth'], limits['max_bytes'], mode, delay or 0, ptopic,
+                time.time(), self.STATS_MARKS, *messages)
+            if pushed and delay:
+                self._note_scheduled(delay)
+            return pushed, dropped
+        # The fallback log is already on disk, so only the depth limit applies and spilling is moot
+        lanes = [self._lane(ptopic, priority) for priority in range(self.priority_levels)]
+        async with self._lock:
+            depth = sum(len(self._log(name)) + len(self._requeued.get(name, ())) + self._held.get(name, 0)
+                        for name in lanes)
+            room = limits['max_depth'] - depth if limits['max_depth'] else len(messages)
+            if room < len(messages) and mode == 'reject' and limits['overflow'] != 'spill':
+                return 0, 0
+            if mode == 'partial':
+                messages = messages[:max(room, 0)]
+            if delay:
+                self._schedule_local(self._topic_of(ptopic), lane, messages, delay)
+            else:
+                self._log(lane).append(messages)
+            dropped = 0
+            if mode == 'drop':
+                excess = len(messages) - room
+                for name in lanes:
+                    if excess <= 0:
+                        break
+                    taken = len(self._log(name).read(excess))
+                    excess -= taken
+                    dropped += taken
+                if excess > 0:
+                    # Delayed and in-flight messages cannot be dropped and keep the partition over
+                    self._record(self._topic_of(ptopic), over_limit=1)
+        if messages and not delay:
+            self._wake(lane)
+        return len(messages), dropped
+
+    def _spill_log(self, topic: str, ptopic: str, lane: str) -> SegmentedLog:
+        spill = self._spills.get(lane)
+        if spill is None:
+            log = SegmentedLog(os.path.join(self.data_dir, 'spill', lane), self.segment_bytes)
+            spill = self._spills[lane] = (topic, ptopic, log)
+        return spill[2]
+
+    def _delayed_spill_log(self, topic: str, ptopic: str, lane: str, priority: int) -> SegmentedLog:
+        spill = self._delayed_spills.get(lane)
+        if spill is None:
+            log = SegmentedLog(os.path.join(self.data_dir, 'spill_delayed', lane), self.segment_bytes)
+            spill = self._delayed_spills[lane] = (topic, ptopic, priority, log)
+        return spill[3]
+
+    def _spill(self, topic: str, ptopic: str, lane: str, priority: int, messages: List[str],
+               delay: Optional[float]):
+        """Park messages on disk; delayed ones keep their due time"""
+        if not delay:
+            self._spill_log(topic, ptopic, lane).append(messages)
+            return
+        due = time.time() + delay
+        self._delayed_spill_log(topic, ptopic, lane, priority).append([json.dumps([due, m]) for m in messages])
+
+    async def refill_spilled(self) -> int:
+        """Move spilled messages back to Redis as far as their topic's limits allow"""
+        moved = 0
+        if not self.redis:
+            return moved
+        for lane, (topic, ptopic, log) in list(self._spills.items()):
+            limits = self._partition_limits(topic) or {'max_depth': 0, 'max_bytes': 0, 'overflow': 'spill'}
+            while len(log):
+                records = log.peek(self.REFILL_BATCH)
+                if not records:
+                    break
+                pushed, _ = await self._push_bounded(ptopic, lane, records, limits, 'partial')
+                # Consumed only once pushed: a crash in between redelivers rather than loses
+                log.read(pushed)
+                moved += pushed
+                if pushed < len(records):
+                    break
+        for lane, (topic, ptopic, priority, log) in list(self._delayed_spills.items()):
+            limits = self._partition_limits(topic) or {'max_depth': 0, 'max_bytes': 0, 'overflow': 'spill'}
+            while len(log):
+                records = [json.loads(r) for r in log.peek(self.REFILL_BATCH)]
+                if not records:
+                    break
+                # Messages spilled together share a due time and go back as one batch
+                due = records[0][0]
+                batch = [m for d, m in itertools.takewhile(lambda r: r[0] == due, records)]
+                delay = due - time.time()
+                pushed, _ = await self._push_bounded(ptopic, lane, batch, limits, 'partial', priority,
+                                                     delay if delay > 0 else None)
+                log.read(pushed)
+                moved += pushed
+                if pushed < len(batch):
+                    break
+        return moved
+
+    def _recover_spills(self):
+        """Reopen spill logs left by an earlier run so their messages are refilled"""
+        for name in ('spill', 'spill_delayed'):
+            directory = os.path.join(self.data_dir, name)
+            if not os.path.isdir(directory):
+                continue
+            for lane in os.listdir(directory):
+                ptopic, _, priority = lane.rpartition(':pri')
+                if not (ptopic and priority.isdigit()):
+                    ptopic, priority = lane, '0'
+                if name == 'spill':
+                    self._spill_log(self._topic_of(ptopic), ptopic, lane)
+                else:
+                    self._delayed_spill_log(self._topic_of(ptopic), ptopic, lane, int(priority))
+
+    async def _refill_loop(self):
+        self._recover_spills()
+        while True:
+            try:
+                await self.refill_spilled()
+            except Exception as e:
+                print(f"[{self.node_id}] Spill refill failed: {e}")
+            await asyncio.sleep(self.REFILL_INTERVAL)
+
+    async def _schedule(self, topic: str, ptopic: str, lane: str, priority: int, messages: List[str],
+                        delay: float):
+        if self.redis:
+            members = [json.dumps([uuid.uuid4().hex, priority, m]) for m in messages]
+            await self._shard(ptopic).eval(
+                _SCHEDULE, 3, f"queue:{ptopic}:delayed", self.DELAYED_TOPICS_KEY, f"queue:{ptopic}:stats",
+                ptopic, delay, *members)
+            self._note_scheduled(delay)
+        else:
+            self._schedule_local(topic, lane, messages, delay)
+
+    def _schedule_local(self, topic: str, lane: str, messages: List[str], delay: float):
+        """Fallback mode: hold messages in the delayed heap"""
+        due = time.time() + delay
+        for message in messages:
+            self._delayed_seq += 1
+            heapq.heappush(self._delayed, (due, self._delayed_seq, topic, lane, message))
+        self._hold(lane, len(messages))
+        self._note_scheduled(delay)
+
+    def _note_scheduled(self, delay: float):
+        # Wake the promoter early if this message is due before its next planned pass
+        if time.time() + delay < self._next_promote:
+            self._promote_wakeup.set()
+
+    def _hold(self, lane: str, count: int):
+        """Fallback mode: track messages of lane that are delayed or in flight"""
+        held = self._held.get(lane, 0) + count
+        if held > 0:
+            self._held[lane] = held
+        else:
+            self._held.pop(lane, None)
+
+    async def promote_due(self) -> float:
+        """Move due delayed messages to their lanes; returns seconds until the next one is due"""
+        next_due = self.PROMOTE_INTERVAL
+        if self.redis:
+            for shard in self.shards.values():
+                for ptopic in await shard.smembers(self.DELAYED_TOPICS_KEY):
+                    topic = self._topic_of(ptopic)
+                    limits = self._partition_limits(topic) or {'max_depth': 0, 'max_bytes': 0}
+                    keys = self._partition_keys(ptopic, ptopic)
+                    moved, wait, full = await shard.eval(
+                        _PROMOTE, 1 + len(keys), f"queue:{ptopic}", *keys,
+                        ptopic, self.PROMOTE_BATCH, limits['max_depth'], limits['max_bytes'],
+                        time.time(), self.STATS_MARKS)
+                    wait = float(wait)
+                    if full:
+                        # Due messages wait for room; try again on the next regular pass
+                        continue
+                    if moved >= self.PROMOTE_BATCH:
+                        wait = 0.0
+                    if wait >= 0:
+                        next_due = min(next_due, wait)
+        else:
+            now = time.time()
+            due = {}
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, topic, lane, message = heapq.heappop(self._delayed)
+                due.setdefault((topic, lane), []).append(message)
+            for (topic, lane), messages in due.items():
+                # Already counted against the limits while delayed
+                self._hold(lane, -len(messages))
+                await self._produce_to_file(lane, *messages)
+                self._wake(lane)
+                self._record(topic, enqueued=len(messages))
+            if self._delayed:
+                next_due = min(next_due, self._delayed[0][0] - now)
+        return max(0.0, next_due)
+
+    async def _promote_loop(self):
+        """Promote delayed messages, sleeping until the next one is due"""
+        while True:
+            self._promote_wakeup.clear()
+            try:
+                wait = await self.promote_due()
+            except Exception as e:
+                print(f"[{self.node_id}] Delayed promotion failed: {e}")
+                wait = self.PROMOTE_INTERVAL
+            self._next_promote = time.time() + wait
+            try:
+                await asyncio.wait_for(self._promote_wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def consume(self, topic: str, count: Optional[int] = None, timeout: Optional[float] = None,
+                      consumer: Optional[str] = None):
+        """
+        Consume message from queue with error handling.
+        With count, up to count messages are popped at once and returned as a list.
+        With timeout, an empty topic blocks for up to timeout seconds instead of
+        returning nothing right away. With consumer, only the partitions
+        assigned to that consumer are read. Higher priority lanes are drained first.
+        """
         try:
+            lanes = self._lanes(topic, await self._candidates(topic, consumer))
+            if timeout:
+                timeout = min(timeout, self.MAX_BLOCK_TIMEOUT)
+            if not lanes:
+                # More consumers than partitions: this one idles for its wait
+                if timeout:
+                    await asyncio.sleep(timeout)
+                return None if count is None else []
+            blocking = timeout and timeout >= self.MIN_BLOCK_TIMEOUT
             if self.redis:
-                item = await self.redis.lpop(key)
-                return item if item else None
+                if blocking:
+                    result = await self._blocking_pop(lanes, count, timeout)
+                else:
+                    result = await self._pop(lanes, count)
+            elif blocking:
+                result = await self._wait_to_take(lanes, count, timeout)
             else:
-                return await self._consume_from_file(topic)
+                result = await self._pop_from_file(lanes, count)
+            # With Redis, pops are counted in the shared stats as they are made
+            if result and not self.redis:
+                self._record(topic, dequeued=1 if count is None else len(result))
+            return result
         except Exception as e:
             print(f"Error consuming message from {topic}: {e}")
+            return None if count is None else []
+
+    async def _pop(self, lanes: List[tuple], count: Optional[int]):
+        """Pop up to count messages (one without count), highest priority first, by counting script"""
+        want = count or 1
+        items = []
+        for ptopic, lane in lanes:
+            items += await self._shard(ptopic).eval(
+                _POP, 2, f"queue:{lane}", f"queue:{ptopic}:stats", want - len(items), time.time()) or []
+            if len(items) >= want:
+                break
+        if count is None:
+            return items[0] if items else None
+        return items
+
+    async def _blocking_pop(self, lanes: List[tuple], count: Optional[int], timeout: float):
+        """
+        _pop, parked on the lanes' watchers while they are empty. A blocking
+        pop cannot run inside the script that counts it, so the wait is a
+        peek and the pop stays atomic with its count.
+        """
+        return await self._wait_to_take(lanes, count, timeout, lambda: self._pop(lanes, count))
+
+    async def _pop_from_file(self, lanes: List[tuple], count: Optional[int]):
+        if count is None:
+            for _, lane in lanes:
+                item = await self._consume_from_file(lane)
+                if item:
+                    return item
+            return None
+        items = []
+        for _, lane in lanes:
+            items.extend(await self._consume_many_from_file(lane, count - len(items)))
+            if len(items) >= count:
+                break
+        return items
+
+    async def _wait_to_take(self, lanes: List[tuple], count: Optional[int], timeout: float, take=None):
+        """
+        Take from lanes, parking on their in-process waiters while there is
+        nothing, until timeout passes. take() does the actual pop (default:
+        _pop_from_file).
+        """
+        take = take or (lambda: self._pop_from_file(lanes, count))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            result = await take()
+            remaining = deadline - loop.time()
+            if result or remaining <= 0:
+                return result
+            # Every waiter is woken and they race for the messages; losers wait again
+            await self._park(lanes, remaining)
+
+    async def _park(self, lanes: List[tuple], timeout: float) -> bool:
+        """
+        Wait on lanes' in-process waiters until one is woken or timeout passes;
+        True if woken. With Redis, each lane gets a watcher task while anyone
+        waits on it.
+        """
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        for ptopic, lane in lanes:
+            self._waiters.setdefault(lane, set()).add(waiter)
+            if self.redis and lane not in self._watchers:
+                self._watchers[lane] = asyncio.ensure_future(self._watch(ptopic, lane))
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            for _, lane in lanes:
+                waiters = self._waiters.get(lane)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self._waiters[lane]
+
+    async def _watch(self, ptopic: str, lane: str):
+        """
+        Wake lane's waiters whenever it holds a message. Rotating the head onto
+        itself waits without taking anything, so one blocking connection per
+        watched lane serves every consumer parked on it.
+        """
+        shard = self._blocking_shard(self._shard_name(ptopic))
+        try:
+            while self._waiters.get(lane):
+                try:
+                    peeked = await shard.blmove(f"queue:{lane}", f"queue:{lane}", self.WATCH_SLICE,
+                                                'LEFT', 'LEFT')
+                except Exception as e:
+                    print(f"[{self.node_id}] Watching {lane} failed: {e}")
+                    await asyncio.sleep(self.WATCH_SLICE)
+                    continue
+                if peeked is not None:
+                    self._wake(lane)
+                    # Give the woken consumers a moment to take it before peeking again
+                    await asyncio.sleep(self.MIN_BLOCK_TIMEOUT)
+        finally:
+            self._watchers.pop(lane, None)
+
+    async def wait_for(self, topics: List[str], timeout: float, consumer: Optional[str] = None) -> bool:
+        """
+        Wait until one of topics may have a message for consumer (only its
+        assigned partitions count), or timeout passes; True if woken. Waiters on
+        the same lanes share one watcher, so any number of them cost at most a
+        blocking connection per lane. Woken waiters race for the messages.
+        """
+        timeout = min(timeout, self.MAX_BLOCK_TIMEOUT)
+        lanes = []
+        for topic in topics:
+            lanes += self._lanes(topic, await self._candidates(topic, consumer))
+        if not lanes:
+            await asyncio.sleep(timeout)
+            return False
+        return await self._park(lanes, timeout)
+
+    def _wake(self, lane: str):
+        for waiter in self._waiters.pop(lane, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def consume_reliable(self, topic: str, consumer: Optional[str] = None, count: Optional[int] = None,
+                               timeout: Optional[float] = None, visibility_timeout: Optional[float] = None):
+        """
+        At-least-once consume: each message is moved to the consumer's processing
+        list and returned with a receipt. It is redelivered unless acked within
+        the visibility timeout. Returns {'message', 'receipt'} (a list of them
+        with count), or None / [] when nothing arrived.
+        """
+        want = count or 1
+        visibility = visibility_timeout or self.visibility_timeout
+        try:
+            partitions = await self._candidates(topic, consumer)
+            if timeout:
+                timeout = min(timeout, self.MAX_BLOCK_TIMEOUT)
+            if not partitions:
+                if timeout:
+                    await asyncio.sleep(timeout)
+                deliveries = []
+            elif self.redis:
+                deliveries = await self._reliable_pop(topic, partitions, consumer or self.node_id,
+                                                      want, visibility, timeout)
+            else:
+                deliveries = await self._reliable_pop_from_file(topic, partitions, consumer or self.node_id,
+                                                                want, visibility, timeout)
+        except Exception as e:
+            print(f"Error consuming reliably from {topic}: {e}")
+            deliveries = []
+        if deliveries and not self.redis:
+            self._record(topic, dequeued=len(deliveries))
+        if count is None:
+            return deliveries[0] if deliveries else None
+        return deliveries
+
+    async def ack(self, topic: str, receipt: str) -> bool:
+        """Settle a delivery for good; False if the receipt is unknown or already redelivered"""
+        return await self._settle(topic, receipt, requeue=False)
+
+    async def nack(self, topic: str, receipt: str) -> bool:
+        """Return a delivery to the head of its topic for immediate redelivery"""
+        return await self._settle(topic, receipt, requeue=True)
+
+    def subscribe(self, topics: List[str], consumer: Optional[str] = None, reliable: bool = False,
+                  visibility_timeout: Optional[float] = None, credits: int = 0) -> 'QueueSubscription':
+        """Push-side state for a subscriber to topics; see QueueSubscription"""
+        return QueueSubscription(self, topics, consumer=consumer, reliable=reliable,
+                                 visibility_timeout=visibility_timeout, credits=credits)
+
+    async def redeliver_expired(self) -> int:
+        """Put deliveries whose visibility timeout passed back on their topics"""
+        redelivered = 0
+        if self.redis:
+            for shard in self.shards.values():
+                for ptopic in await shard.smembers(self.RELIABLE_TOPICS_KEY):
+                    keys = self._reliable_keys(ptopic)
+                    # The earliest deadlines; the script redelivers those that passed
+                    receipts, lists = [], []
+                    for receipt in await shard.zrange(keys['deadlines'], 0, self.REDELIVERY_BATCH - 1):
+                        delivery = self._receipt_keys(ptopic, receipt)
+                        if delivery is not None:
+                            receipts.append(receipt)
+                            lists += [delivery['lane'], delivery['processing']]
+                    redelivered += await shard.eval(
+                        _RELIABLE_REDELIVER, 4 + len(lists), keys['deadlines'], keys['inflight'],
+                        self.RELIABLE_TOPICS_KEY, f"queue:{ptopic}:stats", *lists, ptopic, *receipts)
+        else:
+            now = time.time()
+            expired = {}
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, receipt = heapq.heappop(self._deadlines)
+                delivery = self._inflight.pop(receipt, None)
+                if delivery is not None:
+                    self._hold(delivery[1], -1)
+                    expired.setdefault(delivery[1], []).append(delivery[2])
+            for lane, messages in expired.items():
+                await self._requeue_local(lane, messages)
+                redelivered += len(messages)
+        self.metrics['redelivered'] += redelivered
+        return redelivered
+
+    async def _redelivery_loop(self):
+        """Scan the deadline index and redeliver expired deliveries"""
+        while True:
+            await asyncio.sleep(self.REDELIVERY_INTERVAL)
+            try:
+                await self.redeliver_expired()
+            except Exception as e:
+                print(f"[{self.node_id}] Redelivery scan failed: {e}")
+
+    def _reliable_keys(self, ptopic: str, consumer: Optional[str] = None) -> Dict[str, str]:
+        key = f"queue:{ptopic}"
+        keys = {'queue': key, 'deadlines': f"{key}:deadlines", 'inflight': f"{key}:inflight"}
+        if consumer is not None:
+            keys['processing'] = f"{key}:processing:{consumer}"
+        return keys
+
+    def _new_receipt(self, partition: int, priority: int, consumer: str) -> str:
+        # Partition, lane and consumer travel in the receipt so ack/nack and
+        # redelivery can name every list they touch up front
+        return f"{partition}-{priority}-{uuid.uuid4().hex}-{consumer}"
+
+    def _parse_receipt(self, receipt: str) -> Optional[tuple]:
+        """(partition, priority, consumer) of a receipt, or None if it is not one of ours"""
+        parts = receipt.split('-', 3)
+        if len(parts) < 4 or not (parts[0].isdigit() and parts[1].isdigit()):
+            return None
+        partition, priority = int(parts[0]), int(parts[1])
+        if partition >= self.partitions or priority >= self.priority_levels:
+            return None
+        return partition, priority, parts[3]
+
+    def _receipt_keys(self, ptopic: str, receipt: str) -> Optional[Dict[str, str]]:
+        """Reliable keys of ptopic plus the lane and processing list of receipt's delivery"""
+        parsed = self._parse_receipt(receipt)
+        if parsed is None:
+            return None
+        _, priority, consumer = parsed
+        keys = self._reliable_keys(ptopic, consumer)
+        keys['lane'] = f"queue:{self._lane(ptopic, priority)}"
+        return keys
+
+    async def _reliable_take(self, ptopic: str, lane: str, partition: int, priority: int, consumer: str,
+                             count: int, visibility: float) -> List[dict]:
+        keys = self._reliable_keys(ptopic, consumer)
+        receipts = [self._new_receipt(partition, priority, consumer) for _ in range(count)]
+        out = await self._shard(ptopic).eval(
+            _RELIABLE_CONSUME, 6, f"queue:{lane}", keys['processing'], keys['deadlines'],
+            keys['inflight'], self.RELIABLE_TOPICS_KEY, f"queue:{ptopic}:stats",
+            ptopic, visibility, time.time(), *receipts)
+        return [{'receipt': out[i], 'message': out[i + 1]} for i in range(0, len(out or []), 2)]
+
+    def _reliable_lanes(self, topic: str, partitions: List[int]) -> List[tuple]:
+        """(partition topic, lane, partition, priority) of partitions' lanes, highest priority first"""
+        index = {self.partition_topic(topic, p): p for p in partitions}
+        return [(ptopic, self._lane(ptopic, priority), index[ptopic], priority)
+                for priority in reversed(range(self.priority_levels)) for ptopic in index]
+
+    async def _reliable_pop(self, topic: str, partitions: List[int], consumer: str, count: int,
+                            visibility: float, timeout: Optional[float]) -> List[dict]:
+        lanes = self._reliable_lanes(topic, partitions)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or 0)
+        rounds = 0
+        while True:
+            deliveries = []
+            for ptopic, lane, partition, priority in lanes:
+                deliveries += await self._reliable_take(ptopic, lane, partition, priority, consumer,
+                                                        count - len(deliveries), visibility)
+                if len(deliveries) >= count:
+                    break
+            remaining = deadline - loop.time()
+            if deliveries or remaining < self.MIN_BLOCK_TIMEOUT:
+                return deliveries
+            # Blocking peek: rotating the head onto itself waits for a message without
+            # taking it, so nothing is ever popped outside the atomic script above.
+            # Several lanes are peeked in turn, BLOCK_SLICE seconds each.
+            ptopic, lane, _, _ = lanes[rounds % len(lanes)]
+            rounds += 1
+            wait = remaining if len(lanes) == 1 else min(remaining, self.BLOCK_SLICE)
+            peeked = await self._blocking_shard(self._shard_name(ptopic)).blmove(
+                f"queue:{lane}", f"queue:{lane}", wait, 'LEFT', 'LEFT')
+            if peeked is None and len(lanes) == 1:
+                return []
+
+    async def _reliable_pop_from_file(self, topic: str, partitions: List[int], consumer: str, count: int,
+                                      visibility: float, timeout: Optional[float]) -> List[dict]:
+        lanes = self._reliable_lanes(topic, partitions)
+
+        async def take():
+            taken = []
+            for ptopic, lane, partition, priority in lanes:
+                for message in await self._consume_many_from_file(lane, count - len(taken)):
+                    taken.append((partition, priority, ptopic, lane, message))
+                if len(taken) >= count:
+                    break
+            return taken
+
+        if timeout:
+            taken = await self._wait_to_take([(ptopic, lane) for ptopic, lane, _, _ in lanes], count, timeout, take)
+        else:
+            taken = await take()
+        deadline = time.time() + visibility
+        deliveries = []
+        for partition, priority, ptopic, lane, message in taken:
+            receipt = self._new_receipt(partition, priority, consumer)
+            self._inflight[receipt] = (ptopic, lane, message)
+            self._hold(lane, 1)
+            heapq.heappush(self._deadlines, (deadline, receipt))
+            deliveries.append({'receipt': receipt, 'message': message})
+        return deliveries
+
+    async def _settle(self, topic: str, receipt: str, requeue: bool) -> bool:
+        parsed = self._parse_receipt(receipt)
+        if parsed is None:
+            return False
+        ptopic = self.partition_topic(topic, parsed[0])
+        try:
+            if self.redis:
+                keys = self._receipt_keys(ptopic, receipt)
+                settled = bool(await self._shard(ptopic).eval(
+                    _RELIABLE_SETTLE, 5, keys['lane'], keys['processing'], keys['deadlines'], keys['inflight'],
+                    f"queue:{ptopic}:stats", receipt, '1' if requeue else '0'))
+            else:
+                # The heap entry is left behind and skipped once its deadline comes up
+                delivery = self._inflight.get(receipt)
+                settled = delivery is not None and delivery[0] == ptopic
+                if settled:
+                    del self._inflight[receipt]
+                    self._hold(delivery[1], -1)
+                    if requeue:
+                        await self._requeue_local(delivery[1], [delivery[2]])
+        except Exception as e:
+            print(f"Error settling delivery {receipt} on {topic}: {e}")
+            return False
+        if settled:
+            self.metrics['nacked' if requeue else 'acked'] += 1
+        return settled
+
+    # Stream topics: one Redis stream per topic, read by any number of named
+    # consumer groups, each with its own offset and pending-entry list. They
+    # need Redis; without it these methods return None.
+
+    def _stream(self, topic: str):
+        key = f"stream:{topic}"
+        return key, self._shard_name(key)
+
+    async def publish(self, topic: str, messages: List[str]) -> Optional[List[str]]:
+        """Append messages to the topic's stream (one pipelined XADD each) and return their ids"""
+        if not self.redis:
+            return None
+        key, shard = self._stream(topic)
+        self._stream_topics.add(topic)
+        pipe = self.shards[shard].pipeline(transaction=False)
+        for message in messages:
+            pipe.xadd(key, {'message': message}, maxlen=self.stream_maxlen, approximate=True)
+        return await pipe.execute()
+
+    async def _ensure_group(self, key: str, shard: str, group: str, start: str = '0'):
+        # New groups start from the oldest retained entry, so nothing published earlier is missed
+        if (key, group) in self._stream_groups:
+            return
+        try:
+            await self.shards[shard].xgroup_create(key, group, id=start, mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._stream_groups.add((key, group))
+
+    async def read_group(self, topic: str, group: str, consumer: str, count: int = 1,
+                         timeout: Optional[float] = None) -> Optional[List[dict]]:
+        """
+        Deliver entries not yet seen by group (XREADGROUP '>'), creating the
+        group on first use. Entries stay pending for consumer until acked.
+        """
+        if not self.redis:
             return None
+        key, shard = self._stream(topic)
+        block = None
+        if timeout and timeout >= self.MIN_BLOCK_TIMEOUT:
+            block = int(min(timeout, self.MAX_BLOCK_TIMEOUT) * 1000)
+        client = self._blocking_shard(shard) if block else self.shards[shard]
+        self._stream_topics.add(topic)
+        await self._ensure_group(key, shard, group)
+        try:
+            result = await client.xreadgroup(group, consumer, {key: '>'}, count=count, block=block)
+        except ResponseError as e:
+            if 'NOGROUP' not in str(e):
+                raise
+            # The group was removed behind our back: recreate it and read again
+            self._stream_groups.discard((key, group))
+            await self._ensure_group(key, shard, group)
+            result = await client.xreadgroup(group, consumer, {key: '>'}, count=count, block=block)
+        return [self._entry(entry) for _, entries in result or [] for entry in entries]
+
+    async def ack_group(self, topic: str, group: str, ids: List[str]) -> Optional[int]:
+        """XACK entries for group; returns how many were still pending"""
+        if not self.redis:
+            return None
+        key, shard = self._stream(topic)
+        return await self.shards[shard].xack(key, group, *ids)
+
+    async def claim_pending(self, topic: str, group: str, consumer: str, min_idle: float,
+                            count: int = 100) -> Optional[List[dict]]:
+        """Take over entries pending in group for at least min_idle seconds (XAUTOCLAIM)"""
+        if not self.redis:
+            return None
+        key, shard = self._stream(topic)
+        result = await self.shards[shard].xautoclaim(
+            key, group, consumer, int(min_idle * 1000), start_id='0-0', count=count)
+        return [self._entry(entry) for entry in result[1] if entry[1] is not None]
 
-    async def _produce_to_file(self, topic: str, message: str):
-        """Produce message to file (fallback mode)"""
-        p = f"/tmp/{topic}.queue"
+    async def seek_group(self, topic: str, group: str, offset: str) -> Optional[bool]:
+        """
+        Move group's offset: the next read returns entries after offset
+        ('0' replays everything retained, '$' skips to new entries).
+        """
+        if not self.redis:
+            return None
+        key, shard = self._stream(topic)
+        if (key, group) not in self._stream_groups:
+            await self._ensure_group(key, shard, group, start=offset)
+        await self.shards[shard].xgroup_setid(key, group, offset)
+        return True
+
+    async def stream_groups(self, topic: str) -> Optional[List[dict]]:
+        """Offset, pending count and lag of every group on the topic's stream"""
+        if not self.redis:
+            return None
+        key, shard = self._stream(topic)
+        try:
+            groups = await self.shards[shard].xinfo_groups(key)
+        except ResponseError:
+            # No such stream yet
+            return []
+        return [{
+            'group': g['name'],
+            'consumers': g['consumers'],
+            'pending': g['pending'],
+            'last_delivered_id': g['last-delivered-id'],
+            'lag': g.get('lag')
+        } for g in groups]
+
+    @staticmethod
+    def _entry(entry) -> dict:
+        entry_id, fields = entry
+        return {'id': entry_id, 'message': fields.get('message')}
+
+    def _log(self, ptopic: str) -> SegmentedLog:
+        """Segmented log backing ptopic in fallback mode, opened on first use"""
+        log = self._logs.get(ptopic)
+        if log is None:
+            log = self._logs[ptopic] = SegmentedLog(
+                os.path.join(self.data_dir, f"{ptopic}.log"), self.segment_bytes)
+            # Carry over a backlog left in the old one-line-per-message file
+            legacy = os.path.join(self.data_dir, f"{ptopic}.queue")
+            if os.path.exists(legacy):
+                with open(legacy, "r", encoding='utf-8') as f:
+                    lines = [line.rstrip("\n") for line in f]
+                if lines:
+                    log.append(lines)
+                os.remove(legacy)
+        return log
+
+    async def _produce_to_file(self, topic: str, *messages: str):
+        """Produce messages to the topic's segmented log (fallback mode)"""
         async with self._lock:
-            async with aiofiles.open(p, "a", encoding='utf-8') as f:
-                await f.write(message + "\n")
+            self._log(topic).append(messages)
+
+    async def _requeue_local(self, topic: str, messages: List[str]):
+        """
+        Put messages back in front of the topic (fallback mode). The log is
+        append-only, so they wait in memory, as they did while in flight.
+        """
+        self._requeued.setdefault(topic, deque()).extendleft(reversed(messages))
+        self._wake(topic)
 
     async def _consume_from_file(self, topic: str) -> Optional[str]:
-        """Consume message from file (fallback mode)"""
-        p = f"/tmp/{topic}.queue"
-        if not os.path.exists(p):
-            return None
-        
+        """Consume message from the topic's log (fallback mode)"""
+        items = await self._consume_many_from_file(topic, 1)
+        return items[0] if items else None
+
+    async def _consume_many_from_file(self, topic: str, count: int) -> List[str]:
+        """Consume up to count messages, requeued ones first (fallback mode)"""
         async with self._lock:
-            async with aiofiles.open(p, "r", encoding='utf-8') as f:
-                lines = await f.readlines()
-            
-            if not lines:
-                return None
-            
-            first = lines[0].strip()
-            
-            async with aiofiles.open(p, "w", encoding='utf-8') as f:
-                await f.writelines(lines[1:])
-            
-            return first
+            items = []
+            requeued = self._requeued.get(topic)
+            while requeued and len(items) < count:
+                items.append(requeued.popleft())
+            if len(items) < count:
+                items.extend(self._log(topic).read(count - len(items)))
+            return items
 
     async def get_queue_length(self, topic: str) -> int:
-        """Get current queue length"""
-        key = f"queue:{topic}"
+        """Get current queue length (ready messages), summed over partitions and priorities"""
+        total = 0
         try:
-            if self.redis:
-                return await self.redis.llen(key)
-            else:
-                p = f"/tmp/{topic}.queue"
-                if not os.path.exists(p):
-                    return 0
-                async with aiofiles.open(p, "r", encoding='utf-8') as f:
-                    lines = await f.readlines()
-                return len(lines)
+            for ptopic, lane in self._lanes(topic, range(self.partitions)):
+                if self.redis:
+                    total += await self._shard(ptopic).llen(f"queue:{lane}")
+                else:
+                    # O(1): the log knows its head and tail offsets
+                    total += len(self._log(lane)) + len(self._requeued.get(lane, ()))
+            return total
         except Exception as e:
             print(f"Error getting queue length for {topic}: {e}")
             return 0
+
+    def _record(self, topic: str, enqueued: int = 0, dequeued: int = 0, dropped: int = 0, rejected: int = 0,
+                over_limit: int = 0):
+        """Fallback-mode accounting behind stats(): totals, rates and enqueue-time marks"""
+        stats = self._topic_stats.get(topic)
+        if stats is None:
+            stats = self._topic_stats[topic] = {
+                'enqueued': 0, 'dequeued': 0, 'dropped': 0, 'rejected': 0, 'over_limit': 0,
+                'enqueue_rate': RateCounter(), 'dequeue_rate': RateCounter(),
+                'marks': deque(maxlen=self.STATS_MARKS)}
+        now = time.time()
+        if enqueued:
+            stats['enqueued'] += enqueued
+            stats['enqueue_rate'].add(enqueued, now)
+            marks = stats['marks']
+            # A mark is (enqueued total, time of the first enqueue it covers); one per second
+            if marks and now - marks[-1][1] < 1.0:
+                marks[-1] = (stats['enqueued'], marks[-1][1])
+            else:
+                marks.append((stats['enqueued'], now))
+        if dequeued:
+            stats['dequeued'] += dequeued
+            stats['dequeue_rate'].add(dequeued, now)
+        # Messages dropped by drop_oldest never reach a consumer but did leave the queue
+        stats['dropped'] += dropped
+        stats['rejected'] += rejected
+        stats['over_limit'] += over_limit
+
+    async def _stats_topics(self) -> Set[str]:
+        if not self.redis:
+            return set(self._topic_stats)
+        topics = set()
+        for shard in self.shards.values():
+            topics.update(self._topic_of(ptopic) for ptopic in await shard.smembers(self.STATS_TOPICS_KEY))
+        return topics
+
+    async def _shared_stats(self, topic: str, now: float) -> dict:
+        """
+        topic's totals, rates and oldest-message age from the stats its
+        partitions keep in Redis. Rates blend the current and previous
+        minute's buckets into a sliding 60 second window.
+        """
+        entry = {'enqueued': 0, 'dequeued': 0, 'dropped': 0, 'rejected': 0, 'over_limit': 0,
+                 'enqueue_rate': 0.0, 'dequeue_rate': 0.0, 'oldest_age_seconds': None}
+        minute = int(now // 60)
+        previous = 1 - (now % 60) / 60
+        for partition in range(self.partitions):
+            ptopic = self.partition_topic(topic, partition)
+            shard = self._shard(ptopic)
+            key = f"queue:{ptopic}:stats"
+            counters = await shard.hgetall(key)
+            if not counters:
+                continue
+            for field in ('enqueued', 'dequeued', 'dropped', 'rejected', 'over_limit'):
+                entry[field] += int(counters.get(field, 0))
+            for prefix, rate in (('e', 'enqueue_rate'), ('d', 'dequeue_rate')):
+                entry[rate] += (int(counters.get(f"{prefix}{minute}", 0))
+                                + int(counters.get(f"{prefix}{minute - 1}", 0)) * previous) / 60
+            # Only the last two minutes are read; whichever node reads first drops the rest
+            stale = [f for f in counters if f[1:].isdigit() and int(f[1:]) < minute - 1]
+            if stale:
+                await shard.hdel(key, *stale)
+            for priority in range(self.priority_levels):
+                lane = f"queue:{self._lane(ptopic, priority)}"
+                if not await shard.llen(lane):
+                    continue
+                # Next in line is the lane's message number out + 1, unless messages were put
+                # back at the head: they are older still, the last one taken is the best known
+                head = int(counters.get(f"out:{lane}", 0))
+                if not int(counters.get(f"back:{lane}", 0)):
+                    head += 1
+                mark = await shard.zrangebyscore(f"{lane}:marks", head, '+inf', start=0, num=1)
+                if mark:
+                    age = now - float(mark[0])
+                    entry['oldest_age_seconds'] = max(entry['oldest_age_seconds'] or 0.0, age)
+        return entry
+
+    async def stats(self, topic: Optional[str] = None) -> Dict[str, dict]:
+        """
+        Depth, totals, enqueue/dequeue rates (per second over the last minute),
+        oldest-message age and, for stream topics, consumer group lag; for topic,
+        or every topic with stats. Depth is LLEN per lane (O(1)) plus what this
+        node has spilled to disk. With Redis the rest comes from the per-partition
+        stats the queue scripts keep there, so every node reports the same
+        cluster-wide figures; in fallback mode from this node's own counters.
+        """
+        topics = [topic] if topic else sorted(await self._stats_topics() | self._stream_topics)
+        now = time.time()
+        result = {}
+        for name in topics:
+            spilled = sum(len(log) for topic_name, _, log in self._spills.values() if topic_name == name)
+            depth = await self.get_queue_length(name) + spilled
+            entry = {'depth': depth, 'spilled': spilled, 'enqueued': 0, 'dequeued': 0, 'dropped': 0,
+                     'rejected': 0, 'over_limit': 0, 'enqueue_rate': 0.0, 'dequeue_rate': 0.0,
+                     'oldest_age_seconds': None}
+            stats = self._topic_stats.get(name)
+            if self.redis:
+                entry.update(await self._shared_stats(name, now))
+            elif stats is not None:
+                entry.update(enqueued=stats['enqueued'], dequeued=stats['dequeued'],
+                             dropped=stats['dropped'], rejected=stats['rejected'], over_limit=stats['over_limit'],
+                             enqueue_rate=stats['enqueue_rate'].rate(now),
+                             dequeue_rate=stats['dequeue_rate'].rate(now))
+                # The oldest waiting message is number enqueued - depth; drop marks consumed past it
+                head = stats['enqueued'] - depth
+                marks = stats['marks']
+                while marks and marks[0][0] <= head:
+                    marks.popleft()
+                if depth == 0:
+                    entry['oldest_age_seconds'] = 0.0
+                elif marks:
+                    entry['oldest_age_seconds'] = now - marks[0][1]
+            if self.redis and depth == 0:
+                entry['oldest_age_seconds'] = 0.0
+            if self.redis and (topic or name in self._stream_topics):
+                entry['groups'] = await self.stream_groups(name)
+            result[name] = entry
+        return result
+
+
+class QueueSubscription:
+    """
+    One push subscriber: its topics, the credits its client has granted (one
+    per message pushed) and, in reliable mode, the receipts it has not settled
+    yet. Messages are only fetched while credit is left, so a slow client
+    leaves them in the queue instead of in socket buffers.
+    """
+
+    # Longest single wait in next_batch, so a closed connection is noticed quickly
+    WAIT = 1.0
+    MAX_BATCH = 100
+
+    def __init__(self, queue: DistributedQueue, topics: List[str], consumer: Optional[str] = None,
+                 reliable: bool = False, visibility_timeout: Optional[float] = None, credits: int = 0):
+        self.queue = queue
+        self.topics = list(dict.fromkeys(topics))
+        self.consumer = consumer
+        self.reliable = reliable
+        self.visibility_timeout = visibility_timeout
+        self.credits = 0
+        self._credit = asyncio.Event()
+        # receipt -> topic for reliable deliveries awaiting ack/nack
+        self.pending: Dict[str, str] = {}
+        self._next_topic = 0
+        if credits:
+            self.grant(credits)
+
+    def grant(self, credits: int):
+        self.credits += credits
+        self._credit.set()
+
+    async def next_batch(self, wait: Optional[float] = None) -> List[dict]:
+        """
+        Wait up to wait seconds for credit, then for messages, and return up to
+        credits of them as {'topic', 'message'} (plus 'receipt' when reliable).
+        The topics are swept without blocking, starting at a rotating one; while
+        all are empty the subscriber parks on the queue's shared waiters for
+        every topic at once instead of blocking on a Redis connection itself.
+        """
+        wait = self.WAIT if wait is None else wait
+        try:
+            await asyncio.wait_for(self._credit.wait(), wait)
+        except asyncio.TimeoutError:
+            return []
+        want = min(self.credits, self.MAX_BATCH)
+        start = self._next_topic % len(self.topics)
+        self._next_topic += 1
+        topics = self.topics[start:] + self.topics[:start]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while True:
+            batch = []
+            for topic in topics:
+                batch += await self._fetch(topic, want - len(batch))
+                if len(batch) >= want:
+                    break
+            remaining = deadline - loop.time()
+            if batch or remaining < self.queue.MIN_BLOCK_TIMEOUT:
+                break
+            if not await self.queue.wait_for(self.topics, remaining, consumer=self.consumer):
+                break
+        self.credits -= len(batch)
+        if self.credits <= 0:
+            self._credit.clear()
+        return batch
+
+    async def _fetch(self, topic: str, count: int) -> List[dict]:
+        if self.reliable:
+            deliveries = await self.queue.consume_reliable(topic, consumer=self.consumer, count=count,
+                                                           visibility_timeout=self.visibility_timeout)
+            for delivery in deliveries:
+                self.pending[delivery['receipt']] = topic
+            return [{'topic': topic, **delivery} for delivery in deliveries]
+        messages = await self.queue.consume(topic, count=count, consumer=self.consumer)
+        return [{'topic': topic, 'message': message} for message in messages or []]
+
+    async def settle(self, receipt: str, requeue: bool = False) -> bool:
+        """Ack (or nack with requeue) a delivery made to this subscriber"""
+        topic = self.pending.pop(receipt, None)
+        if topic is None:
+            return False
+        if requeue:
+            return await self.queue.nack(topic, receipt)
+        return await self.queue.ack(topic, receipt)
+
+    async def close(self):
+        """Nack whatever is still unsettled so it is redelivered right away"""
+        for receipt in list(self.pending):
+            await self.settle(receipt, requeue=True)
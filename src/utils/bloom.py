@@ -0,0 +1,96 @@
+import base64
+import hashlib
+import math
+from typing import Dict, Iterable, List
+
+def _bit_indexes(key: str, num_bits: int, num_hashes: int) -> List[int]:
+    # Stable across processes (unlike hash()), since digests travel between nodes
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % num_bits for i in range(num_hashes)]
+
+def optimal_params(expected_items: int, fp_rate: float = 0.01):
+    """Number of bits (multiple of 8) and hash functions for a target false-positive rate"""
+    expected_items = max(1, expected_items)
+    num_bits = int(-expected_items * math.log(fp_rate) / (math.log(2) ** 2))
+    num_bits = max(64, (num_bits + 7) // 8 * 8)
+    num_hashes = max(1, round(num_bits / expected_items * math.log(2)))
+    return num_bits, num_hashes
+
+class BloomFilter:
+    """Plain bit-array Bloom filter; the wire form of a node's key digest"""
+
+    def __init__(self, num_bits: int, num_hashes: int, bits: bytes = None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray(num_bits // 8)
+
+    def add(self, key: str):
+        for i in _bit_indexes(key, self.num_bits, self.num_hashes):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[i >> 3] & (1 << (i & 7))
+                   for i in _bit_indexes(key, self.num_bits, self.num_hashes))
+
+    def apply_delta(self, delta: Dict[int, int]):
+        for byte_index, value in delta.items():
+            self.bits[int(byte_index)] = value
+
+    def to_dict(self) -> dict:
+        return {
+            'num_bits': self.num_bits,
+            'num_hashes': self.num_hashes,
+            'bits': base64.b64encode(bytes(self.bits)).decode('ascii')
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BloomFilter':
+        return cls(data['num_bits'], data['num_hashes'], base64.b64decode(data['bits']))
+
+class CountingBloomFilter:
+    """
+    Bloom filter with 8-bit counters so keys can be removed again.
+    The bit-array form is maintained alongside the counters, and the bytes
+    whose bits flipped are tracked so peers can be sent only what changed.
+    """
+
+    def __init__(self, num_bits: int, num_hashes: int):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.counters = bytearray(num_bits)
+        self.bits = bytearray(num_bits // 8)
+        self.dirty = set()
+
+    def add(self, key: str):
+        counters = self.counters
+        for i in _bit_indexes(key, self.num_bits, self.num_hashes):
+            if counters[i] == 0:
+                self.bits[i >> 3] |= 1 << (i & 7)
+                self.dirty.add(i >> 3)
+            if counters[i] < 255:
+                counters[i] += 1
+
+    def remove(self, key: str):
+        counters = self.counters
+        for i in _bit_indexes(key, self.num_bits, self.num_hashes):
+            # A saturated counter no longer knows its true count, so it stays set
+            if 0 < counters[i] < 255:
+                counters[i] -= 1
+                if counters[i] == 0:
+                    self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+                    self.dirty.add(i >> 3)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.counters[i] for i in _bit_indexes(key, self.num_bits, self.num_hashes))
+
+    def take_dirty(self) -> set:
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def delta(self, byte_indexes: Iterable[int]) -> Dict[int, int]:
+        return {b: self.bits[b] for b in byte_indexes}
+
+    def snapshot(self) -> BloomFilter:
+        return BloomFilter(self.num_bits, self.num_hashes, self.bits)
@@ -0,0 +1,460 @@
+from collections import OrderedDict
+from itertools import chain, islice
+from typing import Dict, List, Optional
+
+class Link:
+    """
+    Intrusive list node. CacheEntry subclasses it, so a policy's lists thread
+    through the cache lines themselves instead of a second per-key hash.
+    """
+    __slots__ = ('key', 'prev', 'next', 'owner')
+
+    def __init__(self, key=None):
+        self.key = key
+        self.prev = None
+        self.next = None
+        # The LinkedList currently holding this link, None when unlinked
+        self.owner = None
+
+class LinkedList:
+    """Doubly linked list of Links around a sentinel; the front is the LRU end"""
+    __slots__ = ('root', 'size', 'freq')
+
+    def __init__(self, freq: int = 0):
+        root = self.root = Link()
+        root.prev = root.next = root
+        self.size = 0
+        # Frequency of every link in the list (LFU buckets only)
+        self.freq = freq
+
+    def __len__(self):
+        return self.size
+
+    def append(self, link: Link):
+        root = self.root
+        last = root.prev
+        link.prev = last
+        link.next = root
+        last.next = link
+        root.prev = link
+        link.owner = self
+        self.size += 1
+
+    def unlink(self, link: Link):
+        link.prev.next = link.next
+        link.next.prev = link.prev
+        link.prev = link.next = link.owner = None
+        self.size -= 1
+
+    def move_to_end(self, link: Link):
+        self.unlink(link)
+        self.append(link)
+
+    def first(self) -> Optional[Link]:
+        link = self.root.next
+        return None if link is self.root else link
+
+    def popleft(self) -> Optional[Link]:
+        link = self.first()
+        if link is not None:
+            self.unlink(link)
+        return link
+
+    def keys_mru(self):
+        """Keys from the most to the least recently used end"""
+        link = self.root.prev
+        while link is not self.root:
+            yield link.key
+            link = link.prev
+
+class EvictionPolicy:
+    """
+    Base class for cache eviction policies.
+    A policy only tracks key ordering/frequency; CacheNode owns the values and
+    decides when it is over capacity, then asks the policy for a victim.
+    Given the cache's entry dict, the policy links the entries (Links) into
+    its lists directly; without one it keeps its own Links, keyed by key.
+    """
+    name = None
+
+    def __init__(self, capacity_hint: Optional[int] = None, entries: Optional[Dict] = None):
+        self.capacity_hint = capacity_hint
+        self._owned = entries is None
+        self._entries = {} if entries is None else entries
+
+    def _link(self, key, create=False) -> Optional[Link]:
+        link = self._entries.get(key)
+        if link is None and create and self._owned:
+            link = self._entries[key] = Link(key)
+        return link
+
+    def _release(self, link: Link) -> object:
+        """Key of a link that left the policy, dropping it if the policy owns it"""
+        if self._owned:
+            self._entries.pop(link.key, None)
+        return link.key
+
+    def record_insert(self, key):
+        raise NotImplementedError
+
+    def record_access(self, key):
+        raise NotImplementedError
+
+    def remove(self, key):
+        raise NotImplementedError
+
+    def victim(self):
+        """Pick and forget the next key to evict, or None if empty"""
+        raise NotImplementedError
+
+    def hot_keys(self, n: int) -> List:
+        """Up to n resident keys, the ones the policy would evict last first"""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+class LRUPolicy(EvictionPolicy):
+    name = 'lru'
+
+    def __init__(self, capacity_hint=None, entries=None):
+        super().__init__(capacity_hint, entries)
+        self._order = LinkedList()
+
+    def record_insert(self, key):
+        link = self._link(key, create=True)
+        if link.owner is not None:
+            link.owner.unlink(link)
+        self._order.append(link)
+
+    def record_access(self, key):
+        link = self._link(key)
+        if link is not None and link.owner is self._order:
+            self._order.move_to_end(link)
+
+    def remove(self, key):
+        link = self._link(key)
+        if link is not None and link.owner is self._order:
+            self._order.unlink(link)
+            self._release(link)
+
+    def victim(self):
+        link = self._order.popleft()
+        return None if link is None else self._release(link)
+
+    def hot_keys(self, n):
+        return list(islice(self._order.keys_mru(), n))
+
+    def __len__(self):
+        return len(self._order)
+
+class LFUPolicy(EvictionPolicy):
+    """O(1) LFU: frequency buckets, LRU order inside each bucket"""
+    name = 'lfu'
+
+    def __init__(self, capacity_hint=None, entries=None):
+        super().__init__(capacity_hint, entries)
+        self._buckets: Dict[int, LinkedList] = {}
+        self._min_freq = 0
+        self._size = 0
+
+    def _add(self, link, freq):
+        bucket = self._buckets.get(freq)
+        if bucket is None:
+            bucket = self._buckets[freq] = LinkedList(freq)
+        bucket.append(link)
+
+    def _take(self, link) -> int:
+        bucket = link.owner
+        bucket.unlink(link)
+        if not bucket:
+            del self._buckets[bucket.freq]
+            if self._min_freq == bucket.freq:
+                self._min_freq = bucket.freq + 1
+        return bucket.freq
+
+    def _resident(self, link) -> bool:
+        return link is not None and link.owner is not None
+
+    def record_insert(self, key):
+        link = self._link(key, create=True)
+        if self._resident(link):
+            self._add(link, self._take(link) + 1)
+            return
+        self._add(link, 1)
+        self._size += 1
+        self._min_freq = 1
+
+    def record_access(self, key):
+        link = self._link(key)
+        if self._resident(link):
+            self._add(link, self._take(link) + 1)
+
+    def remove(self, key):
+        link = self._link(key)
+        if not self._resident(link):
+            return
+        freq = link.owner.freq
+        link.owner.unlink(link)
+        if not self._buckets[freq]:
+            del self._buckets[freq]
+        self._size -= 1
+        self._release(link)
+
+    def victim(self):
+        if not self._size:
+            return None
+        if self._min_freq not in self._buckets:
+            self._min_freq = min(self._buckets)
+        bucket = self._buckets[self._min_freq]
+        link = bucket.popleft()
+        if not bucket:
+            del self._buckets[self._min_freq]
+        self._size -= 1
+        return self._release(link)
+
+    def hot_keys(self, n):
+        buckets = (self._buckets[freq].keys_mru() for freq in sorted(self._buckets, reverse=True))
+        return list(islice(chain.from_iterable(buckets), n))
+
+    def __len__(self):
+        return self._size
+
+class ARCPolicy(EvictionPolicy):
+    """
+    Adaptive Replacement Cache (Megiddo & Modha).
+    T1/T2 hold resident keys seen once/more than once, B1/B2 are ghost lists of
+    recently evicted keys used to adapt the recency/frequency split `p`.
+    Capacity is counted in resident entries at eviction time, so the policy
+    works with both entry- and byte-bounded caches. Only the ghosts, which
+    have no cache line to link through, are kept in dicts of their own.
+    """
+    name = 'arc'
+
+    def __init__(self, capacity_hint=None, entries=None):
+        super().__init__(capacity_hint, entries)
+        self.t1 = LinkedList()
+        self.t2 = LinkedList()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.p = 0.0
+
+    def record_insert(self, key):
+        link = self._link(key, create=True)
+        if link.owner is self.t1 or link.owner is self.t2:
+            self.record_access(key)
+            return
+        c = max(len(self), 1)
+        if key in self.b1:
+            self.p = min(c, self.p + max(len(self.b2) / len(self.b1), 1))
+            del self.b1[key]
+            self.t2.append(link)
+        elif key in self.b2:
+            self.p = max(0.0, self.p - max(len(self.b1) / len(self.b2), 1))
+            del self.b2[key]
+            self.t2.append(link)
+        else:
+            self.t1.append(link)
+
+    def record_access(self, key):
+        link = self._link(key)
+        if link is None:
+            return
+        if link.owner is self.t1:
+            self.t1.unlink(link)
+            self.t2.append(link)
+        elif link.owner is self.t2:
+            self.t2.move_to_end(link)
+
+    def remove(self, key):
+        link = self._link(key)
+        if link is not None and (link.owner is self.t1 or link.owner is self.t2):
+            link.owner.unlink(link)
+            self._release(link)
+
+    def victim(self):
+        if self.t1 and (len(self.t1) > self.p or not self.t2):
+            key = self._release(self.t1.popleft())
+            self.b1[key] = None
+        elif self.t2:
+            key = self._release(self.t2.popleft())
+            self.b2[key] = None
+        else:
+            return None
+        self._trim_ghosts()
+        return key
+
+    def _trim_ghosts(self):
+        # Ghost history never exceeds the resident set size
+        limit = max(len(self), 1)
+        while len(self.b1) + len(self.b2) > limit:
+            if len(self.b1) >= len(self.b2):
+                self.b1.popitem(last=False)
+            else:
+                self.b2.popitem(last=False)
+
+    def hot_keys(self, n):
+        return list(islice(chain(self.t2.keys_mru(), self.t1.keys_mru()), n))
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+class CountMinSketch:
+    """4-row count-min sketch with saturating 4-bit counters and periodic aging"""
+
+    DEPTH = 4
+    SEEDS = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+
+    def __init__(self, width: int = 4096):
+        # Round width up to a power of two so indexing is a mask
+        self.width = 1 << max(4, (width - 1).bit_length())
+        self._mask = self.width - 1
+        self._table = bytearray(self.DEPTH * self.width)
+        self._sample_size = 10 * self.width
+        self._additions = 0
+
+    def _indexes(self, key):
+        h = hash(key)
+        for row, seed in enumerate(self.SEEDS):
+            yield row * self.width + (((h ^ seed) * seed) >> 16 & self._mask)
+
+    def increment(self, key):
+        table = self._table
+        for idx in self._indexes(key):
+            if table[idx] < 15:
+                table[idx] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._reset()
+
+    def estimate(self, key) -> int:
+        return min(self._table[idx] for idx in self._indexes(key))
+
+    def _reset(self):
+        # Halve every counter so old popularity decays
+        self._table = bytearray(v >> 1 for v in self._table)
+        self._additions //= 2
+
+    def resized(self, width: int, keys) -> 'CountMinSketch':
+        """A sketch of width carrying over the estimates of keys (other history is dropped)"""
+        sketch = CountMinSketch(width)
+        table = sketch._table
+        for key in keys:
+            count = self.estimate(key)
+            if count:
+                for idx in sketch._indexes(key):
+                    table[idx] = max(table[idx], count)
+        return sketch
+
+class WTinyLFUPolicy(EvictionPolicy):
+    """
+    Window TinyLFU (as in Caffeine).
+    New keys enter a small LRU window that spills into the main SLRU region;
+    on eviction the window's LRU key competes with the main victim and only
+    the more frequent one (by the count-min sketch) survives. Scans pass
+    through the window without flushing the frequently used main region.
+    """
+    name = 'wtinylfu'
+
+    WINDOW_RATIO = 0.01
+    PROTECTED_RATIO = 0.8
+
+    def __init__(self, capacity_hint=None, entries=None):
+        super().__init__(capacity_hint, entries)
+        self.window = LinkedList()
+        self.probation = LinkedList()
+        self.protected = LinkedList()
+        # Sized from the hint when there is one; byte-bounded caches have none,
+        # so the sketch also widens as the resident set outgrows it
+        self.sketch = CountMinSketch(max(capacity_hint or 0, 1024))
+
+    def _window_max(self):
+        return max(1, int(len(self) * self.WINDOW_RATIO))
+
+    def _protected_max(self):
+        return max(1, int((len(self.probation) + len(self.protected)) * self.PROTECTED_RATIO))
+
+    def _resident(self, link) -> bool:
+        return link is not None and link.owner in (self.window, self.probation, self.protected)
+
+    def record_insert(self, key):
+        link = self._link(key, create=True)
+        if self._resident(link):
+            self.record_access(key)
+            return
+        self.sketch.increment(key)
+        self.window.append(link)
+        # Window overflow moves into probation, where it competes for residency
+        while len(self.window) > self._window_max():
+            self.probation.append(self.window.popleft())
+        if len(self) > self.sketch.width:
+            # Doubling keeps the rebuild amortised O(1) per insert
+            self.sketch = self.sketch.resized(2 * len(self), chain(
+                self.window.keys_mru(), self.probation.keys_mru(), self.protected.keys_mru()))
+
+    def record_access(self, key):
+        link = self._link(key)
+        if link is None:
+            return
+        self.sketch.increment(key)
+        if link.owner is self.window:
+            self.window.move_to_end(link)
+        elif link.owner is self.probation:
+            self.probation.unlink(link)
+            self.protected.append(link)
+            if len(self.protected) > self._protected_max():
+                self.probation.append(self.protected.popleft())
+        elif link.owner is self.protected:
+            self.protected.move_to_end(link)
+
+    def remove(self, key):
+        link = self._link(key)
+        if self._resident(link):
+            link.owner.unlink(link)
+            self._release(link)
+
+    def _main_victim_region(self):
+        if self.probation:
+            return self.probation
+        if self.protected:
+            return self.protected
+        return None
+
+    def victim(self):
+        main = self._main_victim_region()
+        if not self.window:
+            if main is None:
+                return None
+            return self._release(main.popleft())
+        candidate = self.window.first()
+        if main is None:
+            self.window.unlink(candidate)
+            return self._release(candidate)
+        main_victim = main.first()
+        if self.sketch.estimate(candidate.key) > self.sketch.estimate(main_victim.key):
+            # Admit the window candidate, evict the main victim instead
+            main.unlink(main_victim)
+            self.window.unlink(candidate)
+            self.probation.append(candidate)
+            return self._release(main_victim)
+        self.window.unlink(candidate)
+        return self._release(candidate)
+
+    def hot_keys(self, n):
+        regions = (self.protected, self.window, self.probation)
+        return list(islice(chain.from_iterable(r.keys_mru() for r in regions), n))
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+EVICTION_POLICIES = {
+    cls.name: cls for cls in (LRUPolicy, LFUPolicy, ARCPolicy, WTinyLFUPolicy)
+}
+
+def make_policy(name: str = 'lru', capacity_hint: Optional[int] = None, entries: Optional[Dict] = None) -> EvictionPolicy:
+    """Create an eviction policy by name (lru, lfu, arc, wtinylfu), optionally linking entries' Links"""
+    try:
+        cls = EVICTION_POLICIES[(name or 'lru').lower()]
+    except KeyError:
+        raise ValueError(f"Unknown eviction policy: {name}")
+    return cls(capacity_hint, entries)
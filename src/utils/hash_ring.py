@@ -0,0 +1,71 @@
+import bisect
+import hashlib
+from typing import Iterable, List, Optional
+
+def stable_hash(value: str) -> int:
+    # Stable across processes (unlike hash()), so every node builds the same ring
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+class ConsistentHashRing:
+    """
+    Consistent-hash ring with virtual nodes. Each node is placed `vnodes`
+    times on the ring; a key belongs to the first point clockwise from its
+    hash. Adding or removing a node only moves the keys of that node.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = 100):
+        self.vnodes = vnodes
+        self._points: List[int] = []
+        self._owners: List[str] = []
+        self._nodes = set()
+        for node in nodes:
+            self.add_node(node)
+
+    @property
+    def nodes(self) -> List[str]:
+        return sorted(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def add_node(self, node: str):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for i in range(self.vnodes):
+            point = stable_hash(f'{node}#{i}')
+            idx = bisect.bisect(self._points, point)
+            self._points.insert(idx, point)
+            self._owners.insert(idx, node)
+
+    def remove_node(self, node: str):
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        keep = [(p, n) for p, n in zip(self._points, self._owners) if n != node]
+        self._points = [p for p, _ in keep]
+        self._owners = [n for _, n in keep]
+
+    def owner(self, key: str) -> Optional[str]:
+        """Node responsible for key, or None if the ring is empty"""
+        if not self._points:
+            return None
+        idx = bisect.bisect(self._points, stable_hash(key)) % len(self._points)
+        return self._owners[idx]
+
+    def owners(self, key: str, n: int) -> List[str]:
+        """Up to n distinct nodes for key, in ring order starting at its owner"""
+        if not self._points:
+            return []
+        found = []
+        start = bisect.bisect(self._points, stable_hash(key))
+        for offset in range(len(self._points)):
+            node = self._owners[(start + offset) % len(self._points)]
+            if node not in found:
+                found.append(node)
+                if len(found) == n:
+                    break
+        return found
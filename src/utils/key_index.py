@@ -0,0 +1,105 @@
+from typing import Dict, Iterable, List, Set
+
+class _TrieNode:
+    __slots__ = ('children', 'key')
+
+    def __init__(self):
+        self.children: Dict[str, '_TrieNode'] = {}
+        self.key = None
+
+class PrefixIndex:
+    """
+    Trie over key segments (split on `sep`), so all keys under a prefix are
+    found without scanning the cache. Prefixes need not end on a segment
+    boundary: the last, partial segment is matched against the children of
+    the node reached by the complete ones.
+    """
+
+    def __init__(self, sep: str = ':'):
+        self.sep = sep
+        self._root = _TrieNode()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key: str):
+        node = self._root
+        for segment in key.split(self.sep):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _TrieNode()
+            node = child
+        if node.key is None:
+            node.key = key
+            self._size += 1
+
+    def remove(self, key: str):
+        path = [self._root]
+        segments = key.split(self.sep)
+        for segment in segments:
+            node = path[-1].children.get(segment)
+            if node is None:
+                return
+            path.append(node)
+        if path[-1].key is None:
+            return
+        path[-1].key = None
+        self._size -= 1
+        # Prune the branch back up to the first node still in use
+        for depth in range(len(segments), 0, -1):
+            node = path[depth]
+            if node.key is not None or node.children:
+                break
+            del path[depth - 1].children[segments[depth - 1]]
+
+    def keys_with_prefix(self, prefix: str) -> List[str]:
+        """Every indexed key that starts with prefix"""
+        *complete, partial = prefix.split(self.sep)
+        node = self._root
+        for segment in complete:
+            node = node.children.get(segment)
+            if node is None:
+                return []
+        keys = []
+        stack = [child for segment, child in node.children.items() if segment.startswith(partial)]
+        while stack:
+            node = stack.pop()
+            if node.key is not None:
+                keys.append(node.key)
+            stack.extend(node.children.values())
+        return keys
+
+class TagIndex:
+    """Two-way mapping between keys and the tags they were written with"""
+
+    def __init__(self):
+        self._keys_by_tag: Dict[str, Set[str]] = {}
+        self._tags_by_key: Dict[str, Set[str]] = {}
+
+    def set(self, key: str, tags: Iterable[str]):
+        """Replace the tags of key (an empty iterable clears them)"""
+        self.remove(key)
+        tags = set(tags or ())
+        if not tags:
+            return
+        self._tags_by_key[key] = tags
+        for tag in tags:
+            self._keys_by_tag.setdefault(tag, set()).add(key)
+
+    def remove(self, key: str):
+        for tag in self._tags_by_key.pop(key, ()):
+            keys = self._keys_by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_tag[tag]
+
+    def tags_of(self, key: str) -> List[str]:
+        return sorted(self._tags_by_key.get(key, ()))
+
+    def keys_with_tags(self, tags: Iterable[str]) -> Set[str]:
+        """Keys carrying any of the tags"""
+        keys = set()
+        for tag in tags:
+            keys |= self._keys_by_tag.get(tag, set())
+        return keys
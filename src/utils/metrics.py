@@ -72,6 +72,30 @@ class MetricsCollector:
         index = int((percentile / 100) * len(sorted_values))
         return sorted_values[min(index, len(sorted_values) - 1)]
 
+class RateCounter:
+    """Events per second over a sliding window of one-second buckets; add() is O(1)"""
+    
+    def __init__(self, window: int = 60):
+        self.window = window
+        self.buckets = [0] * window
+        self.seconds = [0] * window
+        
+    def add(self, value: int = 1, now: float = None):
+        """Count value events at now (default: current time)"""
+        second = int(time.time() if now is None else now)
+        slot = second % self.window
+        if self.seconds[slot] != second:
+            # The slot still holds a count from an earlier lap of the window
+            self.seconds[slot] = second
+            self.buckets[slot] = 0
+        self.buckets[slot] += value
+        
+    def rate(self, now: float = None) -> float:
+        """Average events per second over the last window seconds"""
+        second = int(time.time() if now is None else now)
+        total = sum(count for count, at in zip(self.buckets, self.seconds) if second - at < self.window)
+        return total / self.window
+
 class PerformanceMonitor:
     """Performance monitoring decorators and utilities"""
     
@@ -108,9 +132,11 @@ class PerformanceMonitor:
 class SystemMetrics:
     """System-level metrics collection"""
     
-    def __init__(self, node_id: str):
+    def __init__(self, node_id: str, queue=None):
         self.node_id = node_id
         self.metrics = MetricsCollector(node_id)
+        # Optional DistributedQueue whose per-topic stats are exported as gauges
+        self.queue = queue
         
     async def start_background(self, app):
         """Start background metrics collection"""
@@ -149,6 +175,21 @@ class SystemMetrics:
         self.metrics.set_gauge('network_bytes_sent', network.bytes_sent)
         self.metrics.set_gauge('network_bytes_recv', network.bytes_recv)
         
+        if self.queue is not None:
+            self.record_queue_stats(await self.queue.stats())
+        
+    def record_queue_stats(self, stats: Dict[str, Dict[str, Any]]):
+        """Export DistributedQueue.stats() as gauges labelled by topic (and group)"""
+        for topic, topic_stats in stats.items():
+            labels = {'topic': topic}
+            for name in ('depth', 'spilled', 'enqueue_rate', 'dequeue_rate', 'oldest_age_seconds'):
+                if topic_stats.get(name) is not None:
+                    self.metrics.set_gauge(f'queue_{name}', topic_stats[name], labels)
+            for group in topic_stats.get('groups') or []:
+                if group.get('lag') is not None:
+                    self.metrics.set_gauge('queue_group_lag', group['lag'], {**labels, 'group': group['group']})
+                self.metrics.set_gauge('queue_group_pending', group['pending'], {**labels, 'group': group['group']})
+        
     def get_metrics_endpoint_data(self) -> Dict[str, Any]:
         """Get metrics data formatted for Prometheus-style endpoint"""
         summary = self.metrics.get_metrics_summary()
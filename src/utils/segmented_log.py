@@ -0,0 +1,182 @@
+import mmap
+import os
+import struct
+from typing import Iterable, List, Optional
+
+_LENGTH = struct.Struct('>I')
+# Consumer offset, head segment base and byte position within it
+_OFFSET = struct.Struct('>QQQ')
+
+class SegmentedLog:
+    """
+    Append-only log of string records split into segment files
+    (`{base offset}.log`, each record a 4-byte length plus UTF-8 bytes) with a
+    single consumer offset persisted next to them. Reads go through a memory
+    map of the head segment, and a segment is deleted as soon as the consumer
+    has moved past it, so neither producing nor consuming rewrites old data.
+    """
+
+    OFFSET_FILE = 'offset'
+
+    def __init__(self, directory: str, segment_bytes: int = 1 << 20):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._segments: List[int] = sorted(
+            int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log') and name[:-4].isdigit())
+        self._writer = None
+        self._map: Optional[mmap.mmap] = None
+        self._recover()
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def _path(self, base: int) -> str:
+        return os.path.join(self.directory, f'{base:020d}.log')
+
+    def _recover(self):
+        # Count the records of the last segment to find the tail, dropping a torn final write
+        self.tail = 0
+        self._active_size = 0
+        if self._segments:
+            base = self._segments[-1]
+            with open(self._path(base), 'rb') as f:
+                data = f.read()
+            pos, count = 0, 0
+            while pos + _LENGTH.size <= len(data):
+                (length,) = _LENGTH.unpack_from(data, pos)
+                if pos + _LENGTH.size + length > len(data):
+                    break
+                pos += _LENGTH.size + length
+                count += 1
+            if pos < len(data):
+                with open(self._path(base), 'r+b') as f:
+                    f.truncate(pos)
+            self.tail = base + count
+            self._active_size = pos
+
+        # The offset is a fixed-size record overwritten in place, so saving it is one pwrite
+        self._offset_fd = os.open(os.path.join(self.directory, self.OFFSET_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        saved = os.pread(self._offset_fd, _OFFSET.size, 0)
+        offset, segment, position = _OFFSET.unpack(saved) if len(saved) == _OFFSET.size else (0, None, 0)
+        if segment in self._segments:
+            self._head_segment = segment
+            self.head = offset
+            self._position = position
+        else:
+            # Missing offset, or its segment was already deleted: start at the oldest segment
+            self._head_segment = self._segments[0] if self._segments else 0
+            self.head = self._head_segment
+            self._position = 0
+        # Segments before the head one were fully consumed before a crash
+        for base in [b for b in self._segments if b < self._head_segment]:
+            self._delete(base)
+
+    def append(self, records: Iterable[str]) -> int:
+        """Append records and return the new tail offset"""
+        if self._writer is None:
+            # After a restart, keep filling the last segment while it has room
+            base = self._segments[-1] if self._segments and self._active_size < self.segment_bytes \
+                else self._new_segment()
+            self._writer = open(self._path(base), 'ab')
+        elif self._active_size >= self.segment_bytes:
+            self._writer.close()
+            self._writer = open(self._path(self._new_segment()), 'ab')
+        chunks = []
+        for record in records:
+            data = record.encode('utf-8')
+            chunks.append(_LENGTH.pack(len(data)))
+            chunks.append(data)
+            self.tail += 1
+        payload = b''.join(chunks)
+        self._writer.write(payload)
+        self._writer.flush()
+        self._active_size += len(payload)
+        return self.tail
+
+    def _new_segment(self) -> int:
+        base = self.tail
+        self._segments.append(base)
+        self._active_size = 0
+        if len(self._segments) == 1:
+            self._head_segment = base
+        return base
+
+    def read(self, max_records: int) -> List[str]:
+        """Consume up to max_records from the head and persist the new offset"""
+        records = []
+        while len(records) < max_records and self.head < self.tail:
+            mm = self._head_map()
+            if self._position + _LENGTH.size > len(mm):
+                self._next_segment()
+                continue
+            (length,) = _LENGTH.unpack_from(mm, self._position)
+            start = self._position + _LENGTH.size
+            records.append(mm[start:start + length].decode('utf-8'))
+            self._position = start + length
+            self.head += 1
+        if records:
+            self._save_offset()
+        return records
+
+    def peek(self, max_records: int) -> List[str]:
+        """
+        Return up to max_records from the head without consuming them; a later
+        read() of the same count consumes exactly these. Stops at the end of
+        the head segment, so it may return fewer than are available.
+        """
+        records = []
+        if self.head >= self.tail:
+            return records
+        mm = self._head_map()
+        if self._position + _LENGTH.size > len(mm):
+            self._next_segment()
+            mm = self._head_map()
+        position = self._position
+        while len(records) < max_records and self.head + len(records) < self.tail \
+                and position + _LENGTH.size <= len(mm):
+            (length,) = _LENGTH.unpack_from(mm, position)
+            start = position + _LENGTH.size
+            records.append(mm[start:start + length].decode('utf-8'))
+            position = start + length
+        return records
+
+    def _head_map(self) -> mmap.mmap:
+        # A segment may have grown since it was mapped, so the map is rebuilt when reads reach its end
+        if self._map is None or self._position + _LENGTH.size > len(self._map):
+            self._close_map()
+            with open(self._path(self._head_segment), 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _next_segment(self):
+        done = self._head_segment
+        self._close_map()
+        self._head_segment = self._segments[self._segments.index(done) + 1]
+        self._position = 0
+        self._save_offset()
+        self._delete(done)
+
+    def _delete(self, base: int):
+        self._segments.remove(base)
+        try:
+            os.remove(self._path(base))
+        except FileNotFoundError:
+            pass
+
+    def _save_offset(self):
+        os.pwrite(self._offset_fd, _OFFSET.pack(self.head, self._head_segment, self._position), 0)
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def close(self):
+        self._close_map()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._offset_fd is not None:
+            os.close(self._offset_fd)
+            self._offset_fd = None
@@ -0,0 +1,83 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel for key deadlines.
+    Level 0 has one slot per tick; each higher level covers `slots` times the
+    span of the level below and is cascaded down when the lower level wraps.
+    schedule/cancel are O(1) and advance only touches the slots whose time
+    has come, so expiry never needs a scan over all keys.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 64, levels: int = 4, now: Optional[float] = None):
+        if slots & (slots - 1):
+            raise ValueError("slots must be a power of two")
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        self._wheels: List[List[Dict[str, int]]] = [
+            [dict() for _ in range(slots)] for _ in range(levels)
+        ]
+        self._where: Dict[str, Tuple[int, int]] = {}
+        self._tick = self._to_tick(time.time() if now is None else now)
+
+    def _to_tick(self, t: float) -> int:
+        return int(t / self.tick)
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, deadline: float):
+        """Schedule (or reschedule) key to expire at the absolute time deadline"""
+        self.cancel(key)
+        # Round up so a key never fires before its deadline
+        due = -(-deadline // self.tick)
+        self._place(key, max(int(due), self._tick + 1))
+
+    def _place(self, key, due_tick: int):
+        diff = due_tick - self._tick
+        level = 0
+        while level < self.levels - 1 and diff >= (1 << (self._bits * (level + 1))):
+            level += 1
+        idx = (due_tick >> (self._bits * level)) & self._mask
+        self._wheels[level][idx][key] = due_tick
+        self._where[key] = (level, idx)
+
+    def cancel(self, key):
+        loc = self._where.pop(key, None)
+        if loc is not None:
+            level, idx = loc
+            self._wheels[level][idx].pop(key, None)
+
+    def advance(self, now: Optional[float] = None) -> List:
+        """Move the wheel to `now` and return the keys that expired on the way"""
+        target = self._to_tick(time.time() if now is None else now)
+        expired = []
+        while self._tick < target:
+            self._tick += 1
+            t = self._tick
+            # Cascade from the highest wrapping level down so re-placed keys
+            # never land in a slot that was already cascaded this tick
+            wrapped = [
+                level for level in range(1, self.levels)
+                if t & ((1 << (self._bits * level)) - 1) == 0
+            ]
+            for level in reversed(wrapped):
+                idx = (t >> (self._bits * level)) & self._mask
+                bucket = self._wheels[level][idx]
+                self._wheels[level][idx] = {}
+                for key, due_tick in bucket.items():
+                    self._place(key, due_tick)
+            bucket = self._wheels[0][t & self._mask]
+            if bucket:
+                self._wheels[0][t & self._mask] = {}
+                for key in bucket:
+                    del self._where[key]
+                expired.extend(bucket)
+        return expired
@@ -1,11 +1,13 @@
 import pytest
 import asyncio
 import json
+import time
 from aiohttp import web, ClientSession
 from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
 from src.api.handlers import Handlers
 from src.api.endpoints import register_routes
 from src.nodes.base_node import create_app
+from src.nodes.queue_node import QueueSubscription, QueueFullError
 
 class TestAPIEndpoints(AioHTTPTestCase):
     """Test suite untuk API endpoints"""
@@ -126,6 +128,127 @@ class TestAPIEndpoints(AioHTTPTestCase):
         data = await resp.json()
         assert 'message' in data
     
+    @unittest_run_loop
+    async def test_batch_produce_consume_endpoints(self):
+        """Test batch produce and consume-N endpoints"""
+        payload = {'topic': 'test_topic', 'messages': ['m1', 'm2', 'm3']}
+        resp = await self.client.request('POST', '/queue/produce_batch', json=payload)
+        assert resp.status == 200
+        assert (await resp.json())['count'] == 3
+        
+        resp = await self.client.request('POST', '/queue/consume', json={'topic': 'test_topic', 'count': 2})
+        assert resp.status == 200
+        assert (await resp.json())['messages'] == ['test_message', 'test_message']
+        
+        resp = await self.client.request('POST', '/queue/consume', json={'topic': 'test_topic', 'count': 0})
+        assert resp.status == 400
+    
+    @unittest_run_loop
+    async def test_blocking_consume_endpoint(self):
+        """Test consume with a server-side wait timeout"""
+        resp = await self.client.request('POST', '/queue/consume', json={'topic': 'test_topic', 'timeout': 5})
+        assert resp.status == 200
+        assert (await resp.json())['message'] == 'test_message'
+        
+        resp = await self.client.request('POST', '/queue/consume', json={'topic': 'test_topic', 'timeout': -1})
+        assert resp.status == 400
+    
+    @unittest_run_loop
+    async def test_delayed_priority_produce_endpoint(self):
+        """Test produce with priority and delayed delivery options"""
+        resp = await self.client.request('POST', '/queue/produce',
+                                         json={'topic': 'test_topic', 'message': 'm', 'priority': 2, 'delay': 30})
+        assert resp.status == 200
+        assert self.app['queue'].last_delay == 30
+        
+        resp = await self.client.request('POST', '/queue/produce_batch',
+                                         json={'topic': 'test_topic', 'messages': ['m'], 'deliver_at': time.time() + 60})
+        assert resp.status == 200
+        assert 55 < self.app['queue'].last_delay <= 60
+        
+        for options in ({'priority': 3}, {'priority': -1}, {'delay': -5}, {'delay': 1, 'deliver_at': 1}):
+            resp = await self.client.request('POST', '/queue/produce',
+                                             json={'topic': 'test_topic', 'message': 'm', **options})
+            assert resp.status == 400
+    
+    @unittest_run_loop
+    async def test_queue_subscribe_websocket(self):
+        """Test push subscription delivers one message per credit and takes acks"""
+        resp = await self.client.request('GET', '/queue/subscribe')
+        assert resp.status == 400
+        
+        ws = await self.client.ws_connect('/queue/subscribe?topic=orders&reliable=true')
+        await ws.send_json({'type': 'credit', 'n': 2})
+        frames = [await ws.receive_json(timeout=2) for _ in range(2)]
+        assert frames[0] == {'type': 'message', 'topic': 'orders', 'message': 'test_message', 'receipt': 'r1'}
+        
+        await ws.send_json({'type': 'ack', 'receipt': 'r1'})
+        assert await ws.receive_json(timeout=2) == {'type': 'ack', 'receipt': 'r1', 'success': True}
+        await ws.send_json({'type': 'credit', 'n': 0})
+        assert (await ws.receive_json(timeout=2))['type'] == 'error'
+        await ws.close()
+    
+    @unittest_run_loop
+    async def test_produce_to_full_topic(self):
+        """Test a full bounded topic pushes back with 429"""
+        resp = await self.client.request('POST', '/queue/produce', json={'topic': 'full_topic', 'message': 'm'})
+        assert resp.status == 429
+        assert resp.headers['Retry-After'] == '1'
+        resp = await self.client.request('POST', '/queue/produce_batch',
+                                         json={'topic': 'full_topic', 'messages': ['m']})
+        assert resp.status == 429
+    
+    @unittest_run_loop
+    async def test_queue_stats_endpoint(self):
+        """Test queue statistics endpoint"""
+        resp = await self.client.request('GET', '/queue/stats?topic=orders')
+        assert resp.status == 200
+        data = await resp.json()
+        assert data['topics']['orders']['depth'] == 3
+        assert data['topics']['orders']['oldest_age_seconds'] == 12.0
+    
+    @unittest_run_loop
+    async def test_reliable_consume_ack_endpoints(self):
+        """Test reliable consume returns a receipt that can be acked or nacked"""
+        resp = await self.client.request('POST', '/queue/consume', json={'topic': 'test_topic', 'reliable': True})
+        assert resp.status == 200
+        assert await resp.json() == {'message': 'test_message', 'receipt': 'r1'}
+        
+        resp = await self.client.request('POST', '/queue/consume',
+                                         json={'topic': 'test_topic', 'reliable': True, 'visibility_timeout': 0})
+        assert resp.status == 400
+        
+        resp = await self.client.request('POST', '/queue/ack', json={'topic': 'test_topic', 'receipt': 'r1'})
+        assert (await resp.json())['success'] is True
+        resp = await self.client.request('POST', '/queue/nack', json={'topic': 'test_topic', 'receipt': 'other'})
+        assert (await resp.json())['success'] is False
+        resp = await self.client.request('POST', '/queue/ack', json={'topic': 'test_topic'})
+        assert resp.status == 400
+    
+    @unittest_run_loop
+    async def test_stream_endpoints(self):
+        """Test stream publish, group read/ack/claim/seek and group listing"""
+        resp = await self.client.request('POST', '/queue/stream/publish', json={'topic': 't', 'messages': ['a', 'b']})
+        assert (await resp.json())['ids'] == ['1-0', '2-0']
+        
+        payload = {'topic': 't', 'group': 'billing', 'consumer': 'w1'}
+        resp = await self.client.request('POST', '/queue/stream/read', json=payload)
+        assert (await resp.json())['messages'] == [{'id': '1-0', 'message': 'test_message'}]
+        resp = await self.client.request('POST', '/queue/stream/read', json={'topic': 't', 'group': 'billing'})
+        assert resp.status == 400
+        
+        resp = await self.client.request('POST', '/queue/stream/ack', json={'topic': 't', 'group': 'billing', 'ids': ['1-0']})
+        assert (await resp.json())['acked'] == 1
+        resp = await self.client.request('POST', '/queue/stream/claim', json={**payload, 'min_idle': 30})
+        assert (await resp.json())['messages'] == []
+        resp = await self.client.request('POST', '/queue/stream/claim', json=payload)
+        assert resp.status == 400
+        resp = await self.client.request('POST', '/queue/stream/seek', json={'topic': 't', 'group': 'billing', 'offset': '0'})
+        assert resp.status == 200
+        
+        resp = await self.client.request('GET', '/queue/stream/groups?topic=t')
+        assert (await resp.json())['groups'][0]['group'] == 'billing'
+    
     @unittest_run_loop
     async def test_cache_get_endpoint(self):
         """Test cache get endpoint"""
@@ -145,6 +268,52 @@ class TestAPIEndpoints(AioHTTPTestCase):
         data = await resp.json()
         assert 'success' in data
     
+    @unittest_run_loop
+    async def test_cache_mget_endpoint(self):
+        """Test multi-key cache get endpoint"""
+        payload = {'keys': ['k1', 'k2']}
+        resp = await self.client.request('POST', '/cache/mget', json=payload)
+        assert resp.status == 200
+        
+        data = await resp.json()
+        assert data['values'] == {'k1': 'test_value', 'k2': 'test_value'}
+    
+    @unittest_run_loop
+    async def test_cache_mput_endpoint(self):
+        """Test multi-key cache put endpoint"""
+        payload = {'items': {'k1': 'v1', 'k2': 'v2'}}
+        resp = await self.client.request('POST', '/cache/mput', json=payload)
+        assert resp.status == 200
+        
+        data = await resp.json()
+        assert data['success'] is True
+        
+        resp = await self.client.request('POST', '/cache/mput', json={'items': {}})
+        assert resp.status == 400
+    
+    @unittest_run_loop
+    async def test_cache_mdelete_endpoint(self):
+        """Test multi-key cache delete endpoint"""
+        resp = await self.client.request('POST', '/cache/mdelete', json={'keys': ['k1', 'k2']})
+        assert resp.status == 200
+        
+        data = await resp.json()
+        assert data['deleted'] == 2
+    
+    @unittest_run_loop
+    async def test_cache_purge_endpoint(self):
+        """Test prefix/tag bulk invalidation endpoint"""
+        resp = await self.client.request('POST', '/cache/purge', json={'prefix': 'user:42:'})
+        assert resp.status == 200
+        
+        data = await resp.json()
+        assert data['removed'] == 3
+        
+        resp = await self.client.request('POST', '/cache/purge', json={})
+        assert resp.status == 400
+        resp = await self.client.request('POST', '/cache/purge', json={'tags': 'not-a-list'})
+        assert resp.status == 400
+    
     @unittest_run_loop
     async def test_cache_invalidate_endpoint(self):
         """Test cache invalidate endpoint"""
@@ -174,6 +343,19 @@ class TestAPIEndpoints(AioHTTPTestCase):
         assert 'cache_state' in data
         assert 'metrics' in data
     
+    @unittest_run_loop
+    async def test_cache_keys_endpoint(self):
+        """Test paginated cache key listing endpoint"""
+        resp = await self.client.request('GET', '/cache/keys?cursor=0&limit=10')
+        assert resp.status == 200
+        
+        data = await resp.json()
+        assert 'keys' in data
+        assert data['cursor'] == 0
+        
+        resp = await self.client.request('GET', '/cache/keys?limit=abc')
+        assert resp.status == 400
+    
     @unittest_run_loop
     async def test_metrics_endpoint(self):
         """Test metrics endpoint"""
@@ -236,26 +418,82 @@ class MockQueue:
     def __init__(self):
         pass
     
-    async def produce(self, topic, message):
-        pass
+    async def produce(self, topic, message, key=None, priority=0, delay=None):
+        await self.produce_batch(topic, [message], key=key, priority=priority, delay=delay)
     
-    async def consume(self, topic):
+    async def produce_batch(self, topic, messages, key=None, priority=0, delay=None):
+        if priority > 2:
+            raise ValueError("priority must be between 0 and 2")
+        if topic == 'full_topic':
+            raise QueueFullError("Topic full_topic is full")
+        self.last_delay = delay
+    
+    async def consume(self, topic, count=None, timeout=None, consumer=None):
+        if count is not None:
+            return ["test_message"] * count
         return "test_message"
+    
+    async def consume_reliable(self, topic, consumer=None, count=None, timeout=None, visibility_timeout=None):
+        delivery = {'message': 'test_message', 'receipt': 'r1'}
+        return [delivery] * count if count is not None else delivery
+    
+    async def ack(self, topic, receipt):
+        return receipt == 'r1'
+    
+    async def nack(self, topic, receipt):
+        return receipt == 'r1'
+    
+    async def publish(self, topic, messages):
+        return [f"{i + 1}-0" for i in range(len(messages))]
+    
+    async def read_group(self, topic, group, consumer, count=1, timeout=None):
+        return [{'id': '1-0', 'message': 'test_message'}]
+    
+    async def ack_group(self, topic, group, ids):
+        return len(ids)
+    
+    async def claim_pending(self, topic, group, consumer, min_idle, count=100):
+        return []
+    
+    async def seek_group(self, topic, group, offset):
+        return True
+    
+    async def stream_groups(self, topic):
+        return [{'group': 'billing', 'consumers': 1, 'pending': 0, 'last_delivered_id': '1-0', 'lag': 0}]
+    
+    def subscribe(self, topics, **options):
+        return QueueSubscription(self, topics, **options)
+    
+    async def stats(self, topic=None):
+        return {'orders': {'depth': 3, 'enqueued': 5, 'dequeued': 2, 'enqueue_rate': 0.1,
+                           'dequeue_rate': 0.05, 'oldest_age_seconds': 12.0}}
 
 class MockCache:
     def __init__(self):
-        pass
+        self.ready = True
     
-    async def get(self, key):
+    async def get(self, key, forwarded=False, reader=None):
         return "test_value"
     
-    async def put(self, key, value):
+    async def put(self, key, value, ttl=None, tags=None, forwarded=False):
         return True
     
-    async def handle_invalidate(self, key):
+    async def mget(self, keys, forwarded=False, reader=None):
+        return {key: "test_value" for key in keys}
+    
+    async def mput(self, items, ttl=None, tags=None, forwarded=False):
+        return True
+    
+    async def purge(self, prefix=None, tags=None):
+        return 3
+    
+    async def mdelete(self, keys, forwarded=False):
+        return len(keys)
+    
+    async def handle_invalidate(self, key, sender=None, version=None):
         pass
     
-    async def handle_fetch(self, key):
+    async def handle_fetch(self, key, if_version=None, any_holder=False):
         return {'value': 'test_value', 'state': 'S'}
     
     async def get_cache_state(self):
@@ -265,6 +503,9 @@ class MockCache:
             'capacity_used': 0,
             'capacity_total': 100
         }
+    
+    async def list_keys(self, cursor=0, limit=100, sample=False):
+        return {'keys': {}, 'cursor': 0, 'total': 0}
 
 class MockMetrics:
     def __init__(self):
@@ -0,0 +1,43 @@
+from src.utils.bloom import BloomFilter, CountingBloomFilter, optimal_params
+
+def test_optimal_params():
+    num_bits, num_hashes = optimal_params(1000, 0.01)
+    assert num_bits % 8 == 0
+    assert 9000 < num_bits < 10000
+    assert num_hashes == 7
+
+def test_bloom_no_false_negatives_and_few_false_positives():
+    bloom = BloomFilter(*optimal_params(1000, 0.01))
+    for i in range(1000):
+        bloom.add(f'key{i}')
+    assert all(f'key{i}' in bloom for i in range(1000))
+    false_positives = sum(f'other{i}' in bloom for i in range(10000))
+    assert false_positives < 300
+
+def test_bloom_wire_roundtrip():
+    bloom = BloomFilter(*optimal_params(100))
+    bloom.add('a')
+    copy = BloomFilter.from_dict(bloom.to_dict())
+    assert 'a' in copy
+    assert copy.bits == bloom.bits
+
+def test_counting_bloom_remove():
+    bloom = CountingBloomFilter(*optimal_params(100))
+    bloom.add('a')
+    bloom.add('b')
+    bloom.remove('a')
+    assert 'a' not in bloom
+    assert 'b' in bloom
+    assert 'b' in bloom.snapshot()
+
+def test_counting_bloom_delta_replays_changes():
+    bloom = CountingBloomFilter(*optimal_params(100))
+    bloom.add('a')
+    peer_view = bloom.snapshot()
+    bloom.take_dirty()
+    bloom.remove('a')
+    bloom.add('b')
+    peer_view.apply_delta(bloom.delta(bloom.take_dirty()))
+    assert peer_view.bits == bloom.bits
+    assert 'a' not in peer_view
+    assert 'b' in peer_view
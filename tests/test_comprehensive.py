@@ -1,14 +1,17 @@
 import pytest
 import asyncio
 import json
+import os
 import time
 from unittest.mock import Mock, AsyncMock, patch
+from redis.exceptions import ResponseError
 from src.consensus.raft_redis import RaftRedis
 from src.nodes.lock_manager import LockManager
-from src.nodes.queue_node import DistributedQueue
-from src.nodes.cache_node import CacheNode, CacheState
+from src.nodes.queue_node import DistributedQueue, QueueFullError, _POP, _PUSH
+from src.utils.hash_ring import stable_hash
+from src.nodes.cache_node import CacheNode, CacheState, CacheProtocol
 from src.communication.message_passing import MessageClient
-from src.utils.metrics import MetricsCollector, SystemMetrics
+from src.utils.metrics import MetricsCollector, SystemMetrics, RateCounter
 from src.utils.logging import DistributedSystemLogger
 
 class TestRaftRedis:
@@ -215,10 +218,15 @@ class TestDistributedQueue:
     def mock_redis(self):
         """Mock Redis client"""
         redis = Mock()
-        redis.rpush = AsyncMock(return_value=1)
-        redis.lpop = AsyncMock(return_value="test_message")
+        redis.eval = AsyncMock(return_value=1)
+        redis.hincrby = AsyncMock(return_value=1)
         return redis
     
+    @staticmethod
+    def pushed(redis):
+        """(lane key, messages) of each counted push made through redis"""
+        return [(c.args[2], c.args[9:]) for c in redis.eval.call_args_list if c.args[0] == _PUSH]
+    
     @pytest.fixture
     def queue_instance(self, mock_redis):
         """Queue instance untuk testing"""
@@ -233,27 +241,587 @@ class TestDistributedQueue:
     @pytest.mark.asyncio
     async def test_produce_message(self, queue_instance, mock_redis):
         """Test produce message"""
-        await queue_instance.produce("test_topic", "test_message")
+        with patch('src.nodes.queue_node.time.time', return_value=1000.0):
+            await queue_instance.produce("test_topic", "test_message")
         
-        mock_redis.rpush.assert_called_once_with("queue:test_topic", "test_message")
+        # One script pushes and updates the topic's shared stats
+        mock_redis.eval.assert_called_once_with(
+            _PUSH, 4, "queue:test_topic", "queue:test_topic:stats", "queue:test_topic:marks",
+            queue_instance.STATS_TOPICS_KEY, "test_topic", 1000.0, queue_instance.STATS_MARKS, "test_message")
     
     @pytest.mark.asyncio
     async def test_consume_message(self, queue_instance, mock_redis):
         """Test consume message"""
-        result = await queue_instance.consume("test_topic")
+        mock_redis.eval.return_value = ["test_message"]
+        with patch('src.nodes.queue_node.time.time', return_value=1000.0):
+            result = await queue_instance.consume("test_topic")
         
         assert result == "test_message"
-        mock_redis.lpop.assert_called_once_with("queue:test_topic")
+        # One script pops and counts the dequeue
+        mock_redis.eval.assert_called_once_with(_POP, 2, "queue:test_topic", "queue:test_topic:stats", 1, 1000.0)
     
     @pytest.mark.asyncio
     async def test_consume_empty_queue(self, queue_instance, mock_redis):
         """Test consume from empty queue"""
-        mock_redis.lpop.return_value = None
+        mock_redis.eval.return_value = []
         
         result = await queue_instance.consume("test_topic")
         
         assert result is None
+    
+    @pytest.mark.asyncio
+    async def test_produce_consume_batch(self, queue_instance, mock_redis):
+        """Test batch produce is one push script and consume-N one pop script with count"""
+        await queue_instance.produce_batch("test_topic", ["m1", "m2", "m3"])
+        assert self.pushed(mock_redis) == [("queue:test_topic", ("m1", "m2", "m3"))]
+        
+        mock_redis.eval = AsyncMock(return_value=["m1", "m2"])
+        assert await queue_instance.consume("test_topic", count=2) == ["m1", "m2"]
+        assert mock_redis.eval.call_args.args[:5] == (_POP, 2, "queue:test_topic", "queue:test_topic:stats", 2)
+        
+        mock_redis.eval = AsyncMock(return_value=[])
+        assert await queue_instance.consume("test_topic", count=2) == []
+    
+    @pytest.mark.asyncio
+    async def test_file_fallback_batch(self, tmp_path):
+        """Test batch produce/consume in file fallback mode"""
+        queue = DistributedQueue(node_id="test_node", data_dir=str(tmp_path))
+        topic = f"test_batch_{time.time_ns()}"
+        await queue.produce_batch(topic, ["m1", "m2", "m3"])
+        assert await queue.consume(topic, count=2) == ["m1", "m2"]
+        assert await queue.consume(topic) == "m3"
+        assert await queue.consume(topic, count=2) == []
+    
+    @pytest.mark.asyncio
+    async def test_blocking_consume_uses_blocking_pool(self, mock_redis):
+        """Test blocking consume waits with a peek on the dedicated client, then pops by script"""
+        lists = {"queue:test_topic": []}
+        
+        async def pop(script, numkeys, key, stats, count, now):
+            taken, lists[key][:] = lists[key][:count], lists[key][count:]
+            return taken
+        
+        async def blmove(source, destination, timeout, *sides):
+            if lists[source]:
+                return lists[source][0]
+            await asyncio.sleep(0.01)
+            return None
+        
+        blocking = Mock()
+        blocking.blmove = AsyncMock(side_effect=blmove)
+        mock_redis.eval = AsyncMock(side_effect=pop)
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis, blocking_redis=blocking)
+        
+        waiting = asyncio.ensure_future(queue.consume("test_topic", count=3, timeout=5))
+        await asyncio.sleep(0.05)
+        lists["queue:test_topic"] += ["m1", "m2"]
+        assert await asyncio.wait_for(waiting, 1) == ["m1", "m2"]
+        args = blocking.blmove.call_args.args
+        assert args[0] == args[1] == "queue:test_topic"
+        assert args[3:] == ('LEFT', 'LEFT')
+        assert {c.args[0] for c in mock_redis.eval.call_args_list} == {_POP}
+        
+        # Timeouts are capped; an expired wait returns nothing
+        queue.MAX_BLOCK_TIMEOUT = 0.05
+        assert await queue.consume("test_topic", timeout=3600) is None
+    
+    @pytest.mark.asyncio
+    async def test_file_fallback_blocking_consume(self, tmp_path):
+        """Test fallback consumers park until produce wakes them"""
+        queue = DistributedQueue(node_id="test_node", data_dir=str(tmp_path))
+        topic = f"test_block_{time.time_ns()}"
+        assert await queue.consume(topic, timeout=0.05) is None
+        assert not queue._waiters
+        
+        consumers = [asyncio.create_task(queue.consume(topic, timeout=5)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        assert len(queue._waiters[topic]) == 2
+        
+        await queue.produce(topic, "m1")
+        await queue.produce(topic, "m2")
+        results = await asyncio.wait_for(asyncio.gather(*consumers), 2)
+        assert sorted(results) == ["m1", "m2"]
+        assert not queue._waiters
+    
+    @pytest.mark.asyncio
+    async def test_reliable_consume_redis(self, queue_instance, mock_redis):
+        """Test reliable consume, ack and redelivery go through atomic scripts"""
+        mock_redis.eval = AsyncMock(return_value=["r1", "m1"])
+        delivery = await queue_instance.consume_reliable("test_topic", consumer="w1", visibility_timeout=10)
+        assert delivery == {'receipt': 'r1', 'message': 'm1'}
+        args = mock_redis.eval.call_args.args
+        assert args[1] == 6
+        assert args[2:8] == ("queue:test_topic", "queue:test_topic:processing:w1", "queue:test_topic:deadlines",
+                             "queue:test_topic:inflight", queue_instance.RELIABLE_TOPICS_KEY,
+                             "queue:test_topic:stats")
+        assert args[8:10] == ("test_topic", 10)
+        
+        receipt = mock_redis.eval.call_args.args[-1]
+        assert receipt.startswith("0-0-") and receipt.endswith("-w1")
+        
+        # Settling names the delivery's lane and processing list, both derived from the receipt
+        mock_redis.eval = AsyncMock(return_value=1)
+        assert await queue_instance.ack("test_topic", receipt) is True
+        assert mock_redis.eval.call_args.args[1:] == (
+            5, "queue:test_topic", "queue:test_topic:processing:w1", "queue:test_topic:deadlines",
+            "queue:test_topic:inflight", "queue:test_topic:stats", receipt, "0")
+        assert await queue_instance.nack("test_topic", receipt) is True
+        assert mock_redis.eval.call_args.args[-2:] == (receipt, "1")
+        assert await queue_instance.ack("test_topic", "bogus") is False
+        
+        mock_redis.smembers = AsyncMock(return_value={"test_topic"})
+        mock_redis.zrange = AsyncMock(return_value=[receipt, "0-0-abc-w2", "bogus"])
+        mock_redis.eval = AsyncMock(return_value=2)
+        assert await queue_instance.redeliver_expired() == 2
+        assert mock_redis.eval.call_args.args[1:] == (
+            8, "queue:test_topic:deadlines", "queue:test_topic:inflight", queue_instance.RELIABLE_TOPICS_KEY,
+            "queue:test_topic:stats", "queue:test_topic", "queue:test_topic:processing:w1",
+            "queue:test_topic", "queue:test_topic:processing:w2", "test_topic", receipt, "0-0-abc-w2")
+        assert queue_instance.metrics == {'acked': 1, 'nacked': 1, 'redelivered': 2}
+    
+    @pytest.mark.asyncio
+    async def test_reliable_blocking_consume_peeks(self, mock_redis):
+        """Test blocking reliable consume waits with a non-destructive BLMOVE"""
+        blocking = Mock()
+        blocking.blmove = AsyncMock(return_value="m1")
+        mock_redis.eval = AsyncMock(side_effect=[[], ["r1", "m1"]])
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis, blocking_redis=blocking)
+        
+        delivery = await queue.consume_reliable("test_topic", timeout=5)
+        assert delivery == {'receipt': 'r1', 'message': 'm1'}
+        args = blocking.blmove.call_args.args
+        assert args[0] == args[1] == "queue:test_topic"
+        assert args[3:] == ('LEFT', 'LEFT')
+        # Default consumer is the node itself
+        assert mock_redis.eval.call_args.args[3] == "queue:test_topic:processing:test_node"
+    
+    @pytest.mark.asyncio
+    async def test_file_fallback_reliable_delivery(self, tmp_path):
+        """Test fallback reliable mode: ack settles, nack and expiry redeliver at the head"""
+        queue = DistributedQueue(node_id="test_node", visibility_timeout=0.05, data_dir=str(tmp_path))
+        topic = f"test_reliable_{time.time_ns()}"
+        await queue.produce_batch(topic, ["m1", "m2", "m3"])
+        first, second = await queue.consume_reliable(topic, count=2)
+        assert [first['message'], second['message']] == ["m1", "m2"]
+        
+        assert await queue.ack(topic, first['receipt']) is True
+        assert await queue.ack(topic, first['receipt']) is False
+        assert await queue.nack(topic, second['receipt']) is True
+        assert await queue.consume(topic) == "m2"
+        
+        third = await queue.consume_reliable(topic)
+        assert third['message'] == "m3"
+        assert await queue.redeliver_expired() == 0
+        await asyncio.sleep(0.1)
+        assert await queue.redeliver_expired() == 1
+        assert await queue.ack(topic, third['receipt']) is False
+        assert await queue.consume(topic) == "m3"
+    
+    @pytest.mark.asyncio
+    async def test_partitioned_topic_routing(self):
+        """Test keyed messages stay on one partition, placed on its ring shard"""
+        shards = {}
+        for name in ("redis-a", "redis-b"):
+            shards[name] = Mock()
+            shards[name].eval = AsyncMock(return_value=1)
+        queue = DistributedQueue(node_id="test_node", shards=shards, partitions=4)
+        
+        await queue.produce("orders", "m1", key="customer-7")
+        await queue.produce("orders", "m2", key="customer-7")
+        partition = stable_hash("customer-7") % 4
+        ptopic = queue.partition_topic("orders", partition)
+        owner = shards[queue.ring.owner(ptopic)]
+        assert self.pushed(owner) == [(f"queue:{ptopic}", ("m1",)), (f"queue:{ptopic}", ("m2",))]
+        assert ptopic == f"orders:p{partition}"
+    
+    @pytest.mark.asyncio
+    async def test_partitioned_blocking_consume_single_shard(self, mock_redis):
+        """Test a blocking consume over partitions parks on every partition's lane watcher"""
+        lists = {f"queue:orders:p{p}": [] for p in range(3)}
+        
+        async def pop(script, numkeys, key, stats, count, now):
+            taken, lists[key][:] = lists[key][:count], lists[key][count:]
+            return taken
+        
+        async def blmove(source, destination, timeout, *sides):
+            if lists[source]:
+                return lists[source][0]
+            await asyncio.sleep(0.01)
+            return None
+        
+        blocking = Mock()
+        blocking.blmove = AsyncMock(side_effect=blmove)
+        mock_redis.eval = AsyncMock(side_effect=pop)
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis,
+                                 blocking_redis=blocking, partitions=3)
+        
+        waiting = asyncio.ensure_future(queue.consume("orders", timeout=5))
+        await asyncio.sleep(0.05)
+        assert sorted(queue._watchers) == ["orders:p0", "orders:p1", "orders:p2"]
+        lists["queue:orders:p2"].append("m1")
+        assert await asyncio.wait_for(waiting, 1) == "m1"
+    
+    @pytest.mark.asyncio
+    async def test_partition_assignment_and_fallback(self, tmp_path):
+        """Test consumers split partitions between them and keyed order is kept"""
+        queue = DistributedQueue(node_id="test_node", partitions=4, data_dir=str(tmp_path))
+        topic = f"test_parts_{time.time_ns()}"
+        assert await queue.assigned_partitions(topic, "c1") == [0, 1, 2, 3]
+        queue._assignments.clear()
+        assert await queue.assigned_partitions(topic, "c2") == [1, 3]
+        assert await queue.assigned_partitions(topic, "c1") == [0, 2]
+        
+        for i in range(3):
+            await queue.produce(topic, f"k{i}", key="same-key")
+        await queue.produce(topic, "other", key="other-key")
+        assert await queue.get_queue_length(topic) == 4
+        
+        owner, other = ("c1", "c2") if stable_hash("same-key") % 4 in (0, 2) else ("c2", "c1")
+        mine = await queue.consume(topic, count=10, consumer=owner)
+        assert [m for m in mine if m.startswith("k")] == ["k0", "k1", "k2"]
+        rest = await queue.consume(topic, count=10, consumer=other)
+        assert sorted(mine + rest) == ["k0", "k1", "k2", "other"]
+    
+    @pytest.mark.asyncio
+    async def test_stream_consumer_groups(self, mock_redis):
+        """Test stream topics: pipelined XADD, group reads, ack, reclaim and seek"""
+        pipe = Mock()
+        pipe.execute = AsyncMock(return_value=["1-0", "2-0"])
+        mock_redis.pipeline = Mock(return_value=pipe)
+        mock_redis.xgroup_create = AsyncMock(return_value=True)
+        mock_redis.xreadgroup = AsyncMock(return_value=[["stream:orders", [("1-0", {"message": "m1"})]]])
+        mock_redis.xack = AsyncMock(return_value=1)
+        mock_redis.xautoclaim = AsyncMock(return_value=["0-0", [("2-0", {"message": "m2"})], []])
+        mock_redis.xgroup_setid = AsyncMock(return_value=True)
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis, stream_maxlen=1000)
+        
+        assert await queue.publish("orders", ["m1", "m2"]) == ["1-0", "2-0"]
+        pipe.xadd.assert_called_with("stream:orders", {"message": "m2"}, maxlen=1000, approximate=True)
+        
+        assert await queue.read_group("orders", "billing", "w1") == [{'id': "1-0", 'message': "m1"}]
+        await queue.read_group("orders", "billing", "w1", count=10, timeout=2)
+        # The group is created once, from the start of the stream
+        mock_redis.xgroup_create.assert_called_once_with("stream:orders", "billing", id='0', mkstream=True)
+        mock_redis.xreadgroup.assert_called_with("billing", "w1", {"stream:orders": '>'}, count=10, block=2000)
+        
+        assert await queue.ack_group("orders", "billing", ["1-0"]) == 1
+        mock_redis.xack.assert_called_once_with("stream:orders", "billing", "1-0")
+        assert await queue.claim_pending("orders", "billing", "w2", min_idle=30) == [{'id': "2-0", 'message': "m2"}]
+        assert mock_redis.xautoclaim.call_args.args[3] == 30000
+        assert await queue.seek_group("orders", "billing", "0") is True
+        mock_redis.xgroup_setid.assert_called_once_with("stream:orders", "billing", "0")
+    
+    @pytest.mark.asyncio
+    async def test_stream_group_recreated_after_nogroup(self, mock_redis):
+        """Test a group deleted behind the node's back is recreated on read"""
+        mock_redis.xgroup_create = AsyncMock(return_value=True)
+        mock_redis.xreadgroup = AsyncMock(side_effect=[ResponseError("NOGROUP No such key"), []])
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis)
+        
+        assert await queue.read_group("orders", "billing", "w1") == []
+        assert mock_redis.xgroup_create.call_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_streams_need_redis(self, tmp_path):
+        """Test stream topics are unavailable in file fallback mode"""
+        queue = DistributedQueue(node_id="test_node", data_dir=str(tmp_path))
+        assert await queue.publish("orders", ["m1"]) is None
+        assert await queue.read_group("orders", "g", "c") is None
+    
+    @pytest.mark.asyncio
+    async def test_priority_lanes_drained_in_order(self, mock_redis):
+        """Test produce picks a priority lane and consume drains higher lanes first"""
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis, priority_levels=3)
+        await queue.produce("jobs", "urgent", priority=2)
+        await queue.produce("jobs", "normal")
+        assert self.pushed(mock_redis) == [("queue:jobs:pri2", ("urgent",)), ("queue:jobs", ("normal",))]
+        with pytest.raises(ValueError):
+            await queue.produce("jobs", "bad", priority=3)
+        
+        mock_redis.eval = AsyncMock(side_effect=[[], ["mid"], ["low"]])
+        assert await queue.consume("jobs") == "mid"
+        assert [c.args[2] for c in mock_redis.eval.call_args_list] == ["queue:jobs:pri2", "queue:jobs:pri1"]
+        
+        mock_redis.eval = AsyncMock(return_value=["urgent"])
+        assert await queue.consume("jobs", timeout=1) == "urgent"
+        assert mock_redis.eval.call_args.args[2] == "queue:jobs:pri2"
+    
+    @pytest.mark.asyncio
+    async def test_delayed_produce_and_promote_redis(self, mock_redis):
+        """Test delayed messages go to a sorted set and are promoted by script"""
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis, priority_levels=2)
+        mock_redis.eval = AsyncMock(return_value=1)
+        await queue.produce("jobs", "later", priority=1, delay=5)
+        mock_redis.rpush.assert_not_called()
+        args = mock_redis.eval.call_args.args
+        assert args[1:7] == (3, "queue:jobs:delayed", queue.DELAYED_TOPICS_KEY, "queue:jobs:stats", "jobs", 5)
+        assert json.loads(args[7])[1:] == [1, "later"]
+        
+        mock_redis.smembers = AsyncMock(return_value={"jobs"})
+        mock_redis.eval = AsyncMock(return_value=[1, "0.25", 0])
+        with patch('src.nodes.queue_node.time.time', return_value=1000.0):
+            assert await queue.promote_due() == 0.25
+        assert mock_redis.eval.call_args.args[1:] == (
+            11, "queue:jobs", "queue:jobs:stats", "queue:jobs:marks", queue.STATS_TOPICS_KEY,
+            queue.DELAYED_TOPICS_KEY, "queue:jobs:delayed", "queue:jobs:inflight",
+            "queue:jobs", "queue:jobs:pri1", "queue:jobs:marks", "queue:jobs:pri1:marks",
+            "jobs", queue.PROMOTE_BATCH, 0, 0, 1000.0, queue.STATS_MARKS)
+        mock_redis.eval = AsyncMock(return_value=[0, "-1", 0])
+        assert await queue.promote_due() == queue.PROMOTE_INTERVAL
+        # A full partition leaves due messages delayed instead of spinning on them
+        mock_redis.eval = AsyncMock(return_value=[0, "-3.0", 1])
+        assert await queue.promote_due() == queue.PROMOTE_INTERVAL
+    
+    @pytest.mark.asyncio
+    async def test_file_fallback_delayed_priority(self, tmp_path):
+        """Test delayed and prioritised delivery without Redis"""
+        queue = DistributedQueue(node_id="test_node", data_dir=str(tmp_path), priority_levels=2)
+        await queue.produce("jobs", "low")
+        await queue.produce("jobs", "high", priority=1)
+        await queue.produce("jobs", "later", priority=1, delay=0.05)
+        assert await queue.consume("jobs", count=10) == ["high", "low"]
+        assert await queue.get_queue_length("jobs") == 0
+        
+        assert 0 < await queue.promote_due() <= 0.05
+        assert await queue.consume("jobs") is None
+        
+        waiting = asyncio.ensure_future(queue.consume("jobs", timeout=2))
+        await asyncio.sleep(0.06)
+        assert await queue.promote_due() == queue.PROMOTE_INTERVAL
+        assert await waiting == "later"
 
+    @pytest.mark.asyncio
+    async def test_stats_from_hot_path_counters(self, tmp_path):
+        """Test stats report depth, totals, rates and oldest-message age"""
+        queue = DistributedQueue(node_id="test_node", data_dir=str(tmp_path))
+        with patch('src.nodes.queue_node.time.time', return_value=1000.0):
+            await queue.produce_batch("orders", ["m1", "m2"])
+        with patch('src.nodes.queue_node.time.time', return_value=1003.0):
+            await queue.produce("orders", "m3")
+        assert await queue.consume("orders", count=2) == ["m1", "m2"]
+        
+        with patch('src.nodes.queue_node.time.time', return_value=1010.0):
+            stats = (await queue.stats())["orders"]
+        assert stats['depth'] == 1
+        assert (stats['enqueued'], stats['dequeued']) == (3, 2)
+        assert stats['oldest_age_seconds'] == 7.0
+        assert stats['enqueue_rate'] == 3 / 60
+        
+        await queue.consume("orders")
+        assert (await queue.stats("orders"))["orders"]['oldest_age_seconds'] == 0.0
+    
+    @pytest.mark.asyncio
+    async def test_stats_from_shared_counters(self, mock_redis):
+        """Test stats with Redis come from the per-partition counters and per-lane marks kept there"""
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis, partitions=2)
+        counters = {"queue:orders:p0:stats": {"enqueued": "5", "dequeued": "3", "e16": "4", "e15": "1",
+                                              "d16": "3", "e10": "9", "in:queue:orders:p0": "5",
+                                              "out:queue:orders:p0": "3"},
+                    "queue:orders:p1:stats": {"enqueued": "2", "dropped": "1", "e16": "2",
+                                              "in:queue:orders:p1": "2", "out:queue:orders:p1": "2",
+                                              "back:queue:orders:p1": "1"}}
+        mock_redis.smembers = AsyncMock(return_value={"orders:p0", "orders:p1"})
+        mock_redis.hgetall = AsyncMock(side_effect=lambda key: counters[key])
+        mock_redis.hdel = AsyncMock(return_value=1)
+        mock_redis.llen = AsyncMock(side_effect=lambda key: {"queue:orders:p0": 2, "queue:orders:p1": 1}[key])
+        marks = {"queue:orders:p0:marks": ["990"], "queue:orders:p1:marks": ["995"]}
+        mock_redis.zrangebyscore = AsyncMock(side_effect=lambda key, *args, **kwargs: marks[key])
+        
+        with patch('src.nodes.queue_node.time.time', return_value=1000.0):
+            stats = (await queue.stats())["orders"]
+        assert (stats['depth'], stats['enqueued'], stats['dequeued'], stats['dropped']) == (3, 7, 3, 1)
+        # The previous minute's bucket weighs in for the part of the window it still covers
+        assert stats['enqueue_rate'] == pytest.approx((4 + 1 / 3 + 2) / 60)
+        assert stats['dequeue_rate'] == pytest.approx(3 / 60)
+        assert stats['oldest_age_seconds'] == 10.0
+        mock_redis.zrangebyscore.assert_any_call("queue:orders:p0:marks", 4, "+inf", start=0, num=1)
+        # A message put back at the head is at least as old as the last one taken
+        mock_redis.zrangebyscore.assert_any_call("queue:orders:p1:marks", 2, "+inf", start=0, num=1)
+        mock_redis.hdel.assert_called_once_with("queue:orders:p0:stats", "e10")
+    
+    @pytest.mark.asyncio
+    async def test_subscription_credits_and_settle(self, tmp_path):
+        """Test push subscriptions only fetch what the client has credit for"""
+        queue = DistributedQueue(node_id="test_node", data_dir=str(tmp_path))
+        await queue.produce_batch("a", ["a1", "a2", "a3"])
+        await queue.produce("b", "b1")
+        subscription = queue.subscribe(["a", "b"], reliable=True, credits=2)
+        
+        batch = await subscription.next_batch(wait=0.1)
+        assert [d['message'] for d in batch] == ["a1", "a2"]
+        assert subscription.credits == 0
+        assert await subscription.next_batch(wait=0.05) == []
+        assert await queue.get_queue_length("a") == 1
+        
+        subscription.grant(5)
+        batch = await subscription.next_batch(wait=0.1)
+        assert sorted(d['message'] for d in batch) == ["a3", "b1"]
+        assert await subscription.settle(batch[0]['receipt']) is True
+        assert await subscription.settle(batch[0]['receipt']) is False
+        
+        # Unsettled deliveries go back to their topic when the subscriber leaves
+        await subscription.close()
+        assert await queue.get_queue_length("a") + await queue.get_queue_length("b") == 3
+    
+    @pytest.mark.asyncio
+    async def test_subscriptions_share_lane_watchers(self, mock_redis):
+        """Test idle subscribers park on one watcher per lane instead of each blocking in Redis"""
+        lists = {"queue:a": [], "queue:b": []}
+        
+        async def pop(script, numkeys, key, stats, count, now):
+            taken, lists[key][:] = lists[key][:count], lists[key][count:]
+            return taken
+        
+        async def blmove(source, destination, timeout, *sides):
+            if lists[source]:
+                return lists[source][0]
+            await asyncio.sleep(0.01)
+            return None
+        
+        blocking = Mock()
+        blocking.blmove = AsyncMock(side_effect=blmove)
+        mock_redis.eval = AsyncMock(side_effect=pop)
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis, blocking_redis=blocking)
+        subscriptions = [queue.subscribe(["a", "b"], credits=1) for _ in range(2)]
+        batches = [asyncio.ensure_future(s.next_batch(wait=2)) for s in subscriptions]
+        await asyncio.sleep(0.05)
+        assert set(queue._watchers) == {"a", "b"}
+        assert {lane: len(waiters) for lane, waiters in queue._waiters.items()} == {"a": 2, "b": 2}
+        
+        lists["queue:b"].append("b1")
+        lists["queue:a"].append("a1")
+        results = await asyncio.wait_for(asyncio.gather(*batches), 1)
+        assert sorted(d['message'] for batch in results for d in batch) == ["a1", "b1"]
+        await asyncio.sleep(0.05)
+        assert not queue._waiters and not queue._watchers
+    
+    @pytest.mark.asyncio
+    async def test_bounded_topic_reject_and_drop_redis(self, mock_redis):
+        """Test bounded produce goes through the check-and-push script"""
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis, partitions=2, max_depth=10,
+                                 topic_limits={'logs': {'overflow': 'drop_oldest', 'max_bytes': 4096}})
+        mock_redis.eval = AsyncMock(return_value=[0, 0])
+        with pytest.raises(QueueFullError), patch('src.nodes.queue_node.time.time', return_value=1000.0):
+            await queue.produce("orders", "m1", key="k")
+        ptopic = queue.partition_topic("orders", stable_hash("k") % 2)
+        assert mock_redis.eval.call_args.args[1:] == (
+            9, f"queue:{ptopic}", f"queue:{ptopic}:stats", f"queue:{ptopic}:marks", queue.STATS_TOPICS_KEY,
+            queue.DELAYED_TOPICS_KEY, f"queue:{ptopic}:delayed", f"queue:{ptopic}:inflight",
+            f"queue:{ptopic}", f"queue:{ptopic}:marks", 5, 0, "reject", 0, ptopic, 1000.0, queue.STATS_MARKS, "m1")
+        mock_redis.rpush.assert_not_called()
+        
+        # Delayed messages are checked against the same limits when scheduled
+        with pytest.raises(QueueFullError):
+            await queue.produce("orders", "m2", key="k", delay=0.001)
+        args = mock_redis.eval.call_args.args
+        assert args[11:15] == (5, 0, "reject", 0.001)
+        assert json.loads(args[-1])[1:] == [0, "m2"]
+        # Rejections are counted in the partition's shared stats
+        assert [c.args for c in mock_redis.hincrby.call_args_list] == [(f"queue:{ptopic}:stats", "rejected", 1)] * 2
+        
+        mock_redis.eval = AsyncMock(return_value=[1, 3])
+        await queue.produce("logs", "line")
+        assert mock_redis.eval.call_args.args[11:14] == (5, 2048, "drop")
+    
+    @pytest.mark.asyncio
+    async def test_bounded_topic_spills_and_refills(self, mock_redis, tmp_path):
+        """Test the spill policy parks overflow on disk and refills it in order"""
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis, data_dir=str(tmp_path),
+                                 max_depth=2, overflow='spill')
+        mock_redis.eval = AsyncMock(return_value=[0, 0])
+        await queue.produce_batch("orders", ["m1", "m2"])
+        # While anything is spilled, new messages join the spill instead of jumping ahead
+        mock_redis.eval.reset_mock()
+        await queue.produce("orders", "m3")
+        mock_redis.eval.assert_not_called()
+        mock_redis.llen = AsyncMock(return_value=0)
+        mock_redis.hgetall = AsyncMock(return_value={})
+        mock_redis.xinfo_groups = AsyncMock(side_effect=ResponseError("no such key"))
+        stats = (await queue.stats("orders"))["orders"]
+        assert (stats['spilled'], stats['depth']) == (3, 3)
+        
+        mock_redis.eval = AsyncMock(return_value=[2, 0])
+        assert await queue.refill_spilled() == 2
+        args = mock_redis.eval.call_args.args
+        assert (args[13:16], args[18:]) == (("partial", 0, "orders"), ("m1", "m2", "m3"))
+        mock_redis.eval = AsyncMock(return_value=[1, 0])
+        assert await queue.refill_spilled() == 1
+        args = mock_redis.eval.call_args.args
+        assert (args[13:16], args[18:]) == (("partial", 0, "orders"), ("m3",))
+        
+        # A restarted node picks the spill log up again
+        mock_redis.eval = AsyncMock(return_value=[0, 0])
+        await queue.produce("orders", "m4")
+        mock_redis.eval = AsyncMock(return_value=[1, 0])
+        restarted = DistributedQueue(node_id="test_node", redis_client=mock_redis, data_dir=str(tmp_path),
+                                     max_depth=2, overflow='spill')
+        restarted._recover_spills()
+        assert await restarted.refill_spilled() == 1
+        assert mock_redis.eval.call_args.args[-1] == "m4"
+    
+    @pytest.mark.asyncio
+    async def test_file_fallback_bounded_topic(self, tmp_path):
+        """Test reject, block and drop_oldest without Redis"""
+        queue = DistributedQueue(node_id="test_node", data_dir=str(tmp_path), max_depth=2,
+                                 overflow_block_timeout=1.0,
+                                 topic_limits={'b': {'overflow': 'block'}, 'd': {'overflow': 'drop_oldest'}})
+        await queue.produce_batch("a", ["a1", "a2"])
+        with pytest.raises(QueueFullError):
+            await queue.produce("a", "a3")
+        
+        await queue.produce_batch("b", ["b1", "b2"])
+        blocked = asyncio.ensure_future(queue.produce("b", "b3"))
+        await asyncio.sleep(0.05)
+        assert not blocked.done()
+        assert await queue.consume("b") == "b1"
+        await asyncio.wait_for(blocked, 1)
+        assert await queue.consume("b", count=5) == ["b2", "b3"]
+        
+        await queue.produce_batch("d", ["d1", "d2", "d3"])
+        assert await queue.consume("d", count=5) == ["d2", "d3"]
+        # Only ready messages can be dropped: delayed ones keep the topic over its limit
+        await queue.produce_batch("d", ["l1", "l2", "l3"], delay=60)
+        stats = (await queue.stats("d"))["d"]
+        assert (stats['dropped'], stats['over_limit']) == (1, 1)
+        with pytest.raises(ValueError):
+            DistributedQueue(node_id="test_node", data_dir=str(tmp_path), overflow='bogus')
+    
+    @pytest.mark.asyncio
+    async def test_bounded_topic_counts_delayed_and_inflight(self, tmp_path):
+        """Test delayed and unacked messages use up a bounded topic's room"""
+        queue = DistributedQueue(node_id="test_node", data_dir=str(tmp_path), max_depth=2)
+        await queue.produce("a", "later", delay=0.001)
+        await queue.produce("a", "a1")
+        with pytest.raises(QueueFullError):
+            await queue.produce("a", "a2", delay=0.001)
+        
+        await asyncio.sleep(0.01)
+        await queue.promote_due()
+        delivery = await queue.consume_reliable("a")
+        with pytest.raises(QueueFullError):
+            await queue.produce("a", "a3")
+        # Requeueing moves the delivery back without growing the topic
+        assert await queue.nack("a", delivery['receipt']) is True
+        assert await queue.get_queue_length("a") == 2
+        delivery = await queue.consume_reliable("a")
+        assert await queue.ack("a", delivery['receipt']) is True
+        await queue.produce("a", "a3")
+    
+    @pytest.mark.asyncio
+    async def test_bounded_topic_spills_delayed_messages(self, mock_redis, tmp_path):
+        """Test delayed overflow is spilled with its due time and scheduled on refill"""
+        queue = DistributedQueue(node_id="test_node", redis_client=mock_redis, data_dir=str(tmp_path),
+                                 max_depth=1, overflow='spill')
+        mock_redis.eval = AsyncMock(return_value=[0, 0])
+        await queue.produce_batch("orders", ["d1", "d2"], delay=60)
+        
+        mock_redis.eval = AsyncMock(return_value=[2, 0])
+        assert await queue.refill_spilled() == 2
+        args = mock_redis.eval.call_args.args
+        assert args[13] == "partial"
+        assert 0 < args[14] <= 60
+        assert [json.loads(m)[2] for m in args[18:]] == ["d1", "d2"]
+    
 class TestCacheNode:
     """Test suite untuk Cache Node dengan MESI Protocol"""
     
@@ -285,9 +853,9 @@ class TestCacheNode:
         await cache_instance.put("key1", "value1")
         
         assert "key1" in cache_instance.cache
-        state, value, timestamp = cache_instance.cache["key1"]
-        assert state == CacheState.MODIFIED
-        assert value == "value1"
+        entry = cache_instance.cache["key1"]
+        assert entry.state == CacheState.MODIFIED
+        assert entry.value == "value1"
     
     @pytest.mark.asyncio
     async def test_cache_get_hit(self, cache_instance):
@@ -324,9 +892,639 @@ class TestCacheNode:
         await cache_instance._fetch_from_peers("key1")
         
         assert "key1" in cache_instance.cache
-        state, value, timestamp = cache_instance.cache["key1"]
-        assert state == CacheState.SHARED
-        assert value == "peer_value"
+        entry = cache_instance.cache["key1"]
+        assert entry.state == CacheState.SHARED
+        assert entry.value == "peer_value"
+    
+    @pytest.mark.asyncio
+    async def test_cache_hit_updates_entry_in_place(self, cache_instance):
+        """Test hits and writes mutate the existing line instead of replacing it"""
+        await cache_instance.put("key1", "value1")
+        entry = cache_instance.cache["key1"]
+        
+        await cache_instance.get("key1")
+        await cache_instance.put("key1", "value2")
+        
+        assert cache_instance.cache["key1"] is entry
+        assert entry.value == "value2"
+        assert not hasattr(entry, '__dict__')
+    
+    @pytest.mark.asyncio
+    async def test_cache_mput_single_invalidation_per_peer(self, cache_instance, mock_msg_client):
+        """Test batch put sends one combined invalidation to each peer"""
+        await cache_instance.mput({"k1": "v1", "k2": "v2", "k3": "v3"})
+        
+        assert mock_msg_client.post.call_count == 2
+        for call in mock_msg_client.post.call_args_list:
+            assert call.args[1] == '/cache/minvalidate'
+            assert call.args[2]['keys'] == ["k1", "k2", "k3"]
+            assert call.args[2]['node'] == "test_node"
+        assert cache_instance.cache["k2"].state == CacheState.MODIFIED
+    
+    @pytest.mark.asyncio
+    async def test_cache_mget_combined_fetch(self, mock_msg_client):
+        """Test batch get serves hits locally and fetches all misses at once"""
+        cache_instance = CacheNode("test_node", mock_msg_client, fetch_mode="sequential")
+        await cache_instance.put("k1", "v1")
+        mock_msg_client.post.reset_mock()
+        mock_msg_client.post.return_value = {'values': {'k2': {'value': 'peer_v2', 'state': 'M'}}}
+        
+        values = await cache_instance.mget(["k1", "k2", "k3"])
+        
+        assert values == {"k1": "v1", "k2": None, "k3": None}
+        assert mock_msg_client.post.call_args_list[0].args[1:] == ('/cache/mfetch', {'keys': ["k2", "k3"]})
+        assert mock_msg_client.post.call_args_list[1].args[2] == {'keys': ["k3"]}
+        assert cache_instance.cache["k2"].state == CacheState.SHARED
+        assert cache_instance.metrics['misses'] == 2
+    
+    @pytest.mark.asyncio
+    async def test_cache_state_counters(self, cache_instance):
+        """Test per-state counters follow every transition"""
+        await cache_instance.put("k1", "v1")
+        await cache_instance.put("k2", "v2")
+        await cache_instance.handle_fetch("k1")
+        await cache_instance.handle_invalidate("k2")
+        
+        state = await cache_instance.get_cache_state()
+        
+        assert state['cache_state']['M'] == {'count': 0, 'bytes': 0}
+        assert state['cache_state']['S']['count'] == 1
+        assert state['cache_state']['S']['bytes'] == cache_instance.bytes_used
+    
+    @pytest.mark.asyncio
+    async def test_cache_list_keys_pagination(self, cache_instance):
+        """Test key listing pages through all lines in bounded slices"""
+        for i in range(7):
+            await cache_instance.put(f"key{i}", f"value{i}")
+        await cache_instance.handle_invalidate("key2")
+        
+        seen = set()
+        cursor = 0
+        while True:
+            page = await cache_instance.list_keys(cursor=cursor, limit=4)
+            assert len(page['keys']) <= 4
+            seen.update(page['keys'])
+            cursor = page['cursor']
+            if cursor == 0:
+                break
+        
+        assert seen == {f"key{i}" for i in range(7)} - {"key2"}
+        sample = await cache_instance.list_keys(limit=3, sample=True)
+        assert len(sample['keys']) == 3
+    
+    @pytest.mark.asyncio
+    async def test_cache_moesi_owned_state(self, mock_msg_client):
+        """Test MOESI shares a dirty line as OWNED and invalidates on rewrite"""
+        cache = CacheNode("test_node", mock_msg_client, protocol="moesi")
+        await cache.put("key1", "value1")
+        mock_msg_client.post.reset_mock()
+        
+        result = await cache.handle_fetch("key1")
+        assert result['value'] == "value1"
+        assert cache.cache["key1"].state == CacheState.OWNED
+        
+        assert await cache.get("key1") == "value1"
+        assert cache.cache["key1"].state == CacheState.OWNED
+        
+        await cache.put("key1", "value2")
+        assert cache.cache["key1"].state == CacheState.MODIFIED
+        assert mock_msg_client.post.call_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_cache_mesif_forward_state(self, mock_msg_client):
+        """Test MESIF: newest copy is FORWARD and plain sharers stay silent"""
+        cache = CacheNode("test_node", mock_msg_client, protocol=CacheProtocol.MESIF)
+        mock_msg_client.get.return_value = {"value": "peer_value", "state": "F"}
+        
+        await cache._fetch_from_peers("key1")
+        assert cache.cache["key1"].state == CacheState.FORWARD
+        
+        result = await cache.handle_fetch("key1")
+        assert result['value'] == "peer_value"
+        assert cache.cache["key1"].state == CacheState.SHARED
+        
+        result = await cache.handle_fetch("key1")
+        assert result == {'value': None, 'declined': True}
+        assert cache.metrics['fetches_declined'] == 1
+    
+    @pytest.mark.asyncio
+    async def test_cache_mesif_falls_back_to_sharers(self, mock_msg_client):
+        """Test MESIF: with the FORWARD copy gone a sharer answers instead of a miss"""
+        sharer = CacheNode("peer1", protocol=CacheProtocol.MESIF)
+        await sharer.put("key1", "v1")
+        await sharer.handle_fetch("key1")  # peer1 keeps a plain S copy
+        
+        async def get(peer, path):
+            return await sharer.handle_fetch("key1", any_holder=path.endswith('&any=1'))
+        mock_msg_client.get.side_effect = get
+        cache = CacheNode("test_node", mock_msg_client, protocol=CacheProtocol.MESIF,
+                          fetch_mode="sequential", negative_ttl=5)
+        
+        await cache.get("key1")
+        assert await cache.get("key1") == "v1"
+        assert cache.cache["key1"].state == CacheState.FORWARD
+        assert sharer.cache["key1"].state == CacheState.SHARED
+        assert cache.metrics['forward_fallbacks'] == 1
+        assert "key1" not in cache._negative
+    
+    @pytest.mark.asyncio
+    async def test_cache_mesif_retries_only_when_declined(self, mock_msg_client):
+        """Test MESIF: a plain miss is not asked again with any=1, a declined key is"""
+        sharer = CacheNode("peer1", protocol=CacheProtocol.MESIF)
+        await sharer.put("key1", "v1")
+        await sharer.handle_fetch("key1")  # peer1 keeps a plain S copy
+        
+        async def get(peer, path):
+            return await sharer.handle_fetch(path.split('key=')[1].split('&')[0], any_holder=path.endswith('&any=1'))
+        
+        async def post(peer, path, body):
+            return await sharer.handle_mfetch(body['keys'], any_holder=body.get('any', False))
+        mock_msg_client.get.side_effect = get
+        mock_msg_client.post.side_effect = post
+        cache = CacheNode("test_node", mock_msg_client, protocol=CacheProtocol.MESIF, fetch_mode="sequential")
+        
+        await cache.get("nokey")
+        assert not any(c.args[1].endswith('&any=1') for c in mock_msg_client.get.call_args_list)
+        await cache.mget(["other", "key1"])
+        retries = [c.args[2] for c in mock_msg_client.post.call_args_list if c.args[2].get('any')]
+        assert retries == [{'keys': ["key1"], 'any': True}]
+        assert cache.cache["key1"].value == "v1"
+        assert cache.metrics['forward_fallbacks'] == 1
+    
+    @staticmethod
+    def _slow_and_fast_peers(mock_msg_client, calls):
+        async def fetch(peer, path):
+            calls.append(peer)
+            if peer == "peer1":
+                await asyncio.sleep(1.0)
+                return {"value": "slow_value"}
+            return {"value": "fast_value"}
+        mock_msg_client.get.side_effect = fetch
+    
+    @pytest.mark.asyncio
+    async def test_cache_parallel_fetch_first_answer_wins(self, mock_msg_client):
+        """Test parallel miss fetch is bounded by the fastest peer"""
+        calls = []
+        self._slow_and_fast_peers(mock_msg_client, calls)
+        cache = CacheNode("test_node", mock_msg_client, fetch_mode="parallel")
+        
+        start = time.monotonic()
+        await cache._fetch_from_peers("key1")
+        
+        assert time.monotonic() - start < 0.5
+        assert calls == ["peer1", "peer2"]
+        assert cache.cache["key1"].value == "fast_value"
+    
+    @pytest.mark.asyncio
+    async def test_cache_hedged_fetch(self, mock_msg_client):
+        """Test hedged fetch asks the next peer once the first is slower than p95"""
+        calls = []
+        self._slow_and_fast_peers(mock_msg_client, calls)
+        cache = CacheNode("test_node", mock_msg_client, fetch_mode="hedged")
+        
+        start = time.monotonic()
+        await cache._fetch_from_peers("key1")
+        
+        assert time.monotonic() - start < 0.5
+        assert cache.metrics['hedged_fetches'] == 1
+        assert cache.cache["key1"].value == "fast_value"
+    
+    @pytest.mark.asyncio
+    async def test_cache_negative_cache(self, mock_msg_client):
+        """Test a key no peer holds is not fetched again until written"""
+        mock_msg_client.get.return_value = {"value": None}
+        cache = CacheNode("test_node", mock_msg_client, negative_ttl=5, fetch_mode="sequential")
+        
+        assert await cache.get("nokey") is None
+        assert mock_msg_client.get.call_count == 2
+        assert await cache.get("nokey") is None
+        assert mock_msg_client.get.call_count == 2
+        assert cache.metrics['negative_hits'] == 1
+        
+        # A write elsewhere invalidates the key and ends the negative entry
+        await cache.handle_invalidate("nokey", sender="peer1")
+        await cache.get("nokey")
+        assert mock_msg_client.get.call_count == 4
+    
+    @pytest.mark.asyncio
+    async def test_cache_unanswered_miss_not_remembered(self, mock_msg_client):
+        """Test a miss is not negative-cached when a peer timed out or failed"""
+        async def get(peer, path):
+            return {"value": None} if peer == "peer1" else None
+        mock_msg_client.get.side_effect = get
+        mock_msg_client.post.return_value = None
+        cache = CacheNode("test_node", mock_msg_client, negative_ttl=5, fetch_mode="sequential")
+        
+        assert await cache.get("nokey") is None
+        assert "nokey" not in cache._negative
+        assert await cache.mget(["a", "b"]) == {"a": None, "b": None}
+        assert "a" not in cache._negative and "b" not in cache._negative
+        
+        # Once every peer answers, the miss is remembered
+        mock_msg_client.get.side_effect = None
+        mock_msg_client.get.return_value = {"value": None}
+        mock_msg_client.post.return_value = {"values": {}}
+        await cache.get("nokey")
+        await cache.mget(["a"])
+        assert "nokey" in cache._negative and "a" in cache._negative
+    
+    @pytest.mark.asyncio
+    async def test_cache_digest_filters_peers(self, mock_msg_client):
+        """Test misses only ask peers whose key digest may hold the key"""
+        owner = CacheNode("peer2", digest_interval=1)
+        await owner.put("key1", "value1")
+        digests = {"peer1": await CacheNode("peer1", digest_interval=1).get_digest(),
+                   "peer2": await owner.get_digest()}
+        
+        async def get(peer, path):
+            if path.startswith('/cache/digest'):
+                return digests[peer]
+            return await owner.handle_fetch("key1") if peer == "peer2" else {"value": None}
+        mock_msg_client.get.side_effect = get
+        cache = CacheNode("test_node", mock_msg_client, digest_interval=1, fetch_mode="sequential")
+        await cache.refresh_peer_digests()
+        mock_msg_client.get.reset_mock()
+        
+        assert await cache.get("key1") is None
+        assert cache.cache["key1"].value == "value1"
+        assert [c.args[0] for c in mock_msg_client.get.call_args_list] == ["peer2"]
+        assert await cache.get("nokey") is None
+        assert mock_msg_client.get.call_count == 1
+        assert cache.metrics['fetches_skipped'] == 3
+    
+    @pytest.mark.asyncio
+    async def test_cache_digest_delta(self):
+        """Test a peer that is up to date only receives the changed bytes"""
+        cache = CacheNode("test_node", digest_interval=1)
+        await cache.put("k1", "v1")
+        full = await cache.get_digest()
+        assert 'bits' in full
+        
+        await cache.put("k2", "v2")
+        delta = await cache.get_digest(epoch=full['epoch'], since=full['generation'])
+        assert 'bits' not in delta
+        assert delta['generation'] == full['generation'] + 1
+        assert 0 < len(delta['delta']) <= 7
+        # A different epoch (restarted peer) always gets the full filter
+        assert 'bits' in await cache.get_digest(epoch="other", since=full['generation'])
+    
+    @pytest.mark.asyncio
+    async def test_cache_warm_up_from_peer(self, mock_msg_client):
+        """Test a starting node copies the peer's hot clean lines before it is ready"""
+        peer = CacheNode("peer1")
+        for i in range(5):
+            await peer.put(f"k{i}", f"v{i}")
+        await peer.handle_fetch("k0")  # M -> S, clean and shareable
+        await peer.handle_fetch("k1")
+        
+        async def get(peer_id, path):
+            params = dict(p.split('=') for p in path.split('?')[1].split('&'))
+            return await peer.handle_snapshot(int(params['offset']), int(params['limit']))
+        mock_msg_client.get.side_effect = get
+        cache = CacheNode("test_node", mock_msg_client, warmup_keys=10)
+        assert not cache.ready
+        
+        await cache.warm_up()
+        
+        assert cache.ready
+        assert set(cache.cache) == {"k0", "k1"}
+        assert cache.cache["k0"].state == CacheState.SHARED
+        assert cache.metrics['warmed_keys'] == 2
+    
+    @pytest.mark.asyncio
+    async def test_cache_warm_up_from_snapshot_file(self, mock_msg_client, tmp_path):
+        """Test warm-up falls back to the local snapshot when no peer answers"""
+        path = str(tmp_path / "cache.snapshot")
+        old = CacheNode("test_node", warmup_keys=10, snapshot_path=path)
+        await old.put("k1", "v1")
+        await old.put("k2", "v2", ttl=60)
+        await old.handle_mfetch(["k1", "k2"])  # shared copies are clean
+        await old.put("dirty", "v3")
+        await old.save_snapshot()
+        
+        mock_msg_client.get.return_value = None
+        cache = CacheNode("test_node", mock_msg_client, warmup_keys=10, snapshot_path=path)
+        await cache.warm_up()
+        
+        assert cache.cache["k1"].value == "v1"
+        assert "dirty" not in cache.cache
+        # Invalidations missed while down are bounded by a short TTL
+        assert 0 < cache.ttl_remaining("k1") <= cache.SNAPSHOT_TTL
+        assert 0 < cache.ttl_remaining("k2") <= cache.SNAPSHOT_TTL
+    
+    @pytest.mark.asyncio
+    async def test_cache_warm_up_skips_invalidated_keys(self, mock_msg_client):
+        """Test a key invalidated while warming is not installed from the snapshot"""
+        cache = CacheNode("test_node", mock_msg_client, warmup_keys=10)
+        
+        async def get(peer_id, path):
+            await cache.handle_invalidate("k1")
+            return {'lines': [{'key': "k1", 'value': "old", 'ttl': None},
+                              {'key': "k2", 'value': "v2", 'ttl': None}], 'more': False}
+        mock_msg_client.get.side_effect = get
+        await cache.warm_up()
+        
+        assert "k1" not in cache.cache
+        assert cache.cache["k2"].value == "v2"
+    
+    @pytest.mark.asyncio
+    async def test_cache_compresses_large_values(self, mock_msg_client):
+        """Test large values are stored compressed and read back transparently"""
+        cache = CacheNode("test_node", mock_msg_client, compress_threshold=1024)
+        blob = {"rows": [{"id": i, "name": "item"} for i in range(500)]}
+        await cache.put("big", blob)
+        await cache.put("small", "tiny")
+        
+        assert cache.cache["big"].codec == 'zlib'
+        assert cache.cache["small"].codec is None
+        assert cache.bytes_used < len(json.dumps(blob))
+        assert await cache.get("big") == blob
+        state = await cache.get_cache_state()
+        assert state['compression']['lines'] == 1
+        assert state['compression']['ratio'] < 0.5
+        
+        await cache.mdelete(["big"])
+        assert cache.compressed_lines == 0
+        assert cache.compressed_raw_bytes == 0
+    
+    @pytest.mark.asyncio
+    async def test_cache_compressed_fetch_passthrough(self, mock_msg_client):
+        """Test compressed lines travel between nodes without recompression"""
+        owner = CacheNode("peer1", compress_threshold=1024)
+        blob = ["x" * 50] * 100
+        await owner.put("big", blob)
+        line = await owner.handle_fetch("big")
+        assert line['codec'] == 'zlib'
+        
+        mock_msg_client.get.return_value = line
+        cache = CacheNode("test_node", mock_msg_client)
+        with patch('src.nodes.cache_node.zlib.compress') as compress:
+            await cache.get("big")
+            compress.assert_not_called()
+        
+        assert cache.cache["big"].value == owner.cache["big"].value
+        assert await cache.get("big") == blob
+    
+    @pytest.mark.asyncio
+    async def test_cache_purge_prefix_and_tags(self, cache_instance, mock_msg_client):
+        """Test bulk invalidation drops matching lines and sends one message per peer"""
+        await cache_instance.mput({"user:42:profile": 1, "user:42:cart": 2, "user:420:profile": 3})
+        await cache_instance.put("session:a", "s", tags=["user:42"])
+        await cache_instance.put("session:b", "s", tags=["user:7"])
+        mock_msg_client.post.reset_mock()
+        
+        assert await cache_instance.purge(prefix="user:42:") == 2
+        assert sorted(cache_instance.cache) == ["session:a", "session:b", "user:420:profile"]
+        assert await cache_instance.purge(tags=["user:42"]) == 1
+        assert "session:a" not in cache_instance.cache
+        assert "session:b" in cache_instance.cache
+        
+        assert mock_msg_client.post.call_count == 4
+        assert mock_msg_client.post.call_args_list[0].args[1:] == (
+            '/cache/invalidate_bulk', {'prefix': "user:42:", 'tags': [], 'node': "test_node"})
+    
+    @pytest.mark.asyncio
+    async def test_cache_tags_travel_with_fetched_lines(self, mock_msg_client):
+        """Test a fetched copy keeps its tags so a peer's tag purge removes it"""
+        owner = CacheNode("peer1")
+        await owner.put("k1", "v1", tags=["t"])
+        mock_msg_client.get.return_value = await owner.handle_fetch("k1")
+        cache = CacheNode("test_node", mock_msg_client, prefix_index=True)
+        await cache.get("k1")
+        
+        assert await cache.handle_invalidate_bulk(tags=["t"]) == 1
+        assert cache.cache == {}
+        assert len(cache.prefixes) == 0
+    
+    @pytest.mark.asyncio
+    async def test_cache_versions_increase_and_travel(self, cache_instance, mock_msg_client):
+        """Test writes stamp increasing versions carried in invalidations and fetches"""
+        await cache_instance.put("k1", "v1")
+        first = cache_instance.cache["k1"].version
+        await cache_instance.handle_fetch("k1")  # M -> S, next write invalidates
+        await cache_instance.put("k1", "v2")
+        
+        assert cache_instance.cache["k1"].version > first
+        assert mock_msg_client.post.call_args.args[2]['version'] == cache_instance.cache["k1"].version
+        assert (await cache_instance.handle_fetch("k1"))['version'] == cache_instance.cache["k1"].version
+    
+    @pytest.mark.asyncio
+    async def test_cache_ignores_stale_invalidation(self, cache_instance):
+        """Test an invalidation older than the line we hold does not drop it"""
+        await cache_instance.put("k1", "v1")
+        version = cache_instance.cache["k1"].version
+        
+        await cache_instance.handle_invalidate("k1", version=version - 1)
+        assert "k1" in cache_instance.cache
+        assert cache_instance.metrics['stale_invalidations'] == 1
+        await cache_instance.handle_invalidate("k1", version=version + 1)
+        assert "k1" not in cache_instance.cache
+    
+    @pytest.mark.asyncio
+    async def test_cache_conditional_fetch_revalidates(self, mock_msg_client):
+        """Test an expired large line is revalidated by version without the body"""
+        owner = CacheNode("peer1")
+        blob = "x" * 4096
+        await owner.put("big", blob)
+        
+        async def get(peer, path):
+            params = dict(p.split('=') for p in path.split('?')[1].split('&'))
+            if_version = int(params['if_version']) if 'if_version' in params else None
+            return await owner.handle_fetch(params['key'], if_version=if_version)
+        mock_msg_client.get.side_effect = get
+        cache = CacheNode("test_node", mock_msg_client, fetch_mode="sequential", default_ttl=60)
+        await cache.get("big")
+        cache.cache["big"].expires_at = time.time() - 1
+        
+        assert await cache.get("big") is None  # lazily expired, revalidated from peer1
+        line = mock_msg_client.get.call_args.args[1]
+        assert 'if_version=' in line
+        assert cache.metrics['revalidations'] == 1
+        assert await cache.get("big") == blob
+        
+        # After a new write the peer sends the full body again
+        await owner.put("big", "y" * 4096)
+        cache.cache["big"].expires_at = time.time() - 1
+        await cache.get("big")
+        assert await cache.get("big") == "y" * 4096
+        assert cache.metrics['revalidations'] == 1
+    
+    @pytest.mark.asyncio
+    async def test_cache_retired_lines_count_against_byte_capacity(self):
+        """Test lines kept for revalidation are bounded by bytes and use the byte budget"""
+        cache = CacheNode("test_node", capacity=None, capacity_bytes=40000)
+        for i in range(20):
+            await cache.put(f"k{i}", "x" * 2000)
+        
+        assert 0 < cache.stale_bytes <= 40000 * cache.STALE_SHARE
+        assert cache.bytes_used + cache.stale_bytes <= 40000
+        assert (await cache.get_cache_state())['stale_bytes'] == cache.stale_bytes
+    
+    @pytest.mark.asyncio
+    async def test_cache_write_update_pushes_to_sharers(self, mock_msg_client):
+        """Test write-update keys are updated in place on sharers, not invalidated"""
+        writer = CacheNode("test_node", mock_msg_client, write_update=["flags:*"])
+        sharer = CacheNode("peer1")
+        await sharer.put("flags:beta", False)
+        writer._install_fetched("flags:beta", await sharer.handle_fetch("flags:beta"))
+        
+        async def post(peer, path, body):
+            if peer == "peer1" and path == '/cache/update':
+                return await sharer.handle_update(body['lines'], sender=body['node'])
+            return {'applied': []}
+        mock_msg_client.post.side_effect = post
+        
+        await writer.put("flags:beta", True)
+        
+        assert sharer.cache["flags:beta"].value is True
+        assert sharer.cache["flags:beta"].version == writer.cache["flags:beta"].version
+        assert writer.cache["flags:beta"].state == CacheState.SHARED
+        assert sharer.metrics['updates_applied'] == 1
+        assert all(c.args[1] == '/cache/update' for c in mock_msg_client.post.call_args_list)
+        
+        # Other keys keep invalidating
+        await writer.put("plain", 1)
+        assert mock_msg_client.post.call_args.args[1] == '/cache/invalidate'
+    
+    @pytest.mark.asyncio
+    async def test_cache_write_update_ignored_without_copy(self):
+        """Test a pushed update is not installed on a node that holds no copy"""
+        cache = CacheNode("test_node")
+        result = await cache.handle_update({"config": {'value': 1, 'version': 5, 'ttl': None}})
+        
+        assert result == {'applied': []}
+        assert cache.cache == {}
+    
+    @pytest.mark.asyncio
+    async def test_cache_write_update_ends_miss_state(self, mock_msg_client):
+        """Test a pushed update marks the writer as a holder and drops the negative entry"""
+        writer = CacheNode("peer1", digest_interval=1)
+        empty_digest = await writer.get_digest()
+        
+        async def get(peer, path):
+            if path.startswith('/cache/digest'):
+                return empty_digest
+            return await writer.handle_fetch("flags:new")
+        mock_msg_client.peers = ["peer1"]
+        mock_msg_client.get.side_effect = get
+        cache = CacheNode("test_node", mock_msg_client, digest_interval=1, negative_ttl=60,
+                          fetch_mode="sequential")
+        await cache.refresh_peer_digests()
+        assert await cache.get("flags:new") is None
+        assert "flags:new" in cache._negative
+        
+        await writer.put("flags:new", True)
+        line = {'value': True, 'version': writer.cache["flags:new"].version, 'ttl': None}
+        assert await cache.handle_update({"flags:new": line}, sender="peer1") == {'applied': []}
+        assert "flags:new" not in cache._negative
+        await cache.get("flags:new")
+        assert await cache.get("flags:new") is True
+    
+    @staticmethod
+    def _partitioned_cluster(size=3):
+        """Partitioned nodes whose message clients call each other directly"""
+        names = [f"node{i}" for i in range(1, size + 1)]
+        nodes = {}
+        
+        def client_for(name):
+            client = Mock()
+            client.peers = names
+            
+            async def get(peer, path):
+                params = dict(p.split('=') for p in path.split('?')[1].split('&'))
+                value = await nodes[peer].get(params['key'], forwarded=params.get('forwarded') == '1',
+                                              reader=params.get('node'))
+                return {'value': value}
+            
+            async def post(peer, path, body):
+                node = nodes[peer]
+                if path == '/cache/put':
+                    return {'success': await node.put(body['key'], body['value'], forwarded=True)}
+                if path == '/cache/mget':
+                    return {'values': await node.mget(body['keys'], forwarded=True, reader=body.get('node'))}
+                if path == '/cache/mput':
+                    return {'success': await node.mput(body['items'], forwarded=True)}
+                if path == '/cache/mdelete':
+                    return {'deleted': await node.mdelete(body['keys'], forwarded=True)}
+                if path == '/cache/minvalidate':
+                    return await node.handle_minvalidate(body['keys'], sender=body['node'], version=body['version'])
+                return None
+            client.get = AsyncMock(side_effect=get)
+            client.post = AsyncMock(side_effect=post)
+            return client
+        
+        for name in names:
+            nodes[name] = CacheNode(name, client_for(name), mode="partitioned", l1_ttl=60)
+        return nodes
+    
+    @pytest.mark.asyncio
+    async def test_cache_partitioned_keys_live_on_owner(self):
+        """Test partitioned mode stores each key only on its ring owner"""
+        nodes = self._partitioned_cluster()
+        keys = [f"key{i}" for i in range(30)]
+        for i, key in enumerate(keys):
+            await nodes["node1"].put(key, i)
+        
+        for key in keys:
+            owner = nodes["node1"].ring.owner(key)
+            holders = [name for name, node in nodes.items() if key in node.cache]
+            assert holders == [owner]
+        assert sum(len(node.cache) for node in nodes.values()) == len(keys)
+        # node1 proxied writes to other owners and fanned out only its own keys
+        for c in nodes["node1"].msg.post.call_args_list:
+            if c.args[1] == '/cache/minvalidate':
+                assert all(nodes["node1"].ring.owner(k) == "node1" for k in c.args[2]['keys'])
+            else:
+                assert c.args[1] == '/cache/put'
+        
+        values = await nodes["node2"].mget(keys)
+        assert values == {key: i for i, key in enumerate(keys)}
+    
+    @pytest.mark.asyncio
+    async def test_cache_partitioned_l1(self):
+        """Test reads through another owner are served from the local L1"""
+        nodes = self._partitioned_cluster()
+        node1 = nodes["node1"]
+        key = next(k for k in (f"key{i}" for i in range(100)) if node1.ring.owner(k) != "node1")
+        await node1.put(key, "v1")
+        
+        assert await node1.get(key) == "v1"
+        assert await node1.get(key) == "v1"
+        assert node1.metrics['l1_hits'] == 1
+        assert key not in node1.cache
+        
+        # A write through this node drops its L1 copy
+        await node1.put(key, "v2")
+        assert await node1.get(key) == "v2"
+        assert await node1.mdelete([key]) == 1
+        assert await node1.get(key) is None
+    
+    @pytest.mark.asyncio
+    async def test_cache_partitioned_invalidations_reach_every_node(self):
+        """Test subscribers on the proxying and on third nodes see owner writes"""
+        nodes = self._partitioned_cluster()
+        node1 = nodes["node1"]
+        key = next(k for k in (f"key{i}" for i in range(100)) if node1.ring.owner(k) == "node2")
+        await nodes["node3"].put(key, "v1")
+        assert await nodes["node3"].get(key) == "v1"  # L1 copy on node3
+        queues = {name: node.subscribe() for name, node in nodes.items()}
+        
+        await node1.put(key, "v2")
+        
+        for name in ("node1", "node2", "node3"):
+            assert key in queues[name].get_nowait()['keys']
+        assert key not in nodes["node3"]._l1
+        # Only node3 read the key through the owner, so only it was sent an invalidation
+        sent = [c.args[0] for c in nodes["node2"].msg.post.call_args_list if c.args[1] == '/cache/minvalidate']
+        assert sent == ["node3"]
+        assert await nodes["node3"].get(key) == "v2"
+        
+        await node1.mdelete([key])
+        assert key in queues["node3"].get_nowait()['keys']
+        # Reads are remembered until the next write: a second write reaches nobody
+        nodes["node2"].msg.post.reset_mock()
+        await node1.put(key, "v3")
+        assert all(c.args[1] != '/cache/minvalidate' for c in nodes["node2"].msg.post.call_args_list)
     
     @pytest.mark.asyncio
     async def test_cache_lru_eviction(self, cache_instance):
@@ -342,23 +1540,76 @@ class TestCacheNode:
         assert "key0" not in cache_instance.cache  # First item evicted
         assert "key10" in cache_instance.cache  # New item added
     
+    @pytest.mark.asyncio
+    async def test_cache_byte_capacity_eviction(self, mock_msg_client):
+        """Test eviction bounded by value bytes instead of entry count"""
+        cache = CacheNode("test_node", mock_msg_client, capacity=None,
+                          capacity_bytes=100, eviction_policy="lru")
+        await cache.put("small", "x")
+        await cache.put("big", "y" * 90)
+        await cache.put("other", "z" * 20)
+        
+        assert "small" not in cache.cache
+        assert "big" not in cache.cache
+        assert "other" in cache.cache
+        assert cache.bytes_used <= 100
+        assert cache.metrics['evictions'] == 2
+    
+    @pytest.mark.asyncio
+    async def test_cache_wtinylfu_byte_bounded(self):
+        """Test W-TinyLFU with only a byte bound sizes its sketch to the resident set"""
+        cache = CacheNode("test_node", capacity=None, capacity_bytes=9000, eviction_policy="wtinylfu")
+        hot = [f"hot{i}" for i in range(20)]
+        for key in hot:
+            await cache.put(key, "v")
+            for _ in range(5):
+                await cache.get(key)
+        for i in range(8000):
+            await cache.put(f"scan{i}", "v")
+        
+        assert len(cache.cache) > 1024
+        assert cache.policy.sketch.width >= len(cache.cache)
+        assert all(key in cache.cache for key in hot)
+    
+    @pytest.mark.asyncio
+    async def test_cache_ttl_lazy_expiry(self, cache_instance):
+        """Test expired line is dropped on access"""
+        await cache_instance.put("key1", "value1", ttl=30)
+        assert 0 < cache_instance.ttl_remaining("key1") <= 30
+        
+        cache_instance.cache["key1"].expires_at = time.time() - 1
+        result = await cache_instance.get("key1")
+        
+        assert result is None
+        assert "key1" not in cache_instance.cache
+        assert cache_instance.metrics['expirations'] == 1
+        assert cache_instance.metrics['lazy_expirations'] == 1
+    
+    @pytest.mark.asyncio
+    async def test_cache_ttl_wheel_expiry(self, cache_instance):
+        """Test timing wheel reports expired keys without scanning"""
+        await cache_instance.put("key1", "value1", ttl=2)
+        await cache_instance.put("key2", "value2")
+        
+        expired = cache_instance.wheel.advance(time.time() + 3)
+        
+        assert expired == ["key1"]
+        assert cache_instance.ttl_remaining("key2") is None
+    
     @pytest.mark.asyncio
     async def test_cache_state_transitions(self, cache_instance):
         """Test MESI state transitions"""
         # Initial put - should be Modified
         await cache_instance.put("key1", "value1")
-        state, _, _ = cache_instance.cache["key1"]
-        assert state == CacheState.MODIFIED
+        assert cache_instance.cache["key1"].state == CacheState.MODIFIED
         
         # Get from same node - should stay Modified
         await cache_instance.get("key1")
-        state, _, _ = cache_instance.cache["key1"]
-        assert state == CacheState.MODIFIED
+        assert cache_instance.cache["key1"].state == CacheState.MODIFIED
         
         # Handle fetch from peer - should become Shared
         await cache_instance.handle_fetch("key1")
-        state, _, _ = cache_instance.cache["key1"]
-        assert state == CacheState.SHARED
+        assert cache_instance.cache["key1"].state == CacheState.SHARED
 
 class TestMessageClient:
     """Test suite untuk Message Client"""
@@ -467,6 +1718,27 @@ class TestSystemMetrics:
             assert system_metrics.metrics.metrics['gauge']['cpu_usage_percent'] == 50.0
             assert system_metrics.metrics.metrics['gauge']['memory_usage_percent'] == 60.0
             assert system_metrics.metrics.metrics['gauge']['disk_usage_percent'] == 70.0
+    
+    def test_record_queue_stats(self, system_metrics):
+        """Test queue statistics are exported as labelled gauges"""
+        system_metrics.record_queue_stats({'orders': {
+            'depth': 4, 'enqueue_rate': 2.0, 'dequeue_rate': 1.5, 'oldest_age_seconds': None,
+            'groups': [{'group': 'billing', 'pending': 1, 'lag': 7}]}})
+        gauges = system_metrics.metrics.metrics['gauge']
+        assert gauges['queue_depth{topic=orders}'] == 4
+        assert gauges['queue_dequeue_rate{topic=orders}'] == 1.5
+        assert 'queue_oldest_age_seconds{topic=orders}' not in gauges
+        assert gauges['queue_group_lag{group=billing,topic=orders}'] == 7
+    
+    def test_rate_counter_window(self):
+        """Test rate counter averages over its window and forgets old buckets"""
+        rate = RateCounter(window=10)
+        rate.add(5, now=100.2)
+        rate.add(15, now=105.9)
+        assert rate.rate(now=106) == 2.0
+        assert rate.rate(now=110.5) == 1.5
+        rate.add(1, now=115)
+        assert rate.rate(now=115) == 0.1
 
 class TestIntegration:
     """Integration tests untuk seluruh sistem"""
@@ -519,8 +1791,7 @@ class TestIntegration:
     async def test_queue_workflow(self):
         """Test queue workflow"""
         mock_redis = Mock()
-        mock_redis.rpush = AsyncMock(return_value=1)
-        mock_redis.lpop = AsyncMock(return_value="test_message")
+        mock_redis.eval = AsyncMock(side_effect=[1, ["test_message"]])
         
         queue = DistributedQueue("node1", mock_redis)
         
@@ -0,0 +1,81 @@
+import pytest
+from src.utils.eviction import Link, make_policy, LRUPolicy, LFUPolicy, ARCPolicy, WTinyLFUPolicy
+
+def test_make_policy_by_name():
+    assert isinstance(make_policy('lru'), LRUPolicy)
+    assert isinstance(make_policy('LFU'), LFUPolicy)
+    assert isinstance(make_policy('arc'), ARCPolicy)
+    assert isinstance(make_policy('wtinylfu', 100), WTinyLFUPolicy)
+    with pytest.raises(ValueError):
+        make_policy('fifo')
+
+def test_lfu_evicts_least_frequent():
+    p = make_policy('lfu')
+    for k in ('a', 'b', 'c'):
+        p.record_insert(k)
+    p.record_access('a')
+    p.record_access('c')
+    assert p.victim() == 'b'
+    assert len(p) == 2
+
+def test_arc_promotes_reused_keys():
+    p = make_policy('arc')
+    for k in ('a', 'b', 'c'):
+        p.record_insert(k)
+    p.record_access('a')
+    # 'a' lives in T2, so the T1 LRU key goes first
+    assert p.victim() == 'b'
+    assert 'b' in p.b1
+
+def test_wtinylfu_resists_scan():
+    p = make_policy('wtinylfu', 100)
+    for k in ('hot1', 'hot2'):
+        p.record_insert(k)
+        for _ in range(5):
+            p.record_access(k)
+    evicted = []
+    for i in range(50):
+        p.record_insert(f'scan{i}')
+        if len(p) > 10:
+            evicted.append(p.victim())
+    assert 'hot1' not in evicted
+    assert 'hot2' not in evicted
+
+@pytest.mark.parametrize('name', ['lru', 'lfu', 'arc', 'wtinylfu'])
+def test_hot_keys_last_to_be_evicted(name):
+    p = make_policy(name, 100)
+    for k in ('a', 'b', 'c'):
+        p.record_insert(k)
+    p.record_access('c')
+    p.record_access('c')
+    hot = p.hot_keys(2)
+    assert len(hot) == 2
+    assert hot[0] == 'c'
+    assert sorted(p.hot_keys(10)) == ['a', 'b', 'c']
+
+@pytest.mark.parametrize('name', ['lru', 'lfu', 'arc', 'wtinylfu'])
+def test_policy_links_through_entries(name):
+    entries = {k: Link(k) for k in ('a', 'b', 'c')}
+    p = make_policy(name, 100, entries=entries)
+    for k in ('a', 'b', 'c'):
+        p.record_insert(k)
+    p.record_access('a')
+    p.remove('c')
+    assert entries['c'].owner is None
+    assert len(p) == 2
+    assert p.victim() == 'b'
+    # The policy unlinks entries but leaves the dict to its owner
+    assert set(entries) == {'a', 'b', 'c'}
+    assert entries['b'].owner is None
+    assert p.hot_keys(10) == ['a']
+
+def test_wtinylfu_sketch_grows_without_capacity_hint():
+    p = make_policy('wtinylfu')
+    p.record_insert('hot')
+    for _ in range(8):
+        p.record_access('hot')
+    for i in range(5000):
+        p.record_insert(f'k{i}')
+    assert p.sketch.width >= len(p)
+    # Popularity survives the rebuilds
+    assert p.sketch.estimate('hot') >= 8
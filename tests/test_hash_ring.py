@@ -0,0 +1,29 @@
+from collections import Counter
+from src.utils.hash_ring import ConsistentHashRing
+
+def test_ring_is_deterministic_and_balanced():
+    ring = ConsistentHashRing(['node1', 'node2', 'node3'])
+    same = ConsistentHashRing(['node3', 'node1', 'node2'])
+    keys = [f'key{i}' for i in range(3000)]
+    assert [ring.owner(k) for k in keys] == [same.owner(k) for k in keys]
+    counts = Counter(ring.owner(k) for k in keys)
+    assert set(counts) == {'node1', 'node2', 'node3'}
+    assert min(counts.values()) > 600
+
+def test_adding_a_node_only_moves_its_keys():
+    ring = ConsistentHashRing(['node1', 'node2', 'node3'])
+    keys = [f'key{i}' for i in range(2000)]
+    before = {k: ring.owner(k) for k in keys}
+    ring.add_node('node4')
+    moved = [k for k in keys if ring.owner(k) != before[k]]
+    assert moved
+    assert all(ring.owner(k) == 'node4' for k in moved)
+    ring.remove_node('node4')
+    assert {k: ring.owner(k) for k in keys} == before
+
+def test_owners_are_distinct():
+    ring = ConsistentHashRing(['a', 'b', 'c'], vnodes=10)
+    owners = ring.owners('key', 3)
+    assert sorted(owners) == ['a', 'b', 'c']
+    assert owners[0] == ring.owner('key')
+    assert ConsistentHashRing().owner('key') is None
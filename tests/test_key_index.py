@@ -0,0 +1,30 @@
+from src.utils.key_index import PrefixIndex, TagIndex
+
+def test_prefix_index_segment_and_partial_prefixes():
+    index = PrefixIndex()
+    for key in ('user:42', 'user:42:cart', 'user:420:cart', 'user:5', 'order:1'):
+        index.add(key)
+    assert sorted(index.keys_with_prefix('user:42:')) == ['user:42:cart']
+    assert sorted(index.keys_with_prefix('user:42')) == ['user:42', 'user:420:cart', 'user:42:cart']
+    assert sorted(index.keys_with_prefix('us')) == ['user:42', 'user:420:cart', 'user:42:cart', 'user:5']
+    assert index.keys_with_prefix('nope:') == []
+
+def test_prefix_index_remove_prunes():
+    index = PrefixIndex()
+    index.add('a:b:c')
+    index.add('a:b')
+    index.remove('a:b:c')
+    assert index.keys_with_prefix('a:') == ['a:b']
+    index.remove('a:b')
+    assert len(index) == 0
+    assert index._root.children == {}
+
+def test_tag_index():
+    index = TagIndex()
+    index.set('k1', ['t1', 't2'])
+    index.set('k2', ['t2'])
+    assert index.keys_with_tags(['t2']) == {'k1', 'k2'}
+    index.set('k1', None)
+    assert index.keys_with_tags(['t1', 't2']) == {'k2'}
+    index.remove('k2')
+    assert index.keys_with_tags(['t2']) == set()
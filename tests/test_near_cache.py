@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from src.api.endpoints import register_routes
+from src.client.near_cache import NearCacheClient
+from src.nodes.cache_node import CacheNode
+
+async def _wait_for(predicate, timeout=2.0):
+    deadline = asyncio.get_event_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_event_loop().time() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.01)
+
+@pytest.mark.asyncio
+async def test_near_cache_serves_hits_locally_until_invalidated():
+    app = web.Application()
+    app['node_id'] = 'test_node'
+    app['cache'] = CacheNode('test_node')
+    await register_routes(app)
+    server = TestServer(app)
+    await server.start_server()
+    client = NearCacheClient(str(server.make_url('')))
+    try:
+        await client.start()
+        await _wait_for(lambda: client.connected)
+        
+        await client.put('k1', 'v1')
+        # Our own write is echoed back as an invalidation
+        await _wait_for(lambda: client.stats['invalidations'] == 1)
+        assert await client.get('k1') == 'v1'
+        assert await client.get('k1') == 'v1'
+        assert client.stats['hits'] == 1
+        
+        # A write on the node (e.g. from another client) is pushed to us
+        await app['cache'].put('k1', 'v2')
+        await _wait_for(lambda: 'k1' not in client._local)
+        assert await client.get('k1') == 'v2'
+        assert client.stats['invalidations'] == 2
+    finally:
+        await client.close()
+        await server.close()
+
+@pytest.mark.asyncio
+async def test_subscriber_overflow_sends_reset():
+    cache = CacheNode('test_node')
+    queue = cache.subscribe(maxsize=2)
+    
+    for i in range(3):
+        await cache.handle_invalidate(f'k{i}')
+    
+    assert queue.qsize() == 1
+    assert queue.get_nowait() == {'type': 'reset'}
+    assert cache.metrics['subscriber_resets'] == 1
+
+@pytest.mark.asyncio
+async def test_prefix_purge_reaches_near_cache():
+    cache = CacheNode('test_node')
+    queue = cache.subscribe()
+    client = NearCacheClient('http://unused')
+    client._apply_event({'type': 'reset'})
+    client._local['user:1:a'] = ('v', None)
+    client._local['user:2:a'] = ('v', None)
+    
+    await cache.purge(prefix='user:1:')
+    client._apply_event(queue.get_nowait())
+    
+    assert list(client._local) == ['user:2:a']
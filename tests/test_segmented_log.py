@@ -0,0 +1,67 @@
+import os
+from src.utils.segmented_log import SegmentedLog
+
+def _segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.log'))
+
+def test_append_read_and_length(tmp_path):
+    log = SegmentedLog(str(tmp_path))
+    assert len(log) == 0
+    assert log.append(['a', 'b\nwith newline', 'ü']) == 3
+    assert len(log) == 3
+    assert log.read(2) == ['a', 'b\nwith newline']
+    assert len(log) == 1
+    log.append(['d'])
+    assert log.read(10) == ['ü', 'd']
+    assert log.read(10) == []
+
+def test_segments_roll_and_are_deleted_once_consumed(tmp_path):
+    log = SegmentedLog(str(tmp_path), segment_bytes=64)
+    for i in range(20):
+        log.append([f'message-{i:02d}'])
+    assert len(_segments(tmp_path)) > 3
+    assert log.read(10) == [f'message-{i:02d}' for i in range(10)]
+    remaining = _segments(tmp_path)
+    assert len(remaining) < 4
+    assert log.read(100) == [f'message-{i:02d}' for i in range(10, 20)]
+    assert len(_segments(tmp_path)) == 1
+
+def test_offset_survives_restart(tmp_path):
+    log = SegmentedLog(str(tmp_path), segment_bytes=64)
+    log.append([f'm{i}' for i in range(30)])
+    log.append([f'm{i}' for i in range(30, 40)])
+    assert log.read(15) == [f'm{i}' for i in range(15)]
+    log.close()
+
+    reopened = SegmentedLog(str(tmp_path), segment_bytes=64)
+    assert len(reopened) == 25
+    reopened.append(['m40'])
+    assert reopened.read(100) == [f'm{i}' for i in range(15, 41)]
+
+def test_torn_final_write_is_dropped(tmp_path):
+    log = SegmentedLog(str(tmp_path))
+    log.append(['complete'])
+    log.close()
+    with open(os.path.join(tmp_path, _segments(tmp_path)[-1]), 'ab') as f:
+        f.write(b'\x00\x00\x00\x10part')
+
+    reopened = SegmentedLog(str(tmp_path))
+    assert len(reopened) == 1
+    reopened.append(['next'])
+    assert reopened.read(10) == ['complete', 'next']
+
+def test_peek_does_not_consume(tmp_path):
+    log = SegmentedLog(str(tmp_path), segment_bytes=32)
+    log.append([f'm{i}' for i in range(10)])
+    first = log.peek(3)
+    assert first == ['m0', 'm1', 'm2']
+    assert log.peek(3) == first
+    assert len(log) == 10
+    assert log.read(len(first)) == first
+    seen = []
+    while len(log):
+        batch = log.peek(100)
+        assert batch
+        seen += batch
+        log.read(len(batch))
+    assert seen == [f'm{i}' for i in range(3, 10)]
@@ -0,0 +1,23 @@
+from src.utils.timing_wheel import TimingWheel
+
+def test_wheel_expires_in_order():
+    wheel = TimingWheel(tick=1.0, slots=8, levels=3, now=0)
+    wheel.schedule('a', 3)
+    wheel.schedule('b', 20)
+    wheel.schedule('c', 100)
+    assert wheel.advance(2) == []
+    assert wheel.advance(3) == ['a']
+    assert wheel.advance(19) == []
+    assert wheel.advance(20) == ['b']
+    assert wheel.advance(100) == ['c']
+    assert len(wheel) == 0
+
+def test_wheel_cancel_and_reschedule():
+    wheel = TimingWheel(tick=1.0, slots=8, levels=2, now=0)
+    wheel.schedule('a', 5)
+    wheel.schedule('b', 5)
+    wheel.cancel('b')
+    wheel.schedule('a', 40)
+    assert wheel.advance(10) == []
+    assert 'a' in wheel
+    assert wheel.advance(40) == ['a']